@@ -0,0 +1,626 @@
+"""
+Programmatic client library (asyncio), with a blocking wrapper and a pool.
+
+Every command is sent as a FRAME_REQUEST carrying a request id, and the
+server tags its reply with the same id, so each call returns a future that
+resolves to the parsed reply (or raises CommandError for ERROR: replies,
+BusyError when the server's rate limits refused the command).
+Requests are written as soon as they are made, without waiting for
+earlier replies, so any number can be pipelined over one connection.
+Messages pushed by the server (MSG, QUEUED) arrive untagged and are read
+with receive(); QUEUED deliveries are ACKed automatically, and the
+server's heartbeat PINGs are answered with PONG. With
+compress=True the client negotiates zlib compression (HELLO) on connect.
+
+    async with AsyncClient(identity="alice") as client:
+        msg_id = await client.send(2, "hello")
+        ids = await client.send_many([(2, "a"), (3, "b")])
+        message = await client.receive()
+
+    client = SyncClient(identity="bob")      # same API, blocking
+    client.send(2, "hi")
+
+    async with ClientPool(1000) as pool:     # many logical clients, one loop
+        async with pool.acquire() as client:
+            await client.list_clients()
+"""
+import asyncio
+import itertools
+import re
+import threading
+import time
+from collections import namedtuple
+
+from protocol import (FrameDecoder, FRAME_REPLY, DEFAULT_DICTIONARY_ID, compression_for, encode_message,
+                      encode_request, split_request)
+
+HOST = '127.0.0.1'
+PORT = 5000
+CALL_TIMEOUT = 10.0  # seconds call() / call_many() and SyncClient wait for a reply
+READ_SIZE = 64 * 1024
+# Streamed pages buffered per stream before the client stops reading the socket
+STREAM_QUEUE_PAGES = 4
+
+# A message pushed by the server; message_id is set for QUEUED (offline)
+# deliveries, group for messages published to a group
+Message = namedtuple('Message', 'sender_id content message_id queued group', defaults=(None,))
+# One MSG_LIST entry; other_id is a client id or "broadcast", created_at a unix time
+StoredMessage = namedtuple('StoredMessage', 'message_id direction other_id created_at')
+
+_MESSAGE_ID = re.compile(r"ID:(\d+)")
+
+
+class CommandError(Exception):
+    """The server answered a request with ERROR:<reason>"""
+
+
+class BusyError(CommandError):
+    """The server refused a request or the connection for now (BUSY); retry after retry_after seconds"""
+
+    def __init__(self, body):
+        fields = dict(field.split("=", 1) for field in body.split(",") if "=" in field)
+        self.retry_after = int(fields.get("RetryAfter", "0ms").rstrip("ms") or 0) / 1000
+        self.limit = fields.get("Limit")
+        super().__init__(f"{self.limit} limit reached, retry after {self.retry_after}s")
+
+
+class AsyncClient:
+    """One connection to the chat server"""
+
+    def __init__(self, host=HOST, port=PORT, identity=None, compress=False, dict_id=DEFAULT_DICTIONARY_ID):
+        self.host = host
+        self.port = port
+        self.identity = identity
+        self.compress = compress
+        self.dict_id = dict_id
+        self.compression = None  # agreed with the server by hello()
+        self.client_id = None
+        self.reader = None
+        self.writer = None
+        self.pending = {}  # request id -> future
+        self.streams = {}  # request id -> queue of streamed replies
+        self.inbox = asyncio.Queue()
+        self.request_ids = itertools.count(1)
+        self.reader_task = None
+        self.closed = False
+        self.refused = None  # BusyError if the server refused the connection
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.reader_task = asyncio.ensure_future(self._read_loop())
+        if self.compress:
+            await self.hello(self.dict_id)
+        if self.identity:
+            await self.identify(self.identity)
+        return self
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    # --- requests ---
+
+    def request(self, command):
+        """Write one command now and return a future for its raw reply text"""
+        future, frame = self._prepare(command)
+        self.writer.write(frame)
+        return future
+
+    async def call(self, command, timeout=CALL_TIMEOUT):
+        """Send one command and wait for its raw reply text (asyncio.TimeoutError after timeout seconds)"""
+        future = self.request(command)
+        return (await self._wait_replies([future], timeout))[0]
+
+    async def call_many(self, commands, timeout=CALL_TIMEOUT):
+        """Pipeline many commands in one write; raw replies in the same order"""
+        futures = []
+        frames = []
+        for command in commands:
+            future, frame = self._prepare(command)
+            futures.append(future)
+            frames.append(frame)
+        self.writer.writelines(frames)
+        return await self._wait_replies(futures, timeout)
+
+    async def _wait_replies(self, futures, timeout):
+        async def replies():
+            await self.writer.drain()
+            return await asyncio.gather(*futures)
+
+        try:
+            return await asyncio.wait_for(replies(), timeout)
+        except asyncio.TimeoutError:
+            # The futures were cancelled; don't keep them until a reply that may never come
+            self.pending = {request_id: future for request_id, future in self.pending.items()
+                            if not future.done()}
+            raise
+
+    def _prepare(self, command):
+        if self.closed:
+            raise self.refused or ConnectionError("client is closed")
+        request_id = next(self.request_ids) & 0xFFFFFFFF
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        return future, encode_request(request_id, command, self.compression)
+
+    def _prepare_stream(self, command):
+        """Like _prepare, for a request answered by several replies"""
+        if self.closed:
+            raise self.refused or ConnectionError("client is closed")
+        request_id = next(self.request_ids) & 0xFFFFFFFF
+        self.streams[request_id] = asyncio.Queue(STREAM_QUEUE_PAGES)
+        return request_id, encode_request(request_id, command, self.compression)
+
+    # --- commands ---
+
+    async def send(self, target_id, content, ttl=None):
+        """Send a message; returns its message id"""
+        if ttl is None:
+            return _parse_message_id(await self.call(f"SEND:{target_id}:{content}"))
+        return _parse_message_id(await self.call(f"SEND_TTL:{target_id}:{ttl}:{content}"))
+
+    async def send_many(self, messages):
+        """Send (target_id, content) pairs pipelined in one write; returns their message ids"""
+        replies = await self.call_many([f"SEND:{target_id}:{content}" for target_id, content in messages])
+        return [_parse_message_id(text) for text in replies]
+
+    async def send_multi(self, target_ids, content):
+        """Send one content to many clients in one command; returns a message id per target"""
+        body = (await self.call(f"SEND_MULTI:{','.join(map(str, target_ids))}:{content}")).split(":", 1)[1]
+        return [int(item.split(":")[1]) for item in body.split(",")]
+
+    async def broadcast(self, content):
+        await self.call(f"BROADCAST:{content}")
+
+    async def join(self, group):
+        """Join a group; returns its number of members"""
+        return int(re.search(r"\((\d+) members\)", await self.call(f"JOIN:{group}")).group(1))
+
+    async def leave(self, group):
+        await self.call(f"LEAVE:{group}")
+
+    async def publish(self, group, content):
+        """Send to every member of a group; returns the message id (None if it had no other members)"""
+        return _parse_message_id(await self.call(f"PUBLISH:{group}:{content}"))
+
+    async def groups(self):
+        """{group: member count}, including the automatic "@<ip>" host groups"""
+        body = (await self.call("GROUPS")).split(":", 1)[1]
+        return {group: int(count) for group, count in (field.rsplit("=", 1) for field in body.split(",") if field)}
+
+    async def members(self, group):
+        members = (await self.call(f"MEMBERS:{group}")).rsplit(":", 1)[1]
+        return [int(client_id) for client_id in members.split(",") if client_id]
+
+    async def hello(self, dict_id=None):
+        """
+        Negotiate compression of large frames in both directions.
+
+        Returns the agreed protocol.Compression, or None if the server declined.
+        """
+        command = "HELLO:zlib" if dict_id is None else f"HELLO:zlib:{dict_id}"
+        fields = (await self.call(command)).split(":")
+        if fields[1] != "zlib":
+            self.compression = None
+        else:
+            self.compression = compression_for(int(fields[2]) if len(fields) > 2 else None)
+        return self.compression
+
+    async def ping(self):
+        """Round trip to the server, in seconds"""
+        started = time.perf_counter()
+        await self.call("PING")
+        return time.perf_counter() - started
+
+    async def identify(self, identity):
+        """Claim a stable identity; returns (and remembers) our client id"""
+        self.client_id = int((await self.call(f"IDENTIFY:{identity}")).split(":", 1)[1])
+        self.identity = identity
+        return self.client_id
+
+    async def list_clients(self):
+        clients = (await self.call("LIST")).split(":", 1)[1]
+        return [int(client_id) for client_id in clients.split(",") if client_id]
+
+    async def messages_page(self, cursor=0, limit=None, direction=None, since=None, until=None):
+        """
+        One page of our stored messages: (StoredMessage list, next cursor).
+
+        The next cursor (an opaque string) is None on the last page; pass it
+        back to read the next one.
+        """
+        reply = await self.call(_msg_list_command(cursor, limit, direction, since, until))
+        return _parse_message_list(reply.split(":", 1)[1])
+
+    async def iter_messages(self, direction=None, since=None, until=None, page_size=None):
+        """
+        Every stored message, streamed by the server page by page.
+
+        At most STREAM_QUEUE_PAGES pages wait here; beyond that the client
+        stops reading, so the server pauses the stream until we catch up.
+        Other replies on this connection wait behind the stream meanwhile.
+        """
+        command = _msg_list_command(0, page_size, direction, since, until) + ":stream"
+        request_id, frame = self._prepare_stream(command)
+        queue = self.streams[request_id]
+        self.writer.write(frame)
+        await self.writer.drain()
+        try:
+            while True:
+                text = await queue.get()
+                if text is None:
+                    raise ConnectionError("connection closed")
+                if text.startswith("MESSAGES_END:"):
+                    return
+                if text.startswith("ERROR:"):
+                    raise CommandError(text[6:])
+                if text.startswith("BUSY:"):
+                    raise BusyError(text[5:])
+                for message in _parse_message_list(text.split(":", 1)[1])[0]:
+                    yield message
+        finally:
+            # Later pages of an abandoned stream are dropped; unblock the reader
+            self.streams.pop(request_id, None)
+            while not queue.empty():
+                queue.get_nowait()
+
+    async def messages(self, direction=None, since=None, until=None):
+        """All our stored messages as a list of StoredMessage"""
+        return [message async for message in self.iter_messages(direction, since, until)]
+
+    async def delete_message(self, message_id):
+        return await self.call(f"DELETE_MSG:{message_id}")
+
+    async def delete_client(self, client_id):
+        return await self.call(f"DELETE_CLIENT:{client_id}")
+
+    async def delete_messages(self, message_ids):
+        """Delete many messages in one command; returns a deleted flag per id"""
+        body = (await self.call(f"DELETE_MSGS:{','.join(map(str, message_ids))}")).split(":", 1)[1]
+        return [item.endswith(":deleted") for item in body.split(",")]
+
+    async def delete_all(self):
+        return await self.call("DELETE_ALL")
+
+    async def stats(self):
+        body = (await self.call("MSG_STATS")).split(":", 1)[1]
+        return dict(field.split("=", 1) for field in body.split(","))
+
+    async def metrics(self):
+        body = (await self.call("METRICS")).split(":", 1)[1]
+        return dict(field.split("=", 1) for field in body.split(";") if "=" in field)
+
+    async def receive(self, timeout=None):
+        """Next message pushed by the server"""
+        return await asyncio.wait_for(self.inbox.get(), timeout)
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        if self.reader_task is not None:
+            await asyncio.gather(self.reader_task, return_exceptions=True)
+
+    # --- incoming frames ---
+
+    async def _read_loop(self):
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    break
+                decoder.feed(data)
+                for request_id, text in self._process_frames(decoder):
+                    queue = self.streams.get(request_id)
+                    if queue is not None:
+                        # Waits while the stream's consumer is behind
+                        await queue.put(text)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.closed = True
+            error = self.refused or ConnectionError("connection closed")
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self.pending.clear()
+            for queue in self.streams.values():
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    def _process_frames(self, decoder):
+        """Handle decoded frames; returns the streamed replies as (request id, text) pairs"""
+        delivered = []
+        streamed = []
+        for frame_type, payload in decoder.frames():
+            if frame_type == FRAME_REPLY:
+                request_id, body = split_request(payload)
+                if request_id in self.streams:
+                    streamed.append((request_id, body.decode('utf-8')))
+                    continue
+                future = self.pending.pop(request_id, None)
+                if future is None or future.done():
+                    continue
+                text = body.decode('utf-8')
+                if text.startswith("ERROR:"):
+                    future.set_exception(CommandError(text[6:]))
+                elif text.startswith("BUSY:"):
+                    future.set_exception(BusyError(text[5:]))
+                else:
+                    future.set_result(text)
+                continue
+
+            text = payload.decode('utf-8')
+            if text == "PING":
+                if not self.closed:
+                    self.writer.write(encode_message("PONG", True, self.compression))
+                continue
+            if text.startswith("BUSY:"):
+                # Over the server's connection cap; it closes the connection next
+                self.refused = BusyError(text[5:])
+                continue
+            message = self._parse_push(text)
+            if message is not None:
+                self.inbox.put_nowait(message)
+                if message.queued:
+                    delivered.append(str(message.message_id))
+
+        # One ACK for every queued message that arrived in this read
+        if delivered and not self.closed:
+            self.writer.write(encode_message("ACK:" + ",".join(delivered), True, self.compression))
+        return streamed
+
+    @staticmethod
+    def _parse_push(text):
+        if text.startswith("MSG:"):
+            # Format: MSG:sender_id:content
+            _, sender_id, content = text.split(":", 2)
+            return Message(int(sender_id), content, None, False)
+        if text.startswith("QUEUED:"):
+            # Format: QUEUED:msg_id:sender_id:content
+            _, message_id, sender_id, content = text.split(":", 3)
+            return Message(int(sender_id), content, int(message_id), True)
+        if text.startswith("GROUP:"):
+            # Format: GROUP:group:sender_id:content
+            _, group, sender_id, content = text.split(":", 3)
+            return Message(int(sender_id), content, None, False, group)
+        return None
+
+
+def _parse_message_id(text):
+    match = _MESSAGE_ID.search(text)
+    return int(match.group(1)) if match else None
+
+
+def _msg_list_command(cursor, limit, direction, since, until):
+    options = [direction] if direction else []
+    if since is not None:
+        options.append(f"since={since}")
+    if until is not None:
+        options.append(f"until={until}")
+    return ":".join(["MSG_LIST", str(cursor), str(limit or "")] + options)
+
+
+def _parse_message_list(body):
+    """MSG_LIST entries -> (StoredMessage list, next cursor or None)"""
+    if body == "No messages found":
+        return [], None
+    messages = []
+    cursor = None
+    for entry in body.split(";"):
+        if entry.startswith("NEXT:"):
+            cursor = entry[5:]
+            continue
+        # Format: ID:<msg_id>,<sent|received>,Client:<other_id|broadcast>,At:<unix time>
+        message_id, direction, other_id, created_at = entry.split(",")
+        other_id = other_id[7:]
+        messages.append(StoredMessage(int(message_id[3:]), direction,
+                                      int(other_id) if other_id.isdigit() else other_id,
+                                      float(created_at[3:])))
+    return messages, cursor
+
+
+class ClientPool:
+    """
+    Many AsyncClient connections driven from one event loop.
+
+    Each connection is a separate logical client to the server. acquire()
+    lends out an idle connection, so callers can spread work over the pool
+    without tracking which connections are busy.
+    """
+
+    def __init__(self, size, host=HOST, port=PORT, identities=None, connect_concurrency=100, compress=False):
+        self.size = size
+        self.host = host
+        self.port = port
+        self.identities = identities
+        self.compress = compress
+        self.connect_concurrency = connect_concurrency
+        self.clients = []
+        self.idle = asyncio.Queue()
+
+    async def start(self):
+        """
+        Open every connection, connect_concurrency at a time.
+
+        If any connection fails, the ones that did open are closed again
+        and the first error is raised.
+        """
+        limit = asyncio.Semaphore(self.connect_concurrency)
+
+        async def open_one(index):
+            identity = self.identities[index] if self.identities else None
+            client = AsyncClient(self.host, self.port, identity, self.compress)
+            async with limit:
+                try:
+                    return await client.connect()
+                except BaseException:
+                    # e.g. IDENTIFY refused after the socket was opened
+                    await client.close()
+                    raise
+
+        results = await asyncio.gather(*(open_one(i) for i in range(self.size)), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            await asyncio.gather(*(result.close() for result in results if not isinstance(result, BaseException)),
+                                 return_exceptions=True)
+            raise errors[0]
+
+        self.clients = results
+        for client in self.clients:
+            self.idle.put_nowait(client)
+        return self
+
+    def acquire(self):
+        """async with pool.acquire() as client: ... (waits for an idle connection)"""
+        return _Lease(self)
+
+    async def close(self):
+        await asyncio.gather(*(client.close() for client in self.clients))
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __iter__(self):
+        return iter(self.clients)
+
+    def __getitem__(self, index):
+        return self.clients[index]
+
+
+class _Lease:
+    def __init__(self, pool):
+        self.pool = pool
+        self.client = None
+
+    async def __aenter__(self):
+        self.client = await self.pool.idle.get()
+        return self.client
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.pool.idle.put_nowait(self.client)
+
+
+class SyncClient:
+    """
+    Blocking wrapper around AsyncClient for scripts and threads.
+
+    The client's event loop runs in a daemon thread; each method submits
+    the coroutine to it and waits up to timeout seconds for the result.
+    """
+
+    def __init__(self, host=HOST, port=PORT, identity=None, timeout=CALL_TIMEOUT, compress=False):
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.client = self._run(self._connect(host, port, identity, compress))
+
+    async def _connect(self, host, port, identity, compress):
+        return await AsyncClient(host, port, identity, compress).connect()
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(self.timeout)
+
+    @property
+    def client_id(self):
+        return self.client.client_id
+
+    def call(self, command):
+        return self._run(self.client.call(command))
+
+    def call_many(self, commands):
+        return self._run(self.client.call_many(commands))
+
+    def send(self, target_id, content, ttl=None):
+        return self._run(self.client.send(target_id, content, ttl))
+
+    def send_many(self, messages):
+        return self._run(self.client.send_many(messages))
+
+    def send_multi(self, target_ids, content):
+        return self._run(self.client.send_multi(target_ids, content))
+
+    def broadcast(self, content):
+        return self._run(self.client.broadcast(content))
+
+    def identify(self, identity):
+        return self._run(self.client.identify(identity))
+
+    def list_clients(self):
+        return self._run(self.client.list_clients())
+
+    def messages_page(self, cursor=0, limit=None, direction=None, since=None, until=None):
+        return self._run(self.client.messages_page(cursor, limit, direction, since, until))
+
+    def messages(self, direction=None, since=None, until=None):
+        return self._run(self.client.messages(direction, since, until))
+
+    def join(self, group):
+        return self._run(self.client.join(group))
+
+    def leave(self, group):
+        return self._run(self.client.leave(group))
+
+    def publish(self, group, content):
+        return self._run(self.client.publish(group, content))
+
+    def groups(self):
+        return self._run(self.client.groups())
+
+    def members(self, group):
+        return self._run(self.client.members(group))
+
+    def delete_message(self, message_id):
+        return self._run(self.client.delete_message(message_id))
+
+    def delete_client(self, client_id):
+        return self._run(self.client.delete_client(client_id))
+
+    def delete_messages(self, message_ids):
+        return self._run(self.client.delete_messages(message_ids))
+
+    def delete_all(self):
+        return self._run(self.client.delete_all())
+
+    def stats(self):
+        return self._run(self.client.stats())
+
+    def ping(self):
+        return self._run(self.client.ping())
+
+    def metrics(self):
+        return self._run(self.client.metrics())
+
+    def receive(self, timeout=None):
+        return self._run(self.client.receive(timeout))
+
+    def close(self):
+        try:
+            self._run(self.client.close())
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout=self.timeout)
+            self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
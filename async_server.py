@@ -0,0 +1,277 @@
+"""
+Event-loop server mode.
+
+Runs the same command set as server.py (SEND, BROADCAST, LIST, DELETE_*,
+MSG_STATS, MSG_LIST) but serves every connection from a single asyncio event
+loop instead of starting one thread per client. Each connection only costs a
+protocol object and its transport buffers, so tens of thousands of idle
+clients fit in one process.
+
+Usage:
+    python async_server.py
+"""
+import asyncio
+import socket
+import time
+
+import server
+from server import HOST, PORT, process_frames, register_client, unregister_client
+from metrics import metrics
+from logger import log
+from protocol import FrameDecoder, ProtocolError, encode_message
+from server_utils import (OutboundQueue, SlowConsumerError, POLICY_BLOCK, POLICY_DISCONNECT,
+                          QUEUE_HIGH_WATERMARK, QUEUE_LOW_WATERMARK, SLOW_CONSUMER_POLICY, set_keepalive)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+LISTEN_BACKLOG = 4096
+# Connections served at once by the event loop (see server.MAX_CONNECTIONS)
+MAX_CONNECTIONS = 100_000
+
+
+class TransportConnection:
+    """
+    ClientConnection counterpart that writes to an asyncio transport.
+
+    transport.write() never blocks; once the transport's buffer passes the
+    high watermark the loop pauses us and further records wait in an
+    OutboundQueue (created only then) under the slow-consumer policy.
+    Blocking a sender is impossible on the event loop, so the "block"
+    policy acts like "disconnect" here.
+    """
+
+    __slots__ = ('transport', 'client_id', 'framed', 'compression', 'limiter', 'paused', 'backlog',
+                 'drain_callbacks', 'last_seen', 'pinged', 'partial')
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.client_id = None
+        self.framed = False
+        self.compression = None
+        self.limiter = None
+        self.paused = False
+        self.backlog = None
+        self.drain_callbacks = None
+        self.last_seen = time.monotonic()
+        self.pinged = 0.0
+        self.partial = False
+        transport.set_write_buffer_limits(high=QUEUE_HIGH_WATERMARK, low=QUEUE_LOW_WATERMARK)
+
+    def send_message(self, message):
+        self.send_bytes(encode_message(message, self.framed, self.compression))
+
+    def send_bytes(self, data):
+        if metrics.enabled:
+            metrics.inc("bytes_sent_total", len(data))
+        if not self.paused:
+            self.transport.write(data)
+            return
+
+        try:
+            self._backlog().put(data)
+        except SlowConsumerError:
+            self.transport.abort()
+            raise
+
+    def send_batch(self, chunks):
+        if metrics.enabled:
+            metrics.inc("bytes_sent_total", sum(map(len, chunks)))
+        if not self.paused:
+            self.transport.writelines(chunks)
+            return
+
+        try:
+            self._backlog().put_many(chunks)
+        except SlowConsumerError:
+            self.transport.abort()
+            raise
+
+    def _backlog(self):
+        if self.backlog is None:
+            policy = SLOW_CONSUMER_POLICY
+            if policy == POLICY_BLOCK:
+                policy = POLICY_DISCONNECT
+            self.backlog = OutboundQueue(policy)
+        return self.backlog
+
+    def pending_bytes(self):
+        """Bytes buffered in the transport plus the paused backlog"""
+        queued = self.transport.get_write_buffer_size()
+        if self.backlog is not None:
+            queued += self.backlog.queued_bytes
+        return queued
+
+    def resume_when_drained(self, callback):
+        """
+        Pace a producer (e.g. a streamed reply) to the client's reading speed.
+
+        The loop cannot block, so this always returns False and calls
+        callback() later: on the next loop iteration, which lets other
+        connections run between chunks, or once the transport has drained
+        if it is paused. A closed transport never calls back.
+        """
+        if self.transport.is_closing():
+            return False
+        if self.paused:
+            if self.drain_callbacks is None:
+                self.drain_callbacks = []
+            self.drain_callbacks.append(callback)
+        else:
+            asyncio.get_running_loop().call_soon(callback)
+        return False
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        if self.backlog is not None:
+            chunks = self.backlog.get_batch_nowait()
+            self.backlog = None
+            self.transport.writelines(chunks)
+        if self.drain_callbacks is not None:
+            callbacks, self.drain_callbacks = self.drain_callbacks, None
+            for callback in callbacks:
+                callback()
+
+    def close(self, flush_timeout=1.0):
+        """Close after writing what is buffered; flush_timeout=0 drops it (dead peers)"""
+        if flush_timeout:
+            self.transport.close()
+        else:
+            self.transport.abort()
+
+
+class ClientProtocol(asyncio.BufferedProtocol):
+    """Per-connection state for the event-loop server"""
+
+    __slots__ = ('transport', 'connection', 'decoder')
+
+    def __init__(self):
+        self.transport = None
+        self.connection = None
+        # Starts small so idle connections stay cheap; grows on demand
+        self.decoder = FrameDecoder(buffer_size=4096)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        address = transport.get_extra_info('peername')
+        refusal = server.admit_connection(address, MAX_CONNECTIONS)
+        if refusal is not None:
+            transport.write(refusal)
+            transport.close()
+            return
+
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            set_keepalive(sock)
+
+        self.connection = TransportConnection(transport)
+        client_id = register_client(self.connection, address)
+        log.info("CONNECTION", "[NEW CONNECTION] Client %s connected from %s:%s | Total clients: %s",
+                 client_id, address[0], address[1], len(server.clients))
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        if metrics.enabled:
+            metrics.inc("bytes_received_total", nbytes)
+        self.connection.last_seen = time.monotonic()
+        self.decoder.advance(nbytes)
+        try:
+            if not process_frames(self.connection, self.decoder):
+                self.transport.close()
+            self.connection.partial = self.decoder.pending() > 0
+        except ProtocolError as e:
+            log.error("ERROR", "[ERROR] Client %s: %s", self.connection.client_id, e)
+            self.connection.send_message(f"ERROR:{e}")
+            self.transport.close()
+        except Exception as e:
+            log.error("ERROR", "[ERROR] Client %s: %s", self.connection.client_id, e)
+            self.transport.close()
+
+    def pause_writing(self):
+        self.connection.pause_writing()
+
+    def resume_writing(self):
+        self.connection.resume_writing()
+
+    def connection_lost(self, exc):
+        if self.connection is None:  # refused in connection_made
+            return
+        unregister_client(self.connection.client_id, self.connection)
+        log.info("CONNECTION", "[DISCONNECTED] Client %s | Remaining clients: %s",
+                 self.connection.client_id, len(server.clients))
+
+
+def raise_fd_limit():
+    """Raise the open-file soft limit to the hard limit so 10k+ sockets fit"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    log.info("SERVER", "[INFO] Open file limit: %s", soft)
+
+
+async def serve(host=HOST, port=PORT, reuse_port=False):
+    server.start_message_manager()
+    metrics.start_http_server()
+    loop = asyncio.get_running_loop()
+    listener = await loop.create_server(ClientProtocol, host, port, backlog=LISTEN_BACKLOG,
+                                        reuse_address=True, reuse_port=reuse_port)
+
+    log.info("SERVER", "[SERVER STARTED] Event loop listening on %s:%s", host, port)
+    log.info("SERVER", "[INFO] Waiting for client connections...")
+
+    reaper = asyncio.ensure_future(run_reaper())
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        reaper.cancel()
+
+
+async def run_reaper():
+    """Heartbeat/reaper passes (server.reap_idle_clients) on the event loop"""
+    loop = asyncio.get_running_loop()
+    next_prune = loop.time() + (server.PENDING_PRUNE_INTERVAL or 0)
+    while True:
+        await asyncio.sleep(server.REAP_INTERVAL)
+        try:
+            server.reap_idle_clients()
+        except Exception as e:
+            log.error("ERROR", "[ERROR] Reaper: %s", e)
+
+        if server.PENDING_PRUNE_INTERVAL is not None and loop.time() >= next_prune:
+            next_prune = loop.time() + server.PENDING_PRUNE_INTERVAL
+            try:
+                # Walks every queue, so keep it off the loop
+                await loop.run_in_executor(None, server.prune_pending_deliveries)
+            except Exception as e:
+                log.error("ERROR", "[ERROR] Pending delivery prune: %s", e)
+
+
+def main():
+    raise_fd_limit()
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        log.info("SERVER", "[SERVER] Shutting down...")
+    finally:
+        if server.message_manager is not None:
+            server.message_manager.stop()
+        log.flush()
+
+
+if __name__ == "__main__":
+    main()
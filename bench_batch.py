@@ -0,0 +1,197 @@
+"""
+Batch command benchmark: SEND_MULTI / DELETE_MSGS vs one command per item.
+
+Part 1 stores and deletes messages directly on a MessageManager, one call
+per message vs store_many()/delete_many() in batches, and reports the
+rate and the number of MessageManager lock acquisitions for each.
+
+Part 2 pushes the same work through server.process_frames() (parsing,
+dispatch, storage and delivery, no sockets): N SEND commands vs SEND_MULTI
+commands of --batch targets, and N DELETE_MSG vs DELETE_MSGS.
+
+Part 3 runs an event-loop server in a child process and times a client
+over loopback that awaits each SEND / DELETE_MSG reply in turn vs one
+SEND_MULTI / DELETE_MSGS per batch, which is where the saved round trips
+show.
+
+Usage:
+    python bench_batch.py [--messages 100000] [--batch 100] [--loopback-messages 5000] [--port 5098]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import multiprocessing
+import time
+
+import server
+from metrics import metrics
+from message_manager import MessageManager
+from protocol import FrameDecoder, encode_frame
+from bench_dispatch import NullConnection
+
+
+def quiet():
+    # Keeps MessageManager log lines out of the report
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def lock_acquisitions():
+    counters, _, _ = metrics.snapshot()
+    return counters.get(("lock_acquisitions_total", (("lock", "message_manager"),)), 0)
+
+
+def chunks(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def bench_manager(messages, batch, payload):
+    metrics.enabled = True
+    with quiet():
+        manager = MessageManager(auto_delete_interval=3600, message_ttl=3600)
+    items = [(1, recipient % 1000 + 2, payload) for recipient in range(messages)]
+
+    def timed(label, work):
+        before = lock_acquisitions()
+        started = time.perf_counter()
+        result = work()
+        elapsed = time.perf_counter() - started
+        print(f"  {label:<24} {messages / elapsed:12,.0f} msgs/s {lock_acquisitions() - before:>9,} lock acquisitions")
+        return result
+
+    print(f"[BENCH] MessageManager, {messages} messages, batches of {batch}")
+    ids = timed("store_message loop", lambda: [manager.store_message(*item) for item in items])
+    timed("delete_message loop", lambda: [manager.delete_message(message_id) for message_id in ids])
+    ids = timed("store_many", lambda: [message_id for part in chunks(items, batch)
+                                       for message_id in manager.store_many(part)])
+    timed("delete_many", lambda: [manager.delete_many(part) for part in chunks(ids, batch)])
+    manager.stop()
+    metrics.enabled = False
+
+
+def run(connection, commands, per_read=256):
+    """Push commands through process_frames, per_read frames per simulated read"""
+    frames = [encode_frame(command) for command in commands]
+    decoder = FrameDecoder()
+    started = time.perf_counter()
+    for start in range(0, len(frames), per_read):
+        decoder.feed(b"".join(frames[start:start + per_read]))
+        server.process_frames(connection, decoder)
+    return time.perf_counter() - started
+
+
+def bench_dispatch(messages, batch, payload):
+    metrics.enabled = False
+    server.start_message_manager()
+    sender = NullConnection(1)
+    server.clients[1] = sender
+    targets = list(range(2, batch + 2))
+    for target in targets:
+        server.clients[target] = NullConnection(target)
+    target_list = b",".join(str(target).encode() for target in targets)
+    rounds = messages // batch
+
+    print(f"[BENCH] process_frames, {rounds * batch} messages, batches of {batch}")
+    single = [b"SEND:%d:%s" % (target, payload) for target in targets] * rounds
+    elapsed = run(sender, single)
+    print(f"  {'SEND x' + str(batch):<24} {len(single) / elapsed:12,.0f} msgs/s")
+    ids = sorted(server.message_manager.messages)
+    elapsed = run(sender, [b"DELETE_MSG:%d" % message_id for message_id in ids])
+    print(f"  {'DELETE_MSG x' + str(batch):<24} {len(ids) / elapsed:12,.0f} msgs/s")
+
+    elapsed = run(sender, [b"SEND_MULTI:" + target_list + b":" + payload] * rounds)
+    print(f"  {'SEND_MULTI':<24} {rounds * batch / elapsed:12,.0f} msgs/s")
+    ids = sorted(server.message_manager.messages)
+    elapsed = run(sender, [b"DELETE_MSGS:" + b",".join(b"%d" % message_id for message_id in part)
+                           for part in chunks(ids, batch)])
+    print(f"  {'DELETE_MSGS':<24} {len(ids) / elapsed:12,.0f} msgs/s")
+
+    server.clients.clear()
+    server.message_manager.stop()
+
+
+def run_server(port):
+    import async_server
+    from logger import log
+
+    metrics.http_port = None
+    log.set_level("WARNING")
+    server.RATE_LIMITS = None  # the loops below would otherwise hit the write limit
+    asyncio.run(async_server.serve('127.0.0.1', port))
+
+
+async def bench_loopback(port, messages, batch, content):
+    from async_client import AsyncClient
+
+    sender = await AsyncClient(port=port).connect()
+    receivers = [await AsyncClient(port=port, identity=f"batch-{i}").connect() for i in range(min(batch, 20))]
+    targets = [receiver.client_id for receiver in receivers]
+    targets = (targets * (batch // len(targets) + 1))[:batch]
+    rounds = messages // batch
+
+    async def drain(receiver, count):
+        for _ in range(count):
+            await receiver.receive()
+
+    async def timed(label, work, count):
+        started = time.perf_counter()
+        result = await work()
+        elapsed = time.perf_counter() - started
+        print(f"  {label:<24} {count / elapsed:12,.0f} msgs/s")
+        return result
+
+    async def send_loop():
+        return [await sender.send(target, content) for _ in range(rounds) for target in targets]
+
+    async def send_multi():
+        return [message_id for _ in range(rounds) for message_id in await sender.send_multi(targets, content)]
+
+    async def delete_loop(ids):
+        return [await sender.delete_message(message_id) for message_id in ids]
+
+    async def delete_many(ids):
+        return [await sender.delete_messages(part) for part in chunks(ids, batch)]
+
+    print(f"[BENCH] Loopback, {rounds * batch} messages, batches of {batch}, {len(receivers)} receivers")
+    for label, sending, deleting in (("SEND", send_loop, delete_loop), ("SEND_MULTI", send_multi, delete_many)):
+        counts = {}
+        for target in targets:
+            counts[target] = counts.get(target, 0) + rounds
+        receiving = [asyncio.ensure_future(drain(receiver, counts[receiver.client_id])) for receiver in receivers]
+        ids = await timed(label, sending, rounds * batch)
+        await asyncio.gather(*receiving)
+        await timed("DELETE_MSG" if deleting is delete_loop else "DELETE_MSGS",
+                    lambda: deleting(ids), len(ids))
+
+    for client in receivers + [sender]:
+        await client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch command benchmark")
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--batch", type=int, default=100, help="items per SEND_MULTI / DELETE_MSGS")
+    parser.add_argument("--payload-size", type=int, default=64)
+    parser.add_argument("--loopback-messages", type=int, default=5000, help="0 skips the loopback part")
+    parser.add_argument("--port", type=int, default=5098)
+    args = parser.parse_args()
+    batch = min(args.batch, server.MAX_BATCH_SIZE)
+    payload = "x" * args.payload_size
+
+    bench_manager(args.messages, batch, payload)
+    bench_dispatch(args.messages, batch, payload.encode())
+
+    if args.loopback_messages:
+        ctx = multiprocessing.get_context("spawn")
+        server_process = ctx.Process(target=run_server, args=(args.port,), daemon=True)
+        server_process.start()
+        time.sleep(1.0)
+        try:
+            asyncio.run(bench_loopback(args.port, args.loopback_messages, batch, payload))
+        finally:
+            server_process.terminate()
+            server_process.join()
+
+
+if __name__ == "__main__":
+    main()
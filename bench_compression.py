@@ -0,0 +1,182 @@
+"""
+Compression benchmark: bandwidth saved vs CPU spent, per payload size.
+
+Part 1 encodes and decodes chat-like MSG frames in-process and reports the
+wire size and the per-frame CPU cost for:
+    - no compression
+    - zlib
+    - zlib with the built-in preset dictionary
+    - zlib with a dictionary trained on sample traffic (build_dictionary)
+
+Part 2 runs an event-loop server in a child process, connects receivers
+over loopback and broadcasts messages of each size to them, once with
+plain receivers and once with receivers that negotiated compression
+(HELLO). It reports bytes the server sent, delivery throughput and the
+CPU seconds used by the server process. All receivers live in this one
+process, so with compression the delivery rate is mostly bounded by their
+decompression, which real clients would do on their own machines.
+
+Usage:
+    python bench_compression.py [--sizes 64,256,1024,4096,16384,65536] [--receivers 20] [--messages 2000]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import time
+
+import protocol
+from protocol import FrameDecoder, Compression, build_dictionary, compression_for, encode_message
+
+WORDS = ("hey hi hello thanks ok okay sure yes no maybe tomorrow today tonight meeting call lunch "
+         "project deadline review the a to and of in is it for on that this with you we they "
+         "please let me know when where what how about can could would should will just really "
+         "great good nice sounds see later update status build test deploy server client message").split()
+
+
+def chat_payload(rng, size):
+    """A MSG frame body of about size bytes of chat-like text"""
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return f"MSG:{rng.randint(1, 999)}:" + " ".join(words)[:size]
+
+
+def bench_codec(sizes, frames):
+    rng = random.Random(1)
+    trained = build_dictionary([chat_payload(rng, 200).encode() for _ in range(2000)])
+    modes = {
+        "none": None,
+        "zlib": Compression(),
+        "zlib+dict": compression_for(protocol.DEFAULT_DICTIONARY_ID),
+        "zlib+trained": compression_for(protocol.register_dictionary(trained)),
+    }
+
+    print(f"{'size':>7} {'mode':<13} {'wire bytes':>10} {'ratio':>6} {'encode':>10} {'decode':>10}")
+    for size in sizes:
+        payloads = [chat_payload(rng, size) for _ in range(frames)]
+        for name, compression in modes.items():
+            if compression is not None:
+                # Compress every size here, so small payloads show what the threshold avoids
+                compression.threshold = 0
+            started = time.perf_counter()
+            encoded = [encode_message(payload, True, compression) for payload in payloads]
+            encode_time = time.perf_counter() - started
+
+            decoder = FrameDecoder()
+            started = time.perf_counter()
+            for data in encoded:
+                decoder.feed(data)
+                for _ in decoder.frames():
+                    pass
+            decode_time = time.perf_counter() - started
+
+            wire = sum(map(len, encoded)) / frames
+            raw = sum(len(payload.encode()) for payload in payloads) / frames + protocol.HEADER_SIZE
+            print(f"{size:>7} {name:<13} {wire:>10.0f} {raw / wire:>6.2f} "
+                  f"{encode_time / frames * 1e6:>8.1f}us {decode_time / frames * 1e6:>8.1f}us")
+        print()
+
+    for compression in modes.values():
+        if compression is not None:
+            compression.threshold = protocol.COMPRESSION_THRESHOLD
+
+
+def run_server(port):
+    import server
+    import async_server
+    from metrics import metrics
+    from logger import log
+
+    metrics.enabled = True  # read through the METRICS command below
+    metrics.http_port = None
+    log.set_level("WARNING")
+    server.PORT = port
+    server.RATE_LIMITS = None  # the broadcasts below are pipelined as fast as possible
+    asyncio.run(async_server.serve('127.0.0.1', port))
+
+
+def cpu_seconds(pid):
+    """User + system CPU time of a process (Linux /proc; None elsewhere)"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+async def bench_broadcast(port, pid, size, receivers, messages, compress):
+    from async_client import AsyncClient
+
+    clients = [await AsyncClient(port=port, compress=compress).connect() for _ in range(receivers)]
+    sender = await AsyncClient(port=port, compress=compress).connect()
+    for client in clients:
+        # Any command marks the connection as framed
+        await client.list_clients()
+
+    rng = random.Random(size)
+    payloads = [chat_payload(rng, size)[6:] for _ in range(messages)]
+
+    async def drain(client):
+        for _ in range(messages):
+            await client.receive()
+
+    before = (await sender.metrics()).get("bytes_sent_total", "0")
+    cpu_before = cpu_seconds(pid)
+    started = time.perf_counter()
+    receiving = [asyncio.ensure_future(drain(client)) for client in clients]
+    for start in range(0, messages, 100):
+        await sender.call_many([f"BROADCAST:{payload}" for payload in payloads[start:start + 100]])
+    await asyncio.gather(*receiving)
+    elapsed = time.perf_counter() - started
+    cpu_after = cpu_seconds(pid)
+    after = (await sender.metrics()).get("bytes_sent_total", "0")
+
+    for client in clients + [sender]:
+        await client.close()
+    sent = int(after) - int(before)
+    cpu = None if cpu_before is None else cpu_after - cpu_before
+    return sent, messages * receivers / elapsed, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compression bandwidth/CPU benchmark")
+    parser.add_argument("--sizes", default="64,256,1024,4096,16384,65536")
+    parser.add_argument("--frames", type=int, default=2000, help="frames per size in the codec benchmark")
+    parser.add_argument("--receivers", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=2000, help="broadcasts per size (fewer for large sizes)")
+    parser.add_argument("--port", type=int, default=5099)
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    print(f"[BENCH] Frame encode/decode, {args.frames} frames per size")
+    bench_codec(sizes, args.frames)
+
+    ctx = multiprocessing.get_context("spawn")
+    server_process = ctx.Process(target=run_server, args=(args.port,), daemon=True)
+    server_process.start()
+    time.sleep(1.0)
+    try:
+        print(f"[BENCH] Loopback broadcast to {args.receivers} receivers")
+        print(f"{'size':>7} {'mode':<6} {'server sent':>12} {'deliveries/s':>13} {'server CPU':>11}")
+        for size in sizes:
+            # Keep the volume per size roughly constant
+            messages = max(50, min(args.messages, args.messages * 1024 // size))
+            for compress in (False, True):
+                sent, rate, cpu = asyncio.run(
+                    bench_broadcast(args.port, server_process.pid, size, args.receivers, messages, compress))
+                cpu_text = "n/a" if cpu is None else f"{cpu:.2f}s"
+                print(f"{size:>7} {'zlib' if compress else 'plain':<6} {sent / 1e6:>10.2f}MB "
+                      f"{rate:>13,.0f} {cpu_text:>11}")
+    finally:
+        server_process.terminate()
+        server_process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""
+Command dispatch microbenchmark: commands per second on one core.
+
+Feeds pipelined commands through server.process_frames() exactly as a
+handler thread would after a recv(), with in-memory connections that
+discard their output, so only parsing, dispatch and command execution are
+measured (no sockets, no threads). Metrics are off unless --metrics is
+given, so the numbers reflect parsing and dispatch rather than instrumentation.
+--rate-limit runs every command through a RateLimiter whose limits are
+never reached, which shows what admission control costs per command.
+
+--baseline also runs every workload through legacy_dispatch(), the
+decode + startswith chain the COMMANDS registry replaced, interleaved with
+the registry runs, and prints both rates side by side.
+
+Usage:
+    python bench_dispatch.py [--commands 200000] [--payload-size 64] [--repeat 3] [--metrics]
+                             [--rate-limit | --baseline]
+"""
+import argparse
+import time
+
+import server
+from metrics import metrics
+from protocol import FrameDecoder, encode_frame
+from ratelimit import RateLimiter
+
+
+class NullConnection:
+    """Stands in for ClientConnection; replies are encoded and dropped"""
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.framed = True
+        self.compression = None
+        self.limiter = None
+        self.sent = 0
+
+    def send_message(self, message):
+        self.send_bytes(message.encode('utf-8'))
+
+    def send_bytes(self, data):
+        self.sent += 1
+
+    def send_batch(self, chunks):
+        self.sent += len(chunks)
+
+    def pending_bytes(self):
+        return 0
+
+
+def registry_command(name, client_id, rest):
+    """Run a command the old chain did not parse itself through its registry handler"""
+    return server.COMMANDS[name][0](client_id, rest.encode('utf-8'))
+
+
+def legacy_dispatch(client_id, payload):
+    """
+    The dispatch the COMMANDS registry replaced: decode the whole payload,
+    then walk a chain of startswith() checks in the order commands were
+    added. SEND, SEND_TTL, ACK, DELETE_MSG and DELETE_CLIENT keep their old
+    split()/int()/try parsing; the other branches call the registry handler
+    once matched, so only the lookup differs for them.
+    """
+    message = payload.decode('utf-8').strip()
+    reply = server.reply
+
+    if message.startswith("SEND:"):
+        parts = message.split(":", 2)
+        if len(parts) == 3:
+            try:
+                target_id = int(parts[1])
+                content = parts[2]
+                msg_id = server.message_manager.store_message(client_id, target_id, content)
+                if server.deliver_or_queue(client_id, target_id, msg_id, content):
+                    reply(client_id, f"SENT:Message stored (ID:{msg_id})")
+                else:
+                    reply(client_id, f"SENT:Message queued for offline Client {target_id} (ID:{msg_id})")
+            except ValueError:
+                reply(client_id, "ERROR:Invalid client ID")
+
+    elif message.startswith("SEND_TTL:"):
+        parts = message.split(":", 3)
+        if len(parts) == 4:
+            try:
+                target_id = int(parts[1])
+                ttl = float(parts[2])
+                content = parts[3]
+                if ttl <= 0:
+                    raise ValueError
+                msg_id = server.message_manager.store_message(client_id, target_id, content, ttl=ttl)
+                if server.deliver_or_queue(client_id, target_id, msg_id, content):
+                    reply(client_id, f"SENT:Message stored (ID:{msg_id}, TTL:{parts[2]}s)")
+                else:
+                    reply(client_id, f"SENT:Message queued for offline Client {target_id} (ID:{msg_id}, TTL:{parts[2]}s)")
+            except ValueError:
+                reply(client_id, "ERROR:Invalid client ID or TTL")
+
+    elif message.startswith("BROADCAST:"):
+        registry_command(b"BROADCAST", client_id, message.split(":", 1)[1])
+
+    elif message.lower() in ["quit", "exit", "disconnect"]:
+        return False
+
+    elif message.startswith("IDENTIFY:"):
+        registry_command(b"IDENTIFY", client_id, message.split(":", 1)[1])
+
+    elif message.startswith("ACK:"):
+        try:
+            message_ids = [int(mid) for mid in message.split(":", 1)[1].split(",") if mid]
+            server.pending_deliveries.ack(client_id, message_ids)
+        except ValueError:
+            reply(client_id, "ERROR:Invalid message ID")
+
+    elif message == "LIST":
+        registry_command(b"LIST", client_id, "")
+
+    elif message.startswith("DELETE_MSG:"):
+        try:
+            msg_id = int(message.split(":", 1)[1])
+            if server.message_manager.delete_message(msg_id):
+                reply(client_id, f"SUCCESS:Message {msg_id} deleted")
+            else:
+                reply(client_id, f"ERROR:Message {msg_id} not found")
+        except ValueError:
+            reply(client_id, "ERROR:Invalid message ID")
+
+    elif message.startswith("DELETE_CLIENT:"):
+        try:
+            target_id = int(message.split(":", 1)[1])
+            count = server.message_manager.delete_client_messages(target_id)
+            reply(client_id, f"SUCCESS:Deleted {count} messages for Client {target_id}")
+        except ValueError:
+            reply(client_id, "ERROR:Invalid client ID")
+
+    elif message == "DELETE_ALL":
+        registry_command(b"DELETE_ALL", client_id, "")
+
+    elif message == "MSG_STATS":
+        registry_command(b"MSG_STATS", client_id, "")
+
+    elif message == "METRICS":
+        registry_command(b"METRICS", client_id, "")
+
+    elif message == "MSG_LIST" or message.startswith("MSG_LIST:"):
+        registry_command(b"MSG_LIST", client_id, message[9:])
+
+    # Commands added after the registry, appended at the bottom as the chain would have grown
+    elif message.startswith("SEND_MULTI:"):
+        registry_command(b"SEND_MULTI", client_id, message.split(":", 1)[1])
+
+    elif message.startswith("DELETE_MSGS:"):
+        registry_command(b"DELETE_MSGS", client_id, message.split(":", 1)[1])
+
+    elif message.startswith("HELLO:"):
+        registry_command(b"HELLO", client_id, message.split(":", 1)[1])
+
+    elif message == "PING":
+        registry_command(b"PING", client_id, "")
+
+    elif message == "PONG":
+        pass
+
+    elif message.startswith("JOIN:"):
+        registry_command(b"JOIN", client_id, message.split(":", 1)[1])
+
+    elif message.startswith("LEAVE:"):
+        registry_command(b"LEAVE", client_id, message.split(":", 1)[1])
+
+    elif message.startswith("PUBLISH:"):
+        registry_command(b"PUBLISH", client_id, message.split(":", 1)[1])
+
+    elif message == "GROUPS":
+        registry_command(b"GROUPS", client_id, "")
+
+    elif message.startswith("MEMBERS:"):
+        registry_command(b"MEMBERS", client_id, message.split(":", 1)[1])
+
+    else:
+        reply(client_id, "ERROR:Unknown command")
+
+    return True
+
+
+def legacy_process_frames(connection, decoder):
+    """process_frames() for plain frames, dispatched through legacy_dispatch()"""
+    for _, payload in decoder.frames():
+        if not legacy_dispatch(connection.client_id, payload):
+            return False
+    return True
+
+
+def run(connection, commands, batch=256, process=server.process_frames):
+    """Push commands through process_frames, batch frames per simulated read"""
+    frames = [encode_frame(command) for command in commands]
+    decoder = FrameDecoder()
+    started = time.perf_counter()
+    for start in range(0, len(frames), batch):
+        decoder.feed(b"".join(frames[start:start + batch]))
+        process(connection, decoder)
+    return time.perf_counter() - started
+
+
+def best_rate(connection, commands, repeat, process):
+    best = None
+    for _ in range(repeat):
+        elapsed = run(connection, commands, process=process)
+        server.message_manager.clear_all_messages()
+        best = elapsed if best is None else min(best, elapsed)
+    return len(commands) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Command dispatch microbenchmark")
+    parser.add_argument("--commands", type=int, default=200_000)
+    parser.add_argument("--payload-size", type=int, default=64)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per workload; the best is reported")
+    parser.add_argument("--metrics", action="store_true", help="keep per-command metrics enabled")
+    parser.add_argument("--rate-limit", action="store_true", help="check every command against a RateLimiter")
+    parser.add_argument("--baseline", action="store_true",
+                        help="also run the old startswith chain and compare (no rate limiting)")
+    args = parser.parse_args()
+    if args.baseline and args.rate_limit:
+        parser.error("--baseline compares dispatch only; it cannot be combined with --rate-limit")
+
+    metrics.enabled = args.metrics
+    server.start_message_manager()
+    sender = NullConnection(1)
+    receiver = NullConnection(2)
+    if args.rate_limit:
+        unlimited = (1e12, 1e12)
+        sender.limiter = RateLimiter({name: unlimited for name in server.RATE_LIMITS})
+    server.clients[1] = sender
+    server.clients[2] = receiver
+    server.groups.join("bench", 2)
+
+    payload = b"x" * args.payload_size
+    n = args.commands
+    workloads = {
+        "SEND": [b"SEND:2:" + payload] * n,
+        "PUBLISH": [b"PUBLISH:bench:" + payload] * n,
+        "ACK": [b"ACK:1,2,3"] * n,
+        "DELETE_MSG": [b"DELETE_MSG:999999999"] * n,
+        "MSG_STATS": [b"MSG_STATS"] * n,
+        "UNKNOWN": [b"NOPE:" + payload] * n,
+        "mix": [b"SEND:2:" + payload, b"SEND:2:" + payload, b"ACK:1", b"MSG_STATS", b"DELETE_MSG:999999999"] * (n // 5),
+    }
+
+    print(f"[BENCH] {n} commands per workload, {args.payload_size}-byte payloads, best of {args.repeat}")
+    if args.baseline:
+        print(f"  {'':<11} {'registry':>12} {'baseline':>12}")
+    for name, commands in workloads.items():
+        if not args.baseline:
+            rate = best_rate(sender, commands, args.repeat, server.process_frames)
+            print(f"  {name:<11} {rate:12,.0f} cmds/s")
+            continue
+        # Alternate the two so drift (thermal, other load) hits both alike
+        registry = baseline = 0
+        for _ in range(args.repeat):
+            registry = max(registry, best_rate(sender, commands, 1, server.process_frames))
+            baseline = max(baseline, best_rate(sender, commands, 1, legacy_process_frames))
+        print(f"  {name:<11} {registry:12,.0f} {baseline:12,.0f} cmds/s  {registry / baseline:5.2f}x")
+
+    server.message_manager.stop()
+
+
+if __name__ == "__main__":
+    main()
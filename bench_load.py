@@ -0,0 +1,382 @@
+"""
+Load generator and latency benchmark built on TCPClient.
+
+Simulates the lab topology - S systems with C clients each (4 x 4 by
+default) - with one process per system, so the generator itself is not
+limited to one core. Scale it up with e.g. --systems 8 --clients 500.
+Each system multiplexes its clients' sockets with a selector and issues
+commands open-loop: arrivals follow a Poisson process at --rate commands
+per second (over all systems), whether or not earlier commands have been
+answered, and commands are picked by the weights in --mix.
+
+Latency is measured from the *scheduled* send time, so a generator or
+server that falls behind shows up as latency instead of hiding it:
+    - reply latency: command scheduled -> its reply (SENT, MESSAGES, ...)
+    - delivery latency: SEND/BROADCAST scheduled -> MSG received by the
+      target, using a timestamp embedded in the message content
+
+Timestamps come from the monotonic clock, which is shared by all
+processes on one machine; run all systems on the same host.
+
+Results can be saved as JSON and compared against an earlier run; the
+exit status is 1 when throughput or a latency percentile regressed by more
+than --tolerance.
+
+Usage:
+    python bench_load.py [--host 127.0.0.1] [--port 5000] [--systems 4] [--clients 4]
+                         [--rate 200] [--duration 10] [--drain 3]
+                         [--mix send=80,broadcast=5,msg_list=10,delete=5]
+                         [--payload-size 64] [--output run.json] [--compare baseline.json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import selectors
+import sys
+import time
+from collections import deque
+
+from async_server import raise_fd_limit
+from client import TCPClient
+from protocol import FrameDecoder
+
+OPS = ("send", "broadcast", "msg_list", "delete")
+DEFAULT_MIX = "send=80,broadcast=5,msg_list=10,delete=5"
+MARKER = "LG"  # content prefix of generated messages: LG|<op>|<scheduled ns>|<payload>
+PERCENTILES = (("p50", 0.50), ("p99", 0.99), ("p999", 0.999))
+
+
+class Stats:
+    """Counters and raw latency samples (ns) collected by one system"""
+
+    def __init__(self):
+        self.sent = dict.fromkeys(OPS, 0)
+        self.errors = dict.fromkeys(OPS, 0)
+        self.reply = {op: [] for op in OPS if op != "broadcast"}
+        self.delivery = {"send": [], "broadcast": []}
+        self.disconnects = 0
+
+
+class LoadClient(TCPClient):
+    """Headless TCPClient that records latencies instead of printing"""
+
+    def __init__(self, host, port, identity, stats):
+        super().__init__(host, port, identity, verbose=False)
+        self.decoder = FrameDecoder(buffer_size=16 * 1024)
+        self.stats = stats
+        self.awaiting = deque()              # (op, scheduled ns) per command that gets a reply
+        self.stored_ids = deque(maxlen=64)   # ids from SENT replies, deleted by DELETE_MSG
+
+    def issue(self, op, scheduled, payload, targets):
+        """Send one command of the given kind"""
+        if op == "send":
+            self.send_command(f"SEND:{random.choice(targets)}:{MARKER}|s|{scheduled}|{payload}")
+        elif op == "broadcast":
+            self.send_command(f"BROADCAST:{MARKER}|b|{scheduled}|{payload}")
+        elif op == "msg_list":
+            self.send_command("MSG_LIST")
+        elif self.stored_ids:
+            self.send_command(f"DELETE_MSG:{self.stored_ids.popleft()}")
+        else:
+            self.send_command(f"DELETE_CLIENT:{self.client_id}")
+
+        # BROADCAST is the only command without a reply
+        if op != "broadcast":
+            self.awaiting.append((op, scheduled))
+        self.stats.sent[op] += 1
+
+    def handle_server_message(self, message):
+        now = time.monotonic_ns()
+
+        if message == "PING":
+            self.send_command("PONG")
+            return None
+
+        if message.startswith("MSG:"):
+            content = message.split(":", 2)[2]
+            if content.startswith(MARKER + "|"):
+                _, kind, scheduled, _ = content.split("|", 3)
+                self.stats.delivery["send" if kind == "s" else "broadcast"].append(now - int(scheduled))
+            return None
+
+        if message.startswith("IDENTIFIED:"):
+            self.client_id = int(message.split(":", 1)[1])
+            return None
+
+        if message.startswith("QUEUED:"):
+            return message.split(":", 2)[1]
+
+        # Anything else answers the oldest outstanding command
+        if self.awaiting:
+            op, scheduled = self.awaiting.popleft()
+            self.stats.reply[op].append(now - scheduled)
+            if message.startswith("ERROR:"):
+                self.stats.errors[op] += 1
+            elif op == "send" and "(ID:" in message:
+                self.stored_ids.append(int(message.split("(ID:", 1)[1].split(",")[0].rstrip(")")))
+        return None
+
+    def read(self):
+        """Read what the socket has and handle it; False once the server closed"""
+        nbytes = self.client_socket.recv_into(self.decoder.get_buffer())
+        if not nbytes:
+            return False
+        self.decoder.advance(nbytes)
+        self.process_frames(self.decoder)
+        return True
+
+
+def parse_mix(text):
+    weights = {}
+    for item in text.split(","):
+        op, _, weight = item.partition("=")
+        op = op.strip().lower()
+        if op not in OPS:
+            raise argparse.ArgumentTypeError(f"Unknown command in mix: {op} (expected one of {', '.join(OPS)})")
+        weights[op] = float(weight)
+    if sum(weights.values()) <= 0:
+        raise argparse.ArgumentTypeError("Mix weights must add up to more than 0")
+    return weights
+
+
+def run_system(index, args, ids_queue, control, results):
+    """One simulated system: connect its clients, then generate load"""
+    random.seed(args.seed * 1000 + index)
+    stats = Stats()
+    selector = selectors.DefaultSelector()
+
+    def pump(timeout):
+        for key, _ in selector.select(timeout):
+            client = key.data
+            try:
+                alive = client.read()
+            except OSError:
+                alive = False
+            if not alive:
+                selector.unregister(client.client_socket)
+                stats.disconnects += 1
+
+    clients = []
+    for n in range(args.clients):
+        client = LoadClient(args.host, args.port, f"lg-{args.run_id}-{index}-{n}", stats)
+        if not client.connect_to_server():
+            ids_queue.put((index, None))
+            return
+        selector.register(client.client_socket, selectors.EVENT_READ, client)
+        clients.append(client)
+
+    # Learn our ids from the IDENTIFIED replies
+    deadline = time.monotonic() + 30
+    while any(client.client_id is None for client in clients) and time.monotonic() < deadline:
+        pump(0.1)
+    ids_queue.put((index, [client.client_id for client in clients]))
+
+    targets, start_ns = control.recv()
+    if not targets:
+        return
+
+    ops = list(args.mix)
+    weights = [args.mix[op] for op in ops]
+    payload = "x" * args.payload_size
+    rate = args.rate / args.systems
+    end_ns = start_ns + int(args.duration * 1e9)
+    drain_ns = end_ns + int(args.drain * 1e9)
+    next_ns = start_ns + int(random.expovariate(rate) * 1e9)
+
+    while True:
+        now = time.monotonic_ns()
+        while next_ns <= now and next_ns < end_ns:
+            op = random.choices(ops, weights)[0]
+            try:
+                random.choice(clients).issue(op, next_ns, payload, targets)
+            except OSError:
+                stats.errors[op] += 1
+            next_ns += int(random.expovariate(rate) * 1e9)
+
+        if now >= drain_ns or (now >= end_ns and not any(client.awaiting for client in clients)):
+            break
+        wake = next_ns if next_ns < end_ns else drain_ns
+        pump(max(0, wake - now) / 1e9)
+
+    # Deliveries still in flight for a moment after the last reply
+    settle = time.monotonic() + min(args.drain, 0.5)
+    while time.monotonic() < settle:
+        pump(0.05)
+
+    for client in clients:
+        client.close()
+    results.put((index, stats.__dict__))
+
+
+def percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return None
+    rank = max(0, min(len(sorted_samples) - 1, int(fraction * len(sorted_samples) + 0.5) - 1))
+    return sorted_samples[rank] / 1e6
+
+
+def summarize(samples):
+    samples.sort()
+    summary = {"count": len(samples)}
+    for name, fraction in PERCENTILES:
+        summary[name + "_ms"] = percentile(samples, fraction)
+    summary["mean_ms"] = sum(samples) / len(samples) / 1e6 if samples else None
+    return summary
+
+
+def build_report(args, per_system):
+    sent = dict.fromkeys(OPS, 0)
+    errors = dict.fromkeys(OPS, 0)
+    reply = {op: [] for op in OPS if op != "broadcast"}
+    delivery = {"send": [], "broadcast": []}
+    disconnects = 0
+    for stats in per_system:
+        disconnects += stats["disconnects"]
+        for op in OPS:
+            sent[op] += stats["sent"][op]
+            errors[op] += stats["errors"][op]
+        for op, samples in stats["reply"].items():
+            reply[op].extend(samples)
+        for op, samples in stats["delivery"].items():
+            delivery[op].extend(samples)
+
+    total_sent = sum(sent.values())
+    total_delivered = sum(len(samples) for samples in delivery.values())
+    return {
+        "config": {
+            "host": args.host, "port": args.port, "systems": args.systems, "clients_per_system": args.clients,
+            "rate": args.rate, "duration": args.duration, "mix": args.mix, "payload_size": args.payload_size,
+            "seed": args.seed,
+        },
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "throughput": {
+            "commands_per_sec": total_sent / args.duration,
+            "deliveries_per_sec": total_delivered / args.duration,
+        },
+        "commands": {
+            op: dict(sent=sent[op], errors=errors[op], **(summarize(reply[op]) if op in reply else {}))
+            for op in OPS
+        },
+        "delivery": {op: summarize(samples) for op, samples in delivery.items()},
+        "disconnects": disconnects,
+    }
+
+
+def print_report(report):
+    def fmt(value):
+        return "-" if value is None else f"{value:.2f}"
+
+    throughput = report["throughput"]
+    print(f"\n[LOAD] {throughput['commands_per_sec']:,.0f} commands/s, "
+          f"{throughput['deliveries_per_sec']:,.0f} deliveries/s, {report['disconnects']} disconnects")
+    print(f"  {'':<20} {'count':>9} {'errors':>7} {'p50 ms':>9} {'p99 ms':>9} {'p999 ms':>9}")
+    for op, row in report["commands"].items():
+        print(f"  {op + ' reply':<20} {row['sent']:>9} {row['errors']:>7} "
+              f"{fmt(row.get('p50_ms')):>9} {fmt(row.get('p99_ms')):>9} {fmt(row.get('p999_ms')):>9}")
+    for op, row in report["delivery"].items():
+        print(f"  {op + ' delivery':<20} {row['count']:>9} {'':>7} "
+              f"{fmt(row['p50_ms']):>9} {fmt(row['p99_ms']):>9} {fmt(row['p999_ms']):>9}")
+
+
+def compare(report, baseline, tolerance):
+    """Print changes against a baseline run; returns the regressed metrics"""
+    rows = [("commands/s", baseline["throughput"]["commands_per_sec"],
+             report["throughput"]["commands_per_sec"], True)]
+    for section, label in (("commands", "reply"), ("delivery", "delivery")):
+        for op, row in report[section].items():
+            for name, _ in PERCENTILES:
+                key = name + "_ms"
+                old = baseline.get(section, {}).get(op, {}).get(key)
+                if row.get(key) is not None and old:
+                    rows.append((f"{op} {label} {name}", old, row[key], False))
+
+    regressions = []
+    print(f"\n[COMPARE] tolerance {tolerance:.0%}")
+    for name, old, new, higher_is_better in rows:
+        change = (new - old) / old if old else 0.0
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > tolerance:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"  {name:<28} {old:>12.2f} -> {new:>12.2f} ({change:+.1%}){flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Open-loop load generator and latency benchmark")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--systems", type=int, default=4, help="simulated machines (processes)")
+    parser.add_argument("--clients", type=int, default=4, help="clients per system")
+    parser.add_argument("--rate", type=float, default=200, help="commands per second over all systems")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load")
+    parser.add_argument("--drain", type=float, default=3, help="seconds to wait for late replies")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument("--payload-size", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed relative regression")
+    args = parser.parse_args()
+    args.run_id = os.urandom(4).hex()
+
+    raise_fd_limit()
+    ids_queue = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    controls = []
+    systems = []
+    for index in range(args.systems):
+        parent_end, child_end = multiprocessing.Pipe()
+        controls.append(parent_end)
+        systems.append(multiprocessing.Process(target=run_system,
+                                               args=(index, args, ids_queue, child_end, results)))
+    for system in systems:
+        system.start()
+
+    targets = []
+    failed = False
+    for _ in range(args.systems):
+        index, ids = ids_queue.get()
+        if ids is None or None in ids:
+            failed = True
+        else:
+            targets.extend(ids)
+    if failed:
+        print("[LOAD] Some clients could not connect or identify; is the server running?")
+        for control in controls:
+            control.send(([], 0))
+        for system in systems:
+            system.join()
+        sys.exit(2)
+
+    print(f"[LOAD] {len(targets)} clients on {args.systems} systems, "
+          f"{args.rate:g} commands/s for {args.duration:g}s, mix {args.mix}")
+    start_ns = time.monotonic_ns() + 200_000_000
+    for control in controls:
+        control.send((targets, start_ns))
+
+    timeout = args.duration + args.drain + 60
+    per_system = [results.get(timeout=timeout)[1] for _ in systems]
+    for system in systems:
+        system.join()
+
+    report = build_report(args, per_system)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n[LOAD] Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
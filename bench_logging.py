@@ -0,0 +1,108 @@
+"""
+Logging benchmark: cost of a log call on the caller's thread.
+
+Several threads each emit records the way the server does on every routed
+message, and the time per call is reported for:
+    - print() to stdout (the old behaviour)
+    - a record filtered out by the level (the production setting for DEBUG records)
+    - a record queued for the background writer
+    - a record queued with 1-in-100 sampling
+Then MessageManager store throughput is compared at LOG_LEVEL INFO and DEBUG.
+stdout goes to /dev/null so the terminal does not dominate the numbers.
+
+Usage:
+    python bench_logging.py [--records 200000] [--threads 4]
+"""
+import argparse
+import contextlib
+import os
+import threading
+import time
+
+import logger
+from logger import log, Logger
+from message_manager import MessageManager
+
+
+def run_threads(threads, per_thread, emit):
+    def worker(t):
+        for i in range(per_thread):
+            emit(t, i)
+
+    workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    started = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return time.perf_counter() - started
+
+
+def bench_calls(records, threads, devnull):
+    per_thread = records // threads
+    total = per_thread * threads
+    results = {}
+
+    with contextlib.redirect_stdout(devnull):
+        results["print()"] = run_threads(threads, per_thread,
+                                         lambda t, i: print(f"[ROUTED] Client {t} → Client {i} (MsgID:{i})"))
+
+    filtered = Logger("INFO", stream=devnull)
+    results["filtered by level"] = run_threads(
+        threads, per_thread,
+        lambda t, i: filtered.debug("ROUTED", "[ROUTED] Client %s → Client %s (MsgID:%s)", t, i, i))
+    filtered.stop()
+
+    saved_limit = logger.DEFAULT_RATE_LIMIT
+    logger.DEFAULT_RATE_LIMIT = None
+    queued = Logger("DEBUG", stream=devnull)
+    results["queued"] = run_threads(
+        threads, per_thread,
+        lambda t, i: queued.debug("ROUTED", "[ROUTED] Client %s → Client %s (MsgID:%s)", t, i, i))
+    queued.stop()
+
+    logger.SAMPLE_EVERY["ROUTED"] = 100
+    sampled = Logger("DEBUG", stream=devnull)
+    results["sampled 1/100"] = run_threads(
+        threads, per_thread,
+        lambda t, i: sampled.debug("ROUTED", "[ROUTED] Client %s → Client %s (MsgID:%s)", t, i, i))
+    sampled.stop()
+    del logger.SAMPLE_EVERY["ROUTED"]
+    logger.DEFAULT_RATE_LIMIT = saved_limit
+
+    for name, elapsed in results.items():
+        print(f"  {name:<18} {elapsed / total * 1e9:10,.0f} ns/call")
+
+
+def bench_stores(messages, threads, level, devnull):
+    log.set_level(level)
+    log.stream = devnull
+    manager = MessageManager(auto_delete_interval=3600, message_ttl=3600)
+    per_thread = messages // threads
+    elapsed = run_threads(threads, per_thread,
+                          lambda t, i: manager.store_message(t + 1, i % 64 + 1, "payload"))
+    manager.stop()
+    log.flush()
+    log.stream = None
+    log.set_level(logger.LOG_LEVEL)
+    return per_thread * threads / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Logging cost benchmark")
+    parser.add_argument("--records", type=int, default=200_000)
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+
+    with open(os.devnull, "w") as devnull:
+        print(f"[BENCH] {args.records} log calls from {args.threads} threads")
+        bench_calls(args.records, args.threads, devnull)
+
+        print(f"\n[BENCH] {args.records} MessageManager stores from {args.threads} threads")
+        for level in ("INFO", "DEBUG"):
+            rate = bench_stores(args.records, args.threads, level, devnull)
+            print(f"  LOG_LEVEL={level:<6} {rate:12,.0f} msgs/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Memory benchmark: bytes per stored message for each MessageManager backend.
+
+Fills a MessageManager with N messages (default 1M) and reports the memory
+allocated while doing so, as measured by tracemalloc. Two figures are
+reported per backend: the message store alone (`manager.messages`) and the
+whole manager, which adds the per-client indexes and the expiry queue.
+
+Usage:
+    python bench_memory.py [--messages 1000000] [--payload-size 32] [--clients 16]
+"""
+import argparse
+import contextlib
+import gc
+import io
+import tracemalloc
+
+from compact_store import CompactMessageStore
+from message_manager import Message, MessageManager
+
+
+def measure_store(storage, messages, payload_size, clients):
+    """Memory used by the message store alone"""
+    payload = "x" * payload_size
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    store = CompactMessageStore(Message.from_row) if storage == "compact" else {}
+    for i in range(messages):
+        store[i + 1] = Message(i % clients + 1, (i + 1) % clients + 1, payload, i + 1)
+
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used
+
+
+def measure_manager(storage, messages, payload_size, clients):
+    """Memory used by a whole MessageManager"""
+    payload = "x" * payload_size
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    # store_message prints one line per message; keep that out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        manager = MessageManager(auto_delete_interval=3600, message_ttl=3600, storage=storage)
+        for i in range(messages):
+            manager.store_message(i % clients + 1, (i + 1) % clients + 1, payload)
+
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        manager.stop()
+    return used
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bytes per message for each storage backend")
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--payload-size", type=int, default=32)
+    parser.add_argument("--clients", type=int, default=16)
+    args = parser.parse_args()
+
+    print(f"[BENCH] {args.messages} messages, {args.payload_size}-byte payloads, {args.clients} clients")
+    payload = args.messages * args.payload_size
+    print(f"  payload bytes alone: {payload / 2**20:.1f} MiB ({args.payload_size} bytes/message)")
+
+    for label, measure in (("message store", measure_store), ("whole manager", measure_manager)):
+        print(f"\n  {label}:")
+        results = {}
+        for storage in ("dict", "compact"):
+            used = measure(storage, args.messages, args.payload_size, args.clients)
+            results[storage] = used
+            print(f"    {storage:<8} {used / 2**20:9.1f} MiB  {used / args.messages:7.1f} bytes/message"
+                  f"  ({used / payload:.1f}x payload)")
+        print(f"    compact uses {results['compact'] / results['dict']:.0%} of dict")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Mesh benchmark: cross-node message latency and forwarding throughput.
+
+Starts --nodes mesh nodes (mesh.py) in child processes on localhost, each
+with its own client port, joined through node 0. All clients live in this
+process, so a message's one-way latency is measured on one clock: the
+sender puts time.perf_counter_ns() in the content and the receiver
+subtracts it on arrival.
+
+    1. one message at a time: node 0 to a client on node 0 (no mesh hop),
+       then to a client on node 1 (one hop), as latency percentiles
+    2. BROADCAST from node 0, latency to a client on every node
+    3. a pipelined burst from node 0 to receivers on node 1, giving the
+       delivery rate, the latency under load, and the average number of
+       messages per link frame (from node 0's METRICS)
+
+Usage:
+    python bench_mesh.py [--nodes 3] [--mode async|thread] [--samples 2000] [--burst 20000] [--port 5200]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import time
+
+import mesh
+
+
+def run_node(node_id, port, mesh_port, peers, mode):
+    import server
+    from metrics import metrics
+    from logger import log
+
+    metrics.enabled = True  # read through the METRICS command below
+    metrics.http_port = None
+    log.set_level("WARNING")
+    server.RATE_LIMITS = None  # the burst below is pipelined as fast as possible
+    mesh.run_node(node_id, "127.0.0.1", port, mesh_port, peers, mode)
+
+
+def percentiles(samples_ns):
+    samples = sorted(samples_ns)
+
+    def at(q):
+        return samples[min(len(samples) - 1, int(q * len(samples)))] / 1000
+
+    return f"p50 {at(0.5):8.0f}us  p90 {at(0.9):8.0f}us  p99 {at(0.99):8.0f}us  max {samples[-1] / 1000:8.0f}us"
+
+
+async def one_at_a_time(sender, receiver, samples):
+    latencies = []
+    for _ in range(samples):
+        sending = asyncio.ensure_future(sender.send(receiver.client_id, str(time.perf_counter_ns())))
+        message = await receiver.receive(5)
+        latencies.append(time.perf_counter_ns() - int(message.content))
+        await sending
+    return latencies
+
+
+async def broadcast_latency(sender, receivers, samples):
+    latencies = {receiver.client_id: [] for receiver in receivers}
+    for _ in range(samples):
+        await sender.broadcast(str(time.perf_counter_ns()))
+        for receiver in receivers:
+            message = await receiver.receive(5)
+            latencies[receiver.client_id].append(time.perf_counter_ns() - int(message.content))
+    return latencies
+
+
+async def burst(sender, receivers, count):
+    latencies = []
+
+    async def drain(receiver, expected):
+        for _ in range(expected):
+            message = await receiver.receive(30)
+            latencies.append(time.perf_counter_ns() - int(message.content))
+
+    per_receiver = count // len(receivers)
+    before = await sender.metrics()
+    started = time.perf_counter()
+    receiving = [asyncio.ensure_future(drain(receiver, per_receiver)) for receiver in receivers]
+    for _ in range(per_receiver // 100):
+        await sender.call_many([f"SEND:{receiver.client_id}:{time.perf_counter_ns()}"
+                                for receiver in receivers for _ in range(100)])
+    await asyncio.gather(*receiving)
+    elapsed = time.perf_counter() - started
+    after = await sender.metrics()
+
+    def delta(name):
+        return int(after.get(name, 0)) - int(before.get(name, 0))
+
+    frames = delta("mesh_frames_sent_total")
+    return len(latencies) / elapsed, latencies, delta("mesh_messages_sent_total") / frames if frames else 0
+
+
+async def bench(ports, samples, burst_size):
+    from async_client import AsyncClient
+
+    sender = await AsyncClient(port=ports[0], identity="bench-sender").connect()
+    receivers = [await AsyncClient(port=port, identity=f"bench-{node}").connect() for node, port in enumerate(ports)]
+    # Wait until node 0 knows the clients of every node
+    expected = {client.client_id for client in receivers}
+    while not expected <= set(await sender.list_clients()):
+        await asyncio.sleep(0.1)
+
+    print(f"[BENCH] One message at a time, {samples} samples")
+    print(f"  {'same node':<18} {percentiles(await one_at_a_time(sender, receivers[0], samples))}")
+    print(f"  {'node 0 -> node 1':<18} {percentiles(await one_at_a_time(sender, receivers[1], samples))}")
+
+    print(f"[BENCH] BROADCAST from node 0, {samples // 4} samples")
+    per_receiver = await broadcast_latency(sender, receivers, samples // 4)
+    for node, receiver in enumerate(receivers):
+        print(f"  {'to node ' + str(node):<18} {percentiles(per_receiver[receiver.client_id])}")
+
+    remote = [await AsyncClient(port=ports[1], identity=f"bench-remote-{i}").connect() for i in range(10)]
+    while not {client.client_id for client in remote} <= set(await sender.list_clients()):
+        await asyncio.sleep(0.1)
+    rate, latencies, batch = await burst(sender, remote, burst_size)
+    print(f"[BENCH] Burst of {burst_size} messages, node 0 -> 10 receivers on node 1")
+    print(f"  {rate:,.0f} msgs/s, {batch:.1f} messages per link frame")
+    print(f"  {'latency':<18} {percentiles(latencies)}")
+
+    for client in [sender] + receivers + remote:
+        await client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mesh latency benchmark")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--mode", choices=("thread", "async"), default="async")
+    parser.add_argument("--samples", type=int, default=2000)
+    parser.add_argument("--burst", type=int, default=20000)
+    parser.add_argument("--port", type=int, default=5200, help="client port of node 0; node i uses port + i")
+    args = parser.parse_args()
+
+    ports = [args.port + node for node in range(max(2, args.nodes))]
+    mesh_ports = [port + mesh.MESH_PORT_OFFSET for port in ports]
+    ctx = multiprocessing.get_context("spawn")
+    nodes = []
+    for node, (port, mesh_port) in enumerate(zip(ports, mesh_ports)):
+        peers = [("127.0.0.1", mesh_ports[0])] if node else []
+        nodes.append(ctx.Process(target=run_node, args=(node, port, mesh_port, peers, args.mode), daemon=True))
+        nodes[-1].start()
+    time.sleep(1.5)
+    try:
+        asyncio.run(bench(ports, args.samples, args.burst))
+    finally:
+        for process in nodes:
+            process.terminate()
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
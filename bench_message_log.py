@@ -0,0 +1,95 @@
+"""
+Message log benchmark: write throughput per durability level and recovery time.
+
+For each durability level ("none", "batch", "sync") several threads store
+messages through a MessageManager backed by a MessageLog, and the store rate
+is reported. Then a log holding N messages (default 1M) is recovered from
+disk and the recovery time is reported.
+
+Usage:
+    python bench_message_log.py [--messages 200000] [--threads 8]
+                                [--recover-messages 1000000] [--dir /tmp/cn-bench-log]
+"""
+import argparse
+import contextlib
+import io
+import shutil
+import threading
+import time
+
+from message_manager import MessageManager
+
+
+def quiet():
+    # Keeps MessageManager log lines out of the report
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def bench_writes(directory, durability, messages, threads, payload):
+    shutil.rmtree(directory, ignore_errors=True)
+    with quiet():
+        manager = MessageManager(auto_delete_interval=3600, message_ttl=3600,
+                                 log_dir=directory, durability=durability)
+
+    per_thread = messages // threads
+
+    def worker(sender_id):
+        for i in range(per_thread):
+            manager.store_message(sender_id, (sender_id + i) % threads + 1, payload)
+
+    workers = [threading.Thread(target=worker, args=(t + 1,)) for t in range(threads)]
+    with quiet():
+        started = time.perf_counter()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        manager.log.flush()
+        elapsed = time.perf_counter() - started
+        manager.stop()
+
+    return per_thread * threads / elapsed
+
+
+def bench_recovery(directory, messages, payload):
+    shutil.rmtree(directory, ignore_errors=True)
+    with quiet():
+        manager = MessageManager(auto_delete_interval=3600, message_ttl=3600,
+                                 log_dir=directory, durability="none")
+        for i in range(messages):
+            manager.store_message(i % 16 + 1, (i + 1) % 16 + 1, payload)
+        manager.stop()
+
+        started = time.perf_counter()
+        recovered = MessageManager(auto_delete_interval=3600, message_ttl=3600,
+                                   log_dir=directory, durability="none")
+        elapsed = time.perf_counter() - started
+        count = len(recovered.messages)
+        recovered.stop()
+
+    return count, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Message log throughput and recovery benchmark")
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--payload-size", type=int, default=64)
+    parser.add_argument("--recover-messages", type=int, default=1_000_000)
+    parser.add_argument("--dir", default="/tmp/cn-bench-log")
+    args = parser.parse_args()
+
+    payload = "x" * args.payload_size
+    print(f"[BENCH] {args.messages} stores from {args.threads} threads, {args.payload_size}-byte payloads")
+    for durability in ("none", "batch", "sync"):
+        rate = bench_writes(args.dir, durability, args.messages, args.threads, payload)
+        print(f"  {durability:<6} {rate:12,.0f} msgs/s")
+
+    count, elapsed = bench_recovery(args.dir, args.recover_messages, payload)
+    print(f"\n[BENCH] Recovered {count:,} messages in {elapsed:.2f}s ({count / elapsed:,.0f} msgs/s)")
+
+    shutil.rmtree(args.dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,62 +2,67 @@ import socket
 import threading
 import sys
 import signal
+from protocol import FrameDecoder, encode_message
 
 class TCPClient:
-    def __init__(self, host='127.0.0.1', port=5000):
+    def __init__(self, host='127.0.0.1', port=5000, identity=None, verbose=True):
         self.host = host
         self.port = port
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.running = True
         self.client_id = None
+        # Stable name sent with IDENTIFY so messages sent while we were
+        # offline are delivered when we reconnect
+        self.identity = identity
+        self.verbose = verbose
+        # The receiver thread answers PING and sends ACKs while the input
+        # thread sends commands; one sendall() at a time keeps frames whole
+        self.send_lock = threading.Lock()
         
     def connect_to_server(self):
         """Connect to the server"""
         try:
             self.client_socket.connect((self.host, self.port))
-            print(f"✓ Connected to server at {self.host}:{self.port}")
+            if self.verbose:
+                print(f"✓ Connected to server at {self.host}:{self.port}")
+            if self.identity:
+                self.send_command(f"IDENTIFY:{self.identity}")
             return True
         except Exception as e:
             print(f"✗ Failed to connect to server: {e}")
             return False
     
+    def send_command(self, message):
+        """Send one command to the server as a single frame"""
+        data = encode_message(message)
+        with self.send_lock:
+            self.client_socket.sendall(data)
+
+    def send_pipelined(self, messages):
+        """
+        Send many commands in one write without waiting for replies.
+
+        Each command is its own frame, so the server splits them apart again
+        and answers them in order.
+        """
+        data = b"".join(encode_message(m) for m in messages)
+        with self.send_lock:
+            self.client_socket.sendall(data)
+
     def receive_messages(self):
         """Continuously listen for messages from the server"""
+        decoder = FrameDecoder()
         while self.running:
             try:
-                message = self.client_socket.recv(1024).decode('utf-8')
+                nbytes = self.client_socket.recv_into(decoder.get_buffer())
                 
-                if not message:
+                if not nbytes:
                     print("\n✗ Server disconnected")
                     self.running = False
                     break
                 
-                # Parse different message types from server
-                if message.startswith("MSG:"):
-                    # Format: MSG:sender_id:content
-                    parts = message.split(":", 2)
-                    if len(parts) == 3:
-                        sender_id = parts[1]
-                        content = parts[2]
-                        print(f"\n[Client {sender_id} → You]: {content}")
-                        print("You: ", end="", flush=True)
-                        
-                elif message.startswith("CLIENTS:"):
-                    # Format: CLIENTS:1,2,3,4
-                    client_list = message.split(":", 1)[1]
-                    print(f"\n[Server]: Connected clients: {client_list}")
-                    print("You: ", end="", flush=True)
-                    
-                elif message.startswith("ERROR:"):
-                    # Format: ERROR:message
-                    error_msg = message.split(":", 1)[1]
-                    print(f"\n[Server Error]: {error_msg}")
-                    print("You: ", end="", flush=True)
-                    
-                else:
-                    # Unknown message format
-                    print(f"\n[Server]: {message}")
-                    print("You: ", end="", flush=True)
+                decoder.advance(nbytes)
+                self.process_frames(decoder)
                     
             except (ConnectionResetError, BrokenPipeError, OSError):
                 if self.running:
@@ -70,6 +75,79 @@ class TCPClient:
                     self.running = False
                 break
     
+    def process_frames(self, decoder):
+        """Handle every complete message buffered in the decoder"""
+        delivered = []
+        for frame_type, payload in decoder.frames():
+            message_id = self.handle_server_message(payload.decode('utf-8'))
+            if message_id is not None:
+                delivered.append(message_id)
+
+        # One ACK for every queued message that arrived in this read
+        if delivered:
+            self.send_command("ACK:" + ",".join(delivered))
+
+    def handle_server_message(self, message):
+        """
+        Display one message received from the server.
+
+        Returns the message id of a QUEUED delivery, which must be ACKed.
+        """
+        # Parse different message types from server
+        if message == "PING":
+            # Server heartbeat; answering keeps an idle session from being reaped
+            self.send_command("PONG")
+
+        elif message.startswith("QUEUED:"):
+            # Format: QUEUED:msg_id:sender_id:content (sent while we were offline)
+            parts = message.split(":", 3)
+            if len(parts) == 4:
+                message_id, sender_id, content = parts[1], parts[2], parts[3]
+                print(f"\n[Client {sender_id} → You (while offline)]: {content}")
+                print("You: ", end="", flush=True)
+                return message_id
+
+        elif message.startswith("IDENTIFIED:"):
+            # Format: IDENTIFIED:client_id
+            self.client_id = message.split(":", 1)[1]
+            print(f"\n[Server]: Identified as Client {self.client_id}")
+            print("You: ", end="", flush=True)
+
+        elif message.startswith("MSG:"):
+            # Format: MSG:sender_id:content
+            parts = message.split(":", 2)
+            if len(parts) == 3:
+                sender_id = parts[1]
+                content = parts[2]
+                print(f"\n[Client {sender_id} → You]: {content}")
+                print("You: ", end="", flush=True)
+                
+        elif message.startswith("GROUP:"):
+            # Format: GROUP:group:sender_id:content
+            parts = message.split(":", 3)
+            if len(parts) == 4:
+                group, sender_id, content = parts[1], parts[2], parts[3]
+                print(f"\n[Client {sender_id} → {group}]: {content}")
+                print("You: ", end="", flush=True)
+
+        elif message.startswith("CLIENTS:"):
+            # Format: CLIENTS:1,2,3,4
+            client_list = message.split(":", 1)[1]
+            print(f"\n[Server]: Connected clients: {client_list}")
+            print("You: ", end="", flush=True)
+            
+        elif message.startswith("ERROR:"):
+            # Format: ERROR:message
+            error_msg = message.split(":", 1)[1]
+            print(f"\n[Server Error]: {error_msg}")
+            print("You: ", end="", flush=True)
+            
+        else:
+            # Unknown message format
+            print(f"\n[Server]: {message}")
+            print("You: ", end="", flush=True)
+        return None
+    
     def send_messages(self):
         """Take user input and send to server"""
         print("\n" + "="*60)
@@ -77,6 +155,10 @@ class TCPClient:
         print("  SEND:<client_id>:<message>    - Send to specific client")
         print("  BROADCAST:<message>            - Send to all clients")
         print("  LIST                           - Get list of connected clients")
+        print("  JOIN:<group> / LEAVE:<group>   - Join or leave a group")
+        print("  PUBLISH:<group>:<message>      - Send to every member of a group")
+        print("  GROUPS / MEMBERS:<group>       - List groups (@<ip> = everyone on that host)")
+        print("  IDENTIFY:<name>                - Claim a stable id and get queued messages")
         print("  quit/exit                      - Disconnect")
         print("  Ctrl+C                         - Force disconnect")
         print("="*60 + "\n")
@@ -91,7 +173,7 @@ class TCPClient:
                     break
                 
                 if message.strip():  # Only send non-empty messages
-                    self.client_socket.send(message.encode('utf-8'))
+                    self.send_command(message)
                     
             except KeyboardInterrupt:
                 # Handle Ctrl+C gracefully
@@ -159,7 +241,8 @@ class TCPClient:
         
         try:
             self.client_socket.close()
-            print("✓ Disconnected from server")
+            if self.verbose:
+                print("✓ Disconnected from server")
         except:
             pass
 
@@ -168,6 +251,8 @@ def main():
     # Server configuration
     HOST = '127.0.0.1'  # Replace with server's LAN IP (e.g., 192.168.x.x)
     PORT = 5000         # Must match server port
+    # Optional stable identity: python client.py <name>
+    IDENTITY = sys.argv[1] if len(sys.argv) > 1 else None
     
     print("="*60)
     print("TCP CLIENT - Multi-Client Chat System")
@@ -175,7 +260,7 @@ def main():
     
     try:
         # Create and start client
-        client = TCPClient(HOST, PORT)
+        client = TCPClient(HOST, PORT, IDENTITY)
         client.start()
     except KeyboardInterrupt:
         print("\n\n[Interrupted] Exiting...")
@@ -0,0 +1,562 @@
+"""
+Multi-process cluster mode.
+
+A single CPython process parses and routes on one core at a time, so this
+mode starts N worker processes that all accept on the same port through
+SO_REUSEPORT. The kernel spreads new connections across the workers and
+each worker owns the connections it accepted, running the threaded server
+for them. LIST, MSG_LIST, MSG_STATS, DELETE_*, IDENTIFY and pending
+deliveries wait for answers from the other workers; on a handler thread
+that only holds up the client that asked, whereas on an event loop it
+would stall every connection of the worker.
+
+Workers are joined by a routing fabric: every worker listens on a Unix
+domain socket in a private run directory and keeps one connection to each
+other worker. Fabric messages are pickled tuples sent as FRAME_CLUSTER
+frames, queued per peer and written by a writer thread with vectored
+sendmsg(), so bursts of forwarded traffic go out in few system calls.
+
+Partitioning (N = number of workers, w = worker index):
+    - client and message ids are counter * N + w, so they never collide
+      and a message id names the worker that stores it
+    - a message is stored by its sender's worker; MSG_LIST, DELETE_* and
+      MSG_STATS read every worker (ClusterMessageManager)
+    - pending deliveries for an offline client live on worker client_id % N
+    - an identity is owned by worker crc32(identity) % N
+    - every worker keeps a table of which worker holds each remote client,
+      updated by online/offline announcements, so SEND and BROADCAST reach
+      the target's worker in one hop
+
+Usage:
+    python cluster.py [--workers N] [--port 5000]
+"""
+import argparse
+import heapq
+import itertools
+import multiprocessing
+import os
+import pickle
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+import server
+from message_manager import merge_pages
+from metrics import metrics
+from logger import log
+from protocol import FrameDecoder, ProtocolError, FRAME_CLUSTER, encode_frame
+from server_utils import ClientConnection, POLICY_BLOCK, broadcast, get_client_list, send_to_client
+
+CALL_TIMEOUT = 5.0       # seconds to wait for a peer's answer
+CONNECT_TIMEOUT = 10.0   # seconds to wait for the other workers to come up
+SHUTDOWN_TIMEOUT = 5.0    # seconds all workers together get to exit before being killed
+# Fabric links must not drop messages: writers block when a peer falls behind
+FABRIC_HIGH_WATERMARK = 16 * 1024 * 1024
+FABRIC_LOW_WATERMARK = 4 * 1024 * 1024
+
+
+class ClusterError(Exception):
+    """Raised when a peer worker cannot be reached or fails a request"""
+
+
+class Fabric:
+    """
+    One worker's end of the routing fabric.
+
+    Requests to other workers ("calls") are answered by their rpc_* methods
+    on the fabric reader thread, never on a client handler thread, so a
+    worker blocked waiting for an answer can always answer others.
+    One-way messages are handled by the matching on_* method.
+    """
+
+    def __init__(self, index, num_workers, run_dir, local_manager, local_pending):
+        self.index = index
+        self.num_workers = num_workers
+        self.run_dir = run_dir
+        self.local_manager = local_manager
+        self.local_pending = local_pending
+        self.peers = {}       # worker index -> ClientConnection to that worker
+        self.locations = {}   # client_id -> worker index, for clients of other workers
+        self.identities = {}  # identity -> stable client id, for identities owned here
+        self.calls = {}       # call id -> Future waiting for the answer
+        self.call_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.listener = None
+
+    # --- setup ---
+
+    def start(self):
+        """Listen for the other workers and connect to each of them"""
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self._socket_path(self.index))
+        self.listener.listen(self.num_workers)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        for peer in range(self.num_workers):
+            if peer == self.index:
+                continue
+            while True:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.connect(self._socket_path(peer))
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    sock.close()
+                    if time.monotonic() > deadline:
+                        raise ClusterError(f"Worker {peer} did not come up")
+                    time.sleep(0.05)
+            connection = ClientConnection(sock, POLICY_BLOCK, FABRIC_HIGH_WATERMARK, FABRIC_LOW_WATERMARK)
+            connection.framed = True
+            self.peers[peer] = connection
+
+        log.info("CLUSTER", "[CLUSTER] Worker %s connected to %s peers", self.index, len(self.peers))
+
+    def _socket_path(self, index):
+        return os.path.join(self.run_dir, f"worker-{index}.sock")
+
+    def _accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._reader, args=(sock,), daemon=True).start()
+
+    def _reader(self, sock):
+        """Fabric reader thread: handles everything one peer sends us"""
+        decoder = FrameDecoder()
+        try:
+            while True:
+                nbytes = sock.recv_into(decoder.get_buffer())
+                if not nbytes:
+                    break
+                decoder.advance(nbytes)
+                for frame_type, payload in decoder.frames():
+                    if frame_type == FRAME_CLUSTER:
+                        self._handle(pickle.loads(payload))
+        except (OSError, ProtocolError) as e:
+            log.error("CLUSTER", "[CLUSTER] Fabric link failed: %s", e)
+        finally:
+            sock.close()
+
+    # --- messaging ---
+
+    def send(self, worker, *message):
+        data = encode_frame(pickle.dumps(message, pickle.HIGHEST_PROTOCOL), FRAME_CLUSTER)
+        self.peers[worker].send_bytes(data)
+
+    def _announce(self, *message):
+        data = encode_frame(pickle.dumps(message, pickle.HIGHEST_PROTOCOL), FRAME_CLUSTER)
+        for connection in self.peers.values():
+            connection.send_bytes(data)
+
+    def _handle(self, message):
+        kind = message[0]
+        if kind == "reply":
+            _, call_id, result, error = message
+            with self.lock:
+                future = self.calls.pop(call_id, None)
+            if future is not None:
+                if error is not None:
+                    future.set_exception(ClusterError(error))
+                else:
+                    future.set_result(result)
+
+        elif kind == "call":
+            _, call_id, origin, method, args = message
+            try:
+                result, error = getattr(self, "rpc_" + method)(*args), None
+            except Exception as e:
+                result, error = None, f"{method} failed on worker {self.index}: {e}"
+            try:
+                self.send(origin, "reply", call_id, result, error)
+            except ProtocolError as e:
+                self.send(origin, "reply", call_id, None, str(e))
+
+        else:
+            getattr(self, "on_" + kind)(*message[1:])
+
+    def _start_call(self, worker, method, args):
+        future = Future()
+        with self.lock:
+            call_id = next(self.call_ids)
+            self.calls[call_id] = future
+        self.send(worker, "call", call_id, self.index, method, args)
+        return call_id, future
+
+    def _result(self, worker, call_id, future):
+        try:
+            return future.result(timeout=CALL_TIMEOUT)
+        except FutureTimeout:
+            with self.lock:
+                self.calls.pop(call_id, None)
+            raise ClusterError(f"Worker {worker} did not answer")
+
+    def call(self, worker, method, *args):
+        """Run rpc_<method> on one worker and return its result"""
+        if worker == self.index:
+            return getattr(self, "rpc_" + method)(*args)
+        call_id, future = self._start_call(worker, method, args)
+        return self._result(worker, call_id, future)
+
+    def call_all(self, method, *args):
+        """Run rpc_<method> on every worker in parallel; results in worker order"""
+        pending = {peer: self._start_call(peer, method, args) for peer in self.peers}
+        results = []
+        for worker in range(self.num_workers):
+            if worker == self.index:
+                results.append(getattr(self, "rpc_" + method)(*args))
+            else:
+                results.append(self._result(worker, *pending[worker]))
+        return results
+
+    # --- client directory ---
+
+    def client_online(self, client_id):
+        self._announce("online", client_id, self.index)
+
+    def client_offline(self, client_id):
+        self._announce("offline", client_id, self.index)
+
+    def on_online(self, client_id, worker):
+        with self.lock:
+            self.locations[client_id] = worker
+
+    def on_offline(self, client_id, worker):
+        with self.lock:
+            # An id that moved (IDENTIFY) may already be online elsewhere
+            if self.locations.get(client_id) != worker:
+                return
+            del self.locations[client_id]
+        server.groups.leave_all(client_id)
+
+    def client_ids(self):
+        """Connected client ids from the local directory (no round trip)"""
+        with self.lock:
+            remote = list(self.locations)
+        return sorted(get_client_list(server.clients, server.clients_lock) + remote)
+
+    def list_clients(self):
+        """Connected client ids as reported by every worker right now"""
+        return sorted(itertools.chain.from_iterable(self.call_all("clients")))
+
+    def rpc_clients(self):
+        return get_client_list(server.clients, server.clients_lock)
+
+    # --- routing ---
+
+    def route(self, sender_id, target_id, msg_id, content):
+        """Forward a message to the worker holding target_id; False if it is offline"""
+        with self.lock:
+            worker = self.locations.get(target_id)
+        if worker is None:
+            return False
+        self.send(worker, "deliver", sender_id, target_id, msg_id, content)
+        return True
+
+    def on_deliver(self, sender_id, target_id, msg_id, content):
+        if not send_to_client(server.clients, server.clients_lock, target_id, f"MSG:{sender_id}:{content}"):
+            # Went offline while the message was in flight
+            server.pending_deliveries.add(target_id, msg_id)
+
+    def multicast(self, recipient_ids, text):
+        """Deliver text to the recipients held by other workers, one message per worker"""
+        per_worker = {}
+        with self.lock:
+            for client_id in recipient_ids:
+                worker = self.locations.get(client_id)
+                if worker is not None:
+                    per_worker.setdefault(worker, []).append(client_id)
+        for worker, client_ids in per_worker.items():
+            self.send(worker, "multicast", client_ids, text)
+
+    def on_multicast(self, client_ids, text):
+        broadcast(server.clients, server.clients_lock, text, None, client_ids)
+
+    def broadcast(self, sender_id, content):
+        """Fan a broadcast out to the clients of every other worker"""
+        self._announce("broadcast", sender_id, content)
+
+    def on_broadcast(self, sender_id, content):
+        broadcast(server.clients, server.clients_lock, f"MSG:{sender_id}:{content}", sender_id)
+
+    # --- groups (every worker keeps the memberships of all clients) ---
+
+    def group_join(self, group, client_id):
+        self._announce("group_join", group, client_id)
+
+    def group_leave(self, group, client_id):
+        self._announce("group_leave", group, client_id)
+
+    def on_group_join(self, group, client_id):
+        server.groups.join(group, client_id)
+
+    def on_group_leave(self, group, client_id):
+        server.groups.leave(group, client_id)
+
+    def on_group_move(self, old_id, new_id):
+        server.groups.move(old_id, new_id)
+
+    # --- identities ---
+
+    def identify_client(self, client_id, identity):
+        """Cluster version of server.identify_client()"""
+        with server.clients_lock:
+            current = server.client_identities.get(client_id)
+        if current is not None:
+            return client_id if current == identity else None
+
+        owner = zlib.crc32(identity.encode('utf-8')) % self.num_workers
+        stable_id = self.call(owner, "claim", identity, client_id)
+        if stable_id is None:
+            return None
+
+        with server.clients_lock:
+            if stable_id != client_id:
+                if stable_id in server.clients:
+                    return None
+                connection = server.clients.pop(client_id)
+                connection.client_id = stable_id
+                server.clients[stable_id] = connection
+            server.client_identities[stable_id] = identity
+
+        if stable_id != client_id:
+            # Announced before "offline", which would drop the old id's memberships
+            server.groups.move(client_id, stable_id)
+            self._announce("group_move", client_id, stable_id)
+            self.client_offline(client_id)
+            self.client_online(stable_id)
+        return stable_id
+
+    def rpc_claim(self, identity, client_id):
+        """Stable id for an identity owned here, or None while it is connected"""
+        with self.lock:
+            stable_id = self.identities.get(identity)
+            if stable_id is None:
+                self.identities[identity] = client_id
+                return client_id
+            online = stable_id in self.locations
+        with server.clients_lock:
+            online = online or stable_id in server.clients
+        return None if online else stable_id
+
+    # --- storage and pending deliveries ---
+
+    def rpc_manager(self, method, *args):
+        return getattr(self.local_manager, method)(*args)
+
+    def rpc_pending(self, method, *args):
+        return getattr(self.local_pending, method)(*args)
+
+    def on_pending_add(self, client_id, message_id):
+        self.local_pending.add(client_id, message_id)
+
+
+class ClusterMessageManager:
+    """
+    MessageManager interface over the storage of every worker.
+
+    Messages are stored locally (in the sender's worker); reads and deletes
+    go to the worker named by the message id, or to all workers.
+    """
+
+    def __init__(self, local, fabric):
+        self.local = local
+        self.fabric = fabric
+        self.num_workers = fabric.num_workers
+
+    def store_message(self, sender_id, recipient_id, content, ttl=None):
+        return self.local.store_message(sender_id, recipient_id, content, ttl)
+
+    def store_broadcast(self, sender_id, recipient_ids, content, ttl=None):
+        return self.local.store_broadcast(sender_id, recipient_ids, content, ttl)
+
+    def store_many(self, messages, ttl=None):
+        return self.local.store_many(messages, ttl)
+
+    def get_message(self, message_id):
+        return self.fabric.call(message_id % self.num_workers, "manager", "get_message", message_id)
+
+    def get_messages(self, message_ids):
+        """Get several messages by ID, one request per worker involved"""
+        by_worker = {}
+        for position, message_id in enumerate(message_ids):
+            by_worker.setdefault(message_id % self.num_workers, []).append(position)
+
+        result = [None] * len(message_ids)
+        for worker, positions in by_worker.items():
+            found = self.fabric.call(worker, "manager", "get_messages", [message_ids[p] for p in positions])
+            for position, msg in zip(positions, found):
+                result[position] = msg
+        return result
+
+    def get_client_messages(self, client_id, direction=None):
+        per_worker = self.fabric.call_all("manager", "get_client_messages", client_id, direction)
+        return list(heapq.merge(*per_worker, key=lambda msg: (msg.created_at, msg.message_id)))
+
+    def get_client_messages_page(self, client_id, cursor=(), limit=100, direction=None,
+                                 since=None, until=None):
+        pages = self.fabric.call_all("manager", "get_client_messages_page",
+                                     client_id, cursor, limit, direction, since, until)
+        return merge_pages(pages, limit)
+
+    def next_cursor(self, cursor, messages):
+        # Every worker partitions ids the same way, so the local manager knows the layout
+        return self.local.next_cursor(cursor, messages)
+
+    def get_all_messages(self):
+        return list(itertools.chain.from_iterable(self.fabric.call_all("manager", "get_all_messages")))
+
+    def delete_message(self, message_id):
+        return self.fabric.call(message_id % self.num_workers, "manager", "delete_message", message_id)
+
+    def delete_many(self, message_ids):
+        """Delete several messages by ID, one request per worker involved"""
+        by_worker = {}
+        for position, message_id in enumerate(message_ids):
+            by_worker.setdefault(message_id % self.num_workers, []).append(position)
+
+        result = [False] * len(message_ids)
+        for worker, positions in by_worker.items():
+            deleted = self.fabric.call(worker, "manager", "delete_many", [message_ids[p] for p in positions])
+            for position, flag in zip(positions, deleted):
+                result[position] = flag
+        return result
+
+    def delete_client_messages(self, client_id):
+        return sum(self.fabric.call_all("manager", "delete_client_messages", client_id))
+
+    def clear_all_messages(self):
+        return sum(self.fabric.call_all("manager", "clear_all_messages"))
+
+    def get_client_ids(self):
+        client_ids = set()
+        for ids in self.fabric.call_all("manager", "get_client_ids"):
+            client_ids |= ids
+        return client_ids
+
+    def get_stats(self):
+        per_worker = self.fabric.call_all("manager", "get_stats")
+        stats = dict(per_worker[0])
+        stats['total_messages'] = sum(s['total_messages'] for s in per_worker)
+        stats['total_clients_with_messages'] = len(self.get_client_ids())
+        stats['workers'] = self.num_workers
+        return stats
+
+    def stop(self):
+        self.local.stop()
+
+
+class ClusterPendingDeliveries:
+    """PendingDeliveries interface; a client's queue lives on worker client_id % N"""
+
+    def __init__(self, local, fabric):
+        self.local = local
+        self.fabric = fabric
+
+    def _home(self, client_id):
+        return client_id % self.fabric.num_workers
+
+    def add(self, client_id, message_id):
+        home = self._home(client_id)
+        if home == self.fabric.index:
+            self.local.add(client_id, message_id)
+        else:
+            self.fabric.send(home, "pending_add", client_id, message_id)
+
+    def get(self, client_id):
+        return self.fabric.call(self._home(client_id), "pending", "get", client_id)
+
+    def count(self, client_id):
+        return self.fabric.call(self._home(client_id), "pending", "count", client_id)
+
+    def ack(self, client_id, message_ids):
+        return self.fabric.call(self._home(client_id), "pending", "ack", client_id, message_ids)
+
+    def total(self):
+        return sum(self.fabric.call_all("pending", "total"))
+
+    def prune(self, get_messages):
+        # Each worker prunes the queues it is home to
+        return self.local.prune(get_messages)
+
+
+def run_worker(index, num_workers, run_dir, host, port):
+    """Worker process entry point"""
+    # SIGTERM from the parent shuts down like Ctrl-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    log_dir = None
+    if server.MESSAGE_LOG_DIR:
+        log_dir = os.path.join(server.MESSAGE_LOG_DIR, f"worker-{index}")
+    local_manager = server.start_message_manager(id_offset=index, id_stride=num_workers, log_dir=log_dir)
+
+    fabric = Fabric(index, num_workers, run_dir, local_manager, server.pending_deliveries)
+    # Each worker exposes its own metrics, on consecutive ports
+    local_pending = server.pending_deliveries
+    if metrics.http_port is not None:
+        metrics.http_port += index
+    metrics.gauge("messages_stored", lambda: local_manager.get_stats()['total_messages'],
+                  "Messages held by this worker")
+    metrics.gauge("pending_deliveries", local_pending.total, "Messages this worker queued for offline clients")
+    server.client_id_offset = index
+    server.client_id_stride = num_workers
+    server.message_manager = ClusterMessageManager(local_manager, fabric)
+    server.pending_deliveries = ClusterPendingDeliveries(server.pending_deliveries, fabric)
+    server.cluster = fabric
+    server.HOST, server.PORT = host, port
+
+    # Handlers block on fabric calls, so workers always run the threaded server
+    fabric.start()
+    server.main(reuse_port=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the chat server as several worker processes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default=server.HOST)
+    parser.add_argument("--port", type=int, default=server.PORT)
+    args = parser.parse_args()
+
+    run_dir = tempfile.mkdtemp(prefix="cn-cluster-")
+    workers = [
+        multiprocessing.Process(target=run_worker, name=f"worker-{index}",
+                                args=(index, args.workers, run_dir, args.host, args.port))
+        for index in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    log.info("CLUSTER", "[CLUSTER] %s workers sharing %s:%s", args.workers, args.host, args.port)
+
+    def stop_workers(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop_workers)
+
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # On Ctrl-C the workers got the same SIGINT and shut down on their own
+        log.info("CLUSTER", "[CLUSTER] Shutting down...")
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for worker in workers:
+            worker.join(timeout=max(0, deadline - time.monotonic()))
+        for worker in workers:
+            if worker.is_alive():
+                worker.kill()
+                worker.join()
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
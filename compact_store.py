@@ -0,0 +1,210 @@
+"""
+Compact columnar storage backend for MessageManager.
+
+Instead of one Python object per message (instance, attribute slots, boxed
+ints/floats and a str), message metadata lives in preallocated typed
+`array` columns and payload bytes are appended to one shared arena
+buffer. A stored message costs ~48 bytes of metadata plus its UTF-8
+payload; Message objects are only built when a row is read.
+
+Rows are appended in message-id order, so a lookup is a binary search over
+the id column. Deleted rows become tombstones; the dead prefix left behind
+by expiry (which mostly removes the oldest rows first) is trimmed with a
+single memmove, and a full compaction runs once tombstones outnumber the
+live rows.
+
+Broadcast recipient sets do not fit a fixed-width column; they are kept in
+a side dict keyed by message id, which only holds broadcast rows.
+"""
+from array import array
+from bisect import bisect_left
+
+DELETED = -1        # length column marker for a tombstoned row
+TRIM_THRESHOLD = 1024  # dead rows at the head before they are trimmed
+
+
+class CompactMessageStore:
+    """
+    Dict-like message_id -> Message mapping backed by typed columns.
+
+    Supports the subset of the dict interface MessageManager uses. Message ids
+    must be stored in increasing order. Reads return a fresh Message built from
+    the row, so callers never hold references into the columns.
+    """
+
+    def __init__(self, row_factory):
+        """
+        Args:
+            row_factory: callable(message_id, sender_id, recipient_id, content,
+                created_at, expires_at, recipients) returning a Message
+        """
+        self.row_factory = row_factory
+        self.ids = array('q')
+        self.senders = array('q')
+        self.recipients = array('q')
+        self.created = array('d')   # monotonic creation time
+        self.expires = array('d')   # monotonic deadline
+        self.offsets = array('q')   # logical arena offset of the payload
+        self.lengths = array('i')   # payload length, DELETED for tombstones
+        self.arena = bytearray()
+        self.arena_base = 0         # logical offset of arena[0]
+        self.recipient_sets = {}    # message_id -> recipient set (broadcasts only)
+        self.live = 0
+        self.dead = 0
+        self.dead_prefix = 0        # rows at the head known to be dead
+
+    # --- dict interface used by MessageManager ---
+
+    def __setitem__(self, message_id, msg):
+        if self.ids and message_id <= self.ids[-1]:
+            raise ValueError(f"Message ids must increase (got {message_id} after {self.ids[-1]})")
+
+        payload = msg.content.encode('utf-8')
+        self.ids.append(message_id)
+        self.senders.append(msg.sender_id)
+        self.recipients.append(msg.recipient_id)
+        self.created.append(msg.created_at)
+        self.expires.append(msg.expires_at)
+        self.offsets.append(self.arena_base + len(self.arena))
+        self.lengths.append(len(payload))
+        self.arena += payload
+        if msg.recipients is not None:
+            self.recipient_sets[message_id] = msg.recipients
+        self.live += 1
+
+    def __getitem__(self, message_id):
+        row = self._find(message_id)
+        if row < 0:
+            raise KeyError(message_id)
+        return self._load(row)
+
+    def get(self, message_id, default=None):
+        row = self._find(message_id)
+        if row < 0:
+            return default
+        return self._load(row)
+
+    def __contains__(self, message_id):
+        return self._find(message_id) >= 0
+
+    def __delitem__(self, message_id):
+        row = self._find(message_id)
+        if row < 0:
+            raise KeyError(message_id)
+        self.lengths[row] = DELETED
+        self.recipient_sets.pop(message_id, None)
+        self.live -= 1
+        self.dead += 1
+        self._maybe_compact()
+
+    def __len__(self):
+        return self.live
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self):
+        lengths = self.lengths
+        for row, message_id in enumerate(self.ids):
+            if lengths[row] != DELETED:
+                yield message_id
+
+    def values(self):
+        lengths = self.lengths
+        for row in range(len(self.ids)):
+            if lengths[row] != DELETED:
+                yield self._load(row)
+
+    def items(self):
+        for msg in self.values():
+            yield msg.message_id, msg
+
+    def clear(self):
+        for column in (self.ids, self.senders, self.recipients, self.created,
+                       self.expires, self.offsets, self.lengths):
+            del column[:]
+        self.arena = bytearray()
+        self.arena_base = 0
+        self.recipient_sets.clear()
+        self.live = self.dead = self.dead_prefix = 0
+
+    # --- internals ---
+
+    def _find(self, message_id):
+        row = bisect_left(self.ids, message_id)
+        if row < len(self.ids) and self.ids[row] == message_id and self.lengths[row] != DELETED:
+            return row
+        return -1
+
+    def _load(self, row):
+        start = self.offsets[row] - self.arena_base
+        content = self.arena[start:start + self.lengths[row]].decode('utf-8')
+        message_id = self.ids[row]
+        # The set itself is shared, so the manager can shrink it in place
+        return self.row_factory(message_id, self.senders[row], self.recipients[row],
+                                content, self.created[row], self.expires[row],
+                                self.recipient_sets.get(message_id))
+
+    def _columns(self):
+        return (self.ids, self.senders, self.recipients, self.created,
+                self.expires, self.offsets, self.lengths)
+
+    def _maybe_compact(self):
+        if self.live == 0:
+            self.clear()
+            return
+
+        # Rows before dead_prefix are already known to be dead
+        lengths = self.lengths
+        rows = len(lengths)
+        prefix = self.dead_prefix
+        while prefix < rows and lengths[prefix] == DELETED:
+            prefix += 1
+        self.dead_prefix = prefix
+
+        if prefix >= TRIM_THRESHOLD and prefix * 4 >= rows:
+            self._trim_prefix(prefix)
+        elif self.dead > self.live and self.dead >= TRIM_THRESHOLD:
+            self._compact()
+
+    def _trim_prefix(self, count):
+        """Drop `count` dead rows from the head of every column"""
+        for column in self._columns():
+            del column[:count]
+        # Rows are in arena order, so everything before the first live
+        # payload is garbage
+        cut = self.offsets[0] - self.arena_base
+        del self.arena[:cut]
+        self.arena_base += cut
+        self.dead -= count
+        self.dead_prefix = 0
+
+    def _compact(self):
+        """Rewrite every column and the arena without tombstones"""
+        keep = [row for row, length in enumerate(self.lengths) if length != DELETED]
+        arena = self.arena
+        base = self.arena_base
+
+        new_arena = bytearray()
+        new_offsets = array('q')
+        for row in keep:
+            start = self.offsets[row] - base
+            new_offsets.append(len(new_arena))
+            new_arena += arena[start:start + self.lengths[row]]
+
+        self.ids = array('q', [self.ids[row] for row in keep])
+        self.senders = array('q', [self.senders[row] for row in keep])
+        self.recipients = array('q', [self.recipients[row] for row in keep])
+        self.created = array('d', [self.created[row] for row in keep])
+        self.expires = array('d', [self.expires[row] for row in keep])
+        self.lengths = array('i', [self.lengths[row] for row in keep])
+        self.offsets = new_offsets
+        self.arena = new_arena
+        self.arena_base = 0
+        self.dead = 0
+        self.dead_prefix = 0
+
+    def memory_usage(self):
+        """Bytes allocated by the columns and the payload arena"""
+        columns = sum(column.buffer_info()[1] * column.itemsize for column in self._columns())
+        return columns + len(self.arena)
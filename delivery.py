@@ -0,0 +1,100 @@
+"""
+Store-and-forward delivery for recipients that are offline.
+
+When a SEND targets a client that is not connected, the message id is added
+to that client's pending queue. The message itself stays in MessageManager,
+so pending entries cost a dict slot each. Ids whose message has expired or
+been deleted are dropped when the backlog is flushed, and by prune(), which
+the server's reaper runs every PENDING_PRUNE_INTERVAL seconds. Both the
+queue of each client and the number of queues are capped, so clients that
+never return cannot grow it without bound. Once the client reconnects and identifies
+itself, its backlog is flushed in large batches and each item stays pending
+until the client acknowledges it with ACK, so nothing is lost if the
+connection drops mid-flush (delivery is at-least-once).
+"""
+import threading
+
+MAX_PENDING_PER_CLIENT = 10000
+MAX_PENDING_CLIENTS = 100000
+PRUNE_BATCH_SIZE = 512
+
+
+class PendingDeliveries:
+    """Per-recipient queues of message ids waiting for delivery"""
+
+    def __init__(self, max_per_client=MAX_PENDING_PER_CLIENT, max_clients=MAX_PENDING_CLIENTS):
+        self.pending = {}  # client_id -> {message_id: None}, oldest first; queues oldest first too
+        self.max_per_client = max_per_client
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+
+    def add(self, client_id, message_id):
+        """Queue a message for an offline recipient"""
+        with self.lock:
+            queue = self.pending.get(client_id)
+            if queue is None:
+                if len(self.pending) >= self.max_clients:
+                    # Drop the queue that has been waiting longest
+                    del self.pending[next(iter(self.pending))]
+                queue = self.pending[client_id] = {}
+            queue[message_id] = None
+            if len(queue) > self.max_per_client:
+                # Drop the oldest entry to bound memory for clients that never return
+                del queue[next(iter(queue))]
+
+    def get(self, client_id):
+        """Message ids waiting for a client, oldest first (not removed until acked)"""
+        with self.lock:
+            return list(self.pending.get(client_id, ()))
+
+    def count(self, client_id):
+        with self.lock:
+            return len(self.pending.get(client_id, ()))
+
+    def ack(self, client_id, message_ids):
+        """Remove acknowledged (or no longer stored) ids; returns how many were pending"""
+        removed = 0
+        with self.lock:
+            queue = self.pending.get(client_id)
+            if queue is None:
+                return 0
+            for message_id in message_ids:
+                if queue.pop(message_id, 0) is None:
+                    removed += 1
+            if not queue:
+                del self.pending[client_id]
+        return removed
+
+    def total(self):
+        with self.lock:
+            return sum(len(queue) for queue in self.pending.values())
+
+    def prune(self, get_messages, batch_size=PRUNE_BATCH_SIZE):
+        """
+        Drop ids whose message is no longer stored (expired or deleted).
+
+        get_messages(ids) returns one message or None per id, like
+        MessageManager.get_messages(); it is called in batches without this
+        lock held. Returns how many ids were dropped.
+        """
+        with self.lock:
+            client_ids = list(self.pending)
+
+        removed = 0
+        batch = []
+        for client_id in client_ids:
+            batch.extend((client_id, message_id) for message_id in self.get(client_id))
+            while len(batch) >= batch_size:
+                removed += self._drop_gone(get_messages, batch[:batch_size])
+                del batch[:batch_size]
+        if batch:
+            removed += self._drop_gone(get_messages, batch)
+        return removed
+
+    def _drop_gone(self, get_messages, batch):
+        messages = get_messages([message_id for _, message_id in batch])
+        gone = {}
+        for (client_id, message_id), msg in zip(batch, messages):
+            if msg is None:
+                gone.setdefault(client_id, []).append(message_id)
+        return sum(self.ack(client_id, message_ids) for client_id, message_ids in gone.items())
@@ -0,0 +1,110 @@
+"""
+Named groups (channels) of clients for multicast.
+
+A client joins and leaves groups with JOIN/LEAVE, and every connection is
+also put in the group of the host it connects from ("@<ip>"), so all the
+clients of one machine can be reached with a single PUBLISH. The index
+maps each group to its members and each client to its groups, so a
+publish looks its recipients up in one step and a disconnect leaves all
+its groups at once. Memberships last as long as the connection.
+
+Publishing reads a cached tuple of a group's members, rebuilt only after
+the membership changed, so a busy group costs no copying per message.
+"""
+import re
+import threading
+
+HOST_GROUP_PREFIX = "@"
+MAX_GROUPS_PER_CLIENT = 100
+GROUP_NAME = re.compile(r"[A-Za-z0-9_.\-@]{1,64}")
+
+
+def valid_group_name(name):
+    return GROUP_NAME.fullmatch(name) is not None
+
+
+def host_group(host):
+    """The automatic group for clients connecting from host (an IP address)"""
+    return HOST_GROUP_PREFIX + host.replace(":", "-")
+
+
+class GroupIndex:
+    """Subscription index: group -> member client ids, client id -> groups"""
+
+    def __init__(self, max_per_client=MAX_GROUPS_PER_CLIENT):
+        self.members = {}    # group -> {client_id: None}, in join order
+        self.groups = {}     # client_id -> set of groups
+        self.snapshots = {}  # group -> tuple of members, dropped when the group changes
+        self.max_per_client = max_per_client
+        self.lock = threading.Lock()
+
+    def join(self, group, client_id):
+        """Add a member; returns the group's size, or None if the client is in too many groups"""
+        with self.lock:
+            joined = self.groups.setdefault(client_id, set())
+            if group not in joined:
+                if len(joined) >= self.max_per_client:
+                    return None
+                joined.add(group)
+                self.members.setdefault(group, {})[client_id] = None
+                self.snapshots.pop(group, None)
+            return len(self.members[group])
+
+    def leave(self, group, client_id):
+        """Remove a member; False if it was not in the group"""
+        with self.lock:
+            joined = self.groups.get(client_id)
+            if joined is None or group not in joined:
+                return False
+            joined.discard(group)
+            if not joined:
+                del self.groups[client_id]
+            self._remove(group, client_id)
+            return True
+
+    def leave_all(self, client_id):
+        """Remove a client from every group (it disconnected); returns the groups it was in"""
+        with self.lock:
+            joined = self.groups.pop(client_id, ())
+            for group in joined:
+                self._remove(group, client_id)
+        return joined
+
+    def move(self, old_id, new_id):
+        """Hand a client's memberships to its new id (IDENTIFY)"""
+        with self.lock:
+            joined = self.groups.pop(old_id, None)
+            if not joined:
+                return
+            for group in joined:
+                self._remove(group, old_id)
+                self.members.setdefault(group, {})[new_id] = None
+            self.groups.setdefault(new_id, set()).update(joined)
+
+    def get(self, group):
+        """Members of a group, as a tuple (empty if the group does not exist)"""
+        members = self.snapshots.get(group)
+        if members is None:
+            with self.lock:
+                current = self.members.get(group)
+                if current is None:
+                    return ()
+                members = self.snapshots[group] = tuple(current)
+        return members
+
+    def groups_of(self, client_id):
+        with self.lock:
+            return sorted(self.groups.get(client_id, ()))
+
+    def counts(self):
+        """{group: number of members} for every group"""
+        with self.lock:
+            return {group: len(members) for group, members in self.members.items()}
+
+    def _remove(self, group, client_id):
+        members = self.members.get(group)
+        if members is not None:
+            members.pop(client_id, None)
+            if not members:
+                del self.members[group]
+            self.snapshots.pop(group, None)
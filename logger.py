@@ -0,0 +1,165 @@
+"""
+Buffered server logging.
+
+Replaces print() on the server's hot paths. A call only checks the level,
+applies per-category sampling and rate limits, and appends a record
+(timestamp, format, args) to a queue; formatting and the write to
+stdout happen on a background thread that flushes all waiting records with
+one write() every FLUSH_INTERVAL seconds. Records below LOG_LEVEL cost one
+comparison.
+
+Usage:
+    from logger import log
+    log.debug("CLIENT", "[CLIENT %s] %s", client_id, message)
+
+Per-message records (commands, stores, routing) are DEBUG; connections and
+lifecycle events are INFO. Set LOG_LEVEL = "DEBUG" to trace every message.
+"""
+import atexit
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR}
+
+LOG_LEVEL = "INFO"
+# Keep only one record in N for a category (e.g. {"CLIENT": 100})
+SAMPLE_EVERY = {}
+# Max records per second for a category; the rest are counted and reported
+RATE_LIMITS = {}
+DEFAULT_RATE_LIMIT = 1000
+FLUSH_INTERVAL = 0.1
+MAX_QUEUED_RECORDS = 100000
+
+
+class Logger:
+    """Level filter, sampler and rate limiter in front of a background writer"""
+
+    def __init__(self, level=LOG_LEVEL, stream=None):
+        self.level = LEVELS[level] if isinstance(level, str) else level
+        self.stream = stream  # None = whatever sys.stdout is at write time
+        self.records = deque()
+        self.sample_counts = {}
+        self.buckets = {}  # category -> [tokens, last refill]
+        self.suppressed = {}  # category -> records dropped by the rate limit
+        self.dropped = 0  # records dropped because the queue was full
+        self.limit_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.writer_thread = None
+        self._start()
+
+    def set_level(self, level):
+        self.level = LEVELS[level] if isinstance(level, str) else level
+
+    def debug(self, category, fmt, *args):
+        if self.level <= DEBUG:
+            self._log(category, fmt, args)
+
+    def info(self, category, fmt, *args):
+        if self.level <= INFO:
+            self._log(category, fmt, args)
+
+    def warning(self, category, fmt, *args):
+        if self.level <= WARNING:
+            self._log(category, fmt, args)
+
+    def error(self, category, fmt, *args):
+        if self.level <= ERROR:
+            self._log(category, fmt, args)
+
+    def _log(self, category, fmt, args):
+        every = SAMPLE_EVERY.get(category)
+        if every:
+            seen = self.sample_counts.get(category, 0)
+            self.sample_counts[category] = seen + 1
+            if seen % every:
+                return
+
+        if not self._allow(category):
+            return
+
+        if len(self.records) >= MAX_QUEUED_RECORDS:
+            self.dropped += 1
+            return
+        self.records.append((time.time(), fmt, args))
+
+    def _allow(self, category):
+        """Token bucket per category"""
+        rate = RATE_LIMITS.get(category, DEFAULT_RATE_LIMIT)
+        if rate is None:
+            return True
+        now = time.monotonic()
+        with self.limit_lock:
+            bucket = self.buckets.get(category)
+            if bucket is None:
+                bucket = self.buckets[category] = [rate, now]
+            tokens = min(rate, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                self.suppressed[category] = self.suppressed.get(category, 0) + 1
+                return False
+            bucket[0] = tokens - 1
+            return True
+
+    def flush(self):
+        """Format and write every queued record (also called by the writer thread)"""
+        with self.write_lock:
+            records = self.records
+            lines = []
+            while records:
+                created, fmt, args = records.popleft()
+                try:
+                    text = fmt % args if args else fmt
+                except Exception as e:
+                    text = f"{fmt!r} % {args!r} failed: {e}"
+                lines.append(f"{time.strftime('%H:%M:%S', time.localtime(created))}"
+                             f".{int(created * 1000) % 1000:03d} {text}\n")
+
+            with self.limit_lock:
+                suppressed, self.suppressed = self.suppressed, {}
+            for category, count in suppressed.items():
+                lines.append(f"[LOG] {count} {category} records over the rate limit were dropped\n")
+            if self.dropped:
+                lines.append(f"[LOG] {self.dropped} records dropped (queue full)\n")
+                self.dropped = 0
+
+            if lines:
+                stream = self.stream or sys.stdout
+                try:
+                    stream.write("".join(lines))
+                    stream.flush()
+                except (OSError, ValueError):
+                    pass
+
+    def _writer(self):
+        while not self.stop_event.wait(FLUSH_INTERVAL):
+            self.flush()
+        self.flush()
+
+    def _start(self):
+        self.stop_event = threading.Event()
+        self.writer_thread = threading.Thread(target=self._writer, name="log-writer", daemon=True)
+        self.writer_thread.start()
+
+    def _after_fork(self):
+        # The writer thread does not survive fork(); cluster workers need their own
+        self.write_lock = threading.Lock()
+        self.limit_lock = threading.Lock()
+        self._start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.writer_thread is not None and self.writer_thread is not threading.current_thread():
+            self.writer_thread.join(timeout=1.0)
+        self.flush()
+
+
+log = Logger()
+atexit.register(log.flush)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=log._after_fork)
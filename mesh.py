@@ -0,0 +1,757 @@
+"""
+Federated mesh of server nodes.
+
+cluster.py spreads one server over the cores of one machine. A mesh joins
+independent servers, on different machines or on different ports of one
+machine, so clients can connect to any node and no single server.py
+instance is needed by all of them. Each node runs the normal threaded or
+event-loop server for its own connections, and keeps one TCP link to
+every other node:
+
+    - when a link comes up, the two nodes exchange a snapshot of their
+      connected clients, identities and group memberships, plus the
+      addresses of the nodes they are linked to. Nodes that are new to
+      the receiver are dialed, so a node given any one member of the mesh
+      with --peer joins all of it
+    - after that, changes are gossiped: client online/offline, IDENTIFY
+      and JOIN/LEAVE are announced to every linked node, so each node
+      knows which node holds every client
+    - a SEND to a client of another node, a BROADCAST and a PUBLISH are
+      forwarded over the links. A link's writer thread sends everything
+      queued since its last write as one frame, so under load many
+      forwarded messages share one frame and one sendall()
+    - messages are stored by the sender's node (MSG_LIST, DELETE_* and
+      MSG_STATS cover one node). A message queued for an offline client
+      is handed over to whichever node the client identifies on, and its
+      ACK is sent back to the node storing it
+
+If a node goes down, its links drop. The other nodes forget its clients
+and keep redialing it until it returns. Its clients can reconnect to any
+other node, and with IDENTIFY they get their ids back.
+
+Ids: client and message ids are counter * MAX_NODES + node id, so every
+node allocates them on its own and a message id names the node storing it.
+A node that starts with --peer waits (up to CONNECT_TIMEOUT) for its first
+snapshot before taking clients, and never hands out a client id below the
+stable ids the mesh remembers for it, so a restarted node does not reuse
+the ids of its earlier clients.
+
+Links carry JSON, never pickle, because they cross the network. With
+--secret (MESH_SECRET) a node only links with peers that know the secret:
+each side sends a random nonce in its hello and answers the other's nonce
+with an HMAC keyed by the secret, so the secret itself never crosses the
+link, not even to a peer that fails the check. Without a secret the mesh
+port only listens on a loopback address. A node may only announce client
+ids it allocated (client_id % MAX_NODES == its node id) or stable ids of
+identities the mesh knows, so a peer cannot take over another node's clients.
+
+Usage:
+    python mesh.py --node 0 [--port 5000] [--mesh-port 6000] [--peer host:6001 ...] [--mode async|thread]
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import os
+import socket
+import threading
+import time
+
+import server
+from metrics import metrics, SIZE_BUCKETS
+from logger import log
+from protocol import FrameDecoder, ProtocolError, FRAME_MESH, MAX_FRAME_SIZE, compression_for, encode_frame, \
+    encode_message
+from server_utils import broadcast, get_client_list, send_to_client, set_keepalive
+
+MAX_NODES = 64              # node ids are 0 .. MAX_NODES - 1
+MESH_PORT_OFFSET = 1000     # default mesh port: client port + 1000
+MESH_SECRET = None          # shared secret every peer must present, or None
+BATCH_SIZE = 512            # most messages in one link frame
+COMPRESS_LINKS = True       # zlib-compress link frames above the compression threshold
+LINK_HEARTBEAT = 5.0        # an idle link sends a ping this often
+LINK_TIMEOUT = 15.0         # a link that received nothing for this long is dropped
+LINK_QUEUE_LIMIT = 100_000  # a link with more messages waiting is stalled and dropped
+CONNECT_TIMEOUT = 5.0
+RECONNECT_DELAY = 0.5       # first redial delay, doubled after each failure
+RECONNECT_MAX_DELAY = 10.0
+
+
+class PeerLink:
+    """
+    One TCP connection to another node, used in both directions.
+
+    send() only appends to a queue. The writer thread takes everything
+    queued (up to BATCH_SIZE messages) and sends it as one frame, so a
+    burst of forwarded messages costs few frames and system calls while a
+    lone message still goes out at once.
+    """
+
+    def __init__(self, node, sock, address, dialed):
+        self.node = node
+        self.sock = sock
+        self.address = address  # (host, mesh port) of the peer; None until its hello if it dialed us
+        self.dialed = dialed    # True if this node opened the connection
+        self.peer_id = None     # set once the peer's hello (and proof) is accepted
+        self.nonce = os.urandom(16).hex()  # challenge in our hello
+        self.hello = None       # (peer_id, mesh_port, nonce) from the peer's hello
+        self.queue = []
+        self.cond = threading.Condition()
+        self.closed = False
+        self.done = threading.Event()
+        self.compression = compression_for() if COMPRESS_LINKS else None
+
+    def start(self):
+        threading.Thread(target=self._writer, daemon=True).start()
+        threading.Thread(target=self._reader, daemon=True).start()
+
+    def send(self, *message):
+        with self.cond:
+            if self.closed:
+                return
+            self.queue.append(message)
+            if len(self.queue) == 1:
+                self.cond.notify()
+            stalled = len(self.queue) > LINK_QUEUE_LIMIT
+        if stalled:
+            log.warning("MESH", "[MESH] Link to node %s stalled, dropping it", self.peer_id)
+            self.close()
+
+    def send_built(self, build):
+        """Queue the message build() returns, built under the queue lock so no later send can overtake it"""
+        with self.cond:
+            if not self.closed:
+                self.queue.append(build())
+                self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue = []
+            self.cond.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.node.link_down(self)
+        self.done.set()
+
+    def _writer(self):
+        try:
+            while True:
+                with self.cond:
+                    if not self.queue and not self.closed:
+                        self.cond.wait(LINK_HEARTBEAT)
+                    if self.closed:
+                        return
+                    if len(self.queue) <= BATCH_SIZE:
+                        batch, self.queue = self.queue, []
+                    else:
+                        batch = self.queue[:BATCH_SIZE]
+                        del self.queue[:BATCH_SIZE]
+                if not batch:
+                    batch = [("ping",)]
+                self.sock.sendall(self._encode(batch))
+                if metrics.enabled:
+                    metrics.inc("mesh_frames_sent_total")
+                    metrics.inc("mesh_messages_sent_total", len(batch))
+                    metrics.observe("mesh_batch_size", len(batch), buckets=SIZE_BUCKETS)
+        except OSError as e:
+            if not self.closed:
+                log.warning("MESH", "[MESH] Link to node %s failed: %s", self.peer_id, e)
+        finally:
+            self.close()
+
+    def _encode(self, batch):
+        """One frame for the batch, or several if it is too large for one"""
+        payload = json.dumps(batch, separators=(",", ":")).encode('utf-8')
+        if len(payload) <= MAX_FRAME_SIZE:
+            return encode_frame(payload, FRAME_MESH, self.compression)
+        if len(batch) == 1:
+            log.error("MESH", "[MESH] Dropped a %s message of %s bytes", batch[0][0], len(payload))
+            return b""
+        half = len(batch) // 2
+        return self._encode(batch[:half]) + self._encode(batch[half:])
+
+    def _reader(self):
+        decoder = FrameDecoder()
+        self.sock.settimeout(LINK_TIMEOUT)
+        try:
+            while True:
+                nbytes = self.sock.recv_into(decoder.get_buffer())
+                if not nbytes:
+                    break
+                decoder.advance(nbytes)
+                for frame_type, payload in decoder.frames():
+                    if frame_type == FRAME_MESH:
+                        self.node.receive(self, json.loads(payload))
+        except (OSError, ProtocolError, ValueError) as e:
+            if not self.closed:
+                log.warning("MESH", "[MESH] Link to node %s failed: %s", self.peer_id, e)
+        finally:
+            self.close()
+
+
+class MeshNode:
+    """
+    This node's end of the mesh.
+
+    It is installed as server.cluster, so the server routes through it the
+    same way as through a cluster worker's Fabric. Messages from a link are
+    handled by the matching on_* method, a whole frame at a time, through
+    `dispatch`, which runs them on the event loop in async mode.
+    """
+
+    def __init__(self, node_id, mesh_port, seeds, local_manager, local_pending, secret=MESH_SECRET):
+        self.node_id = node_id
+        self.mesh_port = mesh_port
+        self.seeds = seeds
+        self.local_manager = local_manager
+        self.local_pending = local_pending
+        self.secret = secret
+        self.dispatch = lambda func, *args: func(*args)
+        self.links = {}       # node id -> PeerLink
+        self.locations = {}   # client_id -> node id, for clients of other nodes
+        self.identities = {}  # identity -> stable client id, the same on every node
+        self.stable_ids = set()  # every stable id learned, which any node may announce
+        self.addresses = {}   # (host, mesh port) -> node id, or None while unknown
+        self.dialing = set()  # addresses with a redial thread
+        self.lock = threading.Lock()
+        self.synced = threading.Event()
+        self.listener = None
+
+    # --- links ---
+
+    def start(self, host):
+        """Listen for other nodes and dial the seed peers"""
+        if self.secret is None and not is_loopback(host):
+            raise ValueError(f"a mesh listening on {host} needs a secret; use --secret or a loopback --host")
+        self.listener = socket.create_server((host, self.mesh_port), backlog=MAX_NODES)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        for address in self.seeds:
+            self._maintain(address)
+        log.info("MESH", "[MESH] Node %s listening for peers on %s:%s", self.node_id, host, self.mesh_port)
+        if self.seeds and not self.synced.wait(CONNECT_TIMEOUT):
+            log.warning("MESH", "[MESH] No peer answered within %ss, starting alone", CONNECT_TIMEOUT)
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.close()
+        with self.lock:
+            links = list(self.links.values())
+        for link in links:
+            link.close()
+
+    def link_count(self):
+        with self.lock:
+            return len(self.links)
+
+    def _accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            self._open(sock, None, dialed=False)
+
+    def _open(self, sock, address, dialed):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        set_keepalive(sock)
+        link = PeerLink(self, sock, address, dialed)
+        link.send("hello", self.node_id, self.mesh_port, link.nonce)
+        link.start()
+        return link
+
+    def _maintain(self, address, peer_id=None):
+        """Keep a link to the node at address, redialing whenever it drops"""
+        with self.lock:
+            if peer_id is not None:
+                self.addresses[address] = peer_id
+            else:
+                self.addresses.setdefault(address, None)
+            if address in self.dialing:
+                return
+            self.dialing.add(address)
+        threading.Thread(target=self._dial_loop, args=(address,), daemon=True).start()
+
+    def _dial_loop(self, address):
+        delay = RECONNECT_DELAY
+        while True:
+            with self.lock:
+                peer_id = self.addresses.get(address)
+                link = self.links.get(peer_id)
+            if peer_id == self.node_id:
+                return  # our own address, gossiped back to us
+            if link is None:
+                try:
+                    sock = socket.create_connection(address, timeout=CONNECT_TIMEOUT)
+                except OSError:
+                    time.sleep(delay)
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                    continue
+                sock.settimeout(None)
+                link = self._open(sock, address, dialed=True)
+            link.done.wait()
+            if link.peer_id is None:
+                # Refused during the handshake
+                time.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            else:
+                delay = RECONNECT_DELAY
+
+    def receive(self, link, messages):
+        """Handle one frame from a link (on its reader thread)"""
+        while link.peer_id is None and messages:
+            if not self._handshake(link, messages[0]):
+                link.close()
+                return
+            messages = messages[1:]
+        if messages:
+            self.dispatch(self._handle_batch, link, messages)
+
+    def _handshake(self, link, message):
+        """
+        Take one handshake message: the peer's hello, then (with a secret)
+        its proof. Returns False to refuse the link.
+        """
+        if not isinstance(message, list) or not message:
+            return False
+        kind = message[0]
+        if kind == "ping":
+            return True
+        if link.hello is None:
+            if kind != "hello" or len(message) != 4 or not isinstance(message[3], str):
+                return False
+            link.hello = tuple(message[1:])
+            if self.secret is None:
+                return self._hello(link, *link.hello[:2])
+            # Prove we know the secret by signing the peer's challenge
+            link.send("auth", self._proof(link.hello[2], link.nonce, self.node_id))
+            return True
+
+        peer_id, mesh_port, peer_nonce = link.hello
+        expected = self._proof(link.nonce, peer_nonce, peer_id)
+        if (kind != "auth" or len(message) != 2 or not isinstance(message[1], str)
+                or not hmac.compare_digest(message[1].encode('utf-8'), expected.encode('ascii'))):
+            log.warning("MESH", "[MESH] Refused node %s: wrong secret", peer_id)
+            return False
+        return self._hello(link, peer_id, mesh_port)
+
+    def _proof(self, challenge, nonce, prover_id):
+        """
+        HMAC of both nonces and the prover's node id. Binding the id keeps a
+        peer from reflecting our own proof back at us.
+        """
+        data = f"{challenge}:{nonce}:{prover_id}".encode('utf-8')
+        return hmac.new(self.secret.encode('utf-8'), data, hashlib.sha256).hexdigest()
+
+    def _hello(self, link, peer_id, mesh_port):
+        if link.address is None:
+            link.address = (link.sock.getpeername()[0], mesh_port)
+        if peer_id == self.node_id:
+            with self.lock:
+                self.addresses[link.address] = peer_id
+            return False
+        if not isinstance(peer_id, int) or not 0 <= peer_id < MAX_NODES:
+            log.warning("MESH", "[MESH] Refused peer with node id %s", peer_id)
+            return False
+
+        # Two nodes may dial each other at once; both keep the link the lower id dialed
+        preferred = self.node_id < peer_id
+        with self.lock:
+            current = self.links.get(peer_id)
+            if current is not None and current.dialed == preferred and link.dialed != preferred:
+                return False
+            link.peer_id = peer_id
+            self.links[peer_id] = link
+            self.addresses[link.address] = peer_id
+        if current is not None:
+            current.close()
+
+        log.info("MESH", "[MESH] Linked to node %s at %s:%s", peer_id, *link.address)
+        link.send_built(self._snapshot)
+        self._maintain(link.address, peer_id)
+        return True
+
+    def link_down(self, link):
+        with self.lock:
+            if link.peer_id is None or self.links.get(link.peer_id) is not link:
+                return
+            del self.links[link.peer_id]
+            gone = [client_id for client_id, node in self.locations.items() if node == link.peer_id]
+            for client_id in gone:
+                del self.locations[client_id]
+        for client_id in gone:
+            server.groups.leave_all(client_id)
+        log.warning("MESH", "[MESH] Lost node %s (%s clients)", link.peer_id, len(gone))
+
+    def _snapshot(self):
+        local = get_client_list(server.clients, server.clients_lock)
+        with self.lock:
+            identities = list(self.identities.items())
+            peers = [(link.peer_id, link.address) for link in self.links.values()]
+        memberships = [(group, client_id) for client_id in local for group in server.groups.groups_of(client_id)]
+        return ("sync", local, identities, memberships, peers)
+
+    def _handle_batch(self, link, messages):
+        if self.links.get(link.peer_id) is not link:
+            return  # replaced by a newer link to the same node
+        for message in messages:
+            try:
+                getattr(self, "on_" + message[0])(link.peer_id, *message[1:])
+            except Exception as e:
+                log.error("MESH", "[MESH] Bad %s message from node %s: %s", message[0], link.peer_id, e)
+
+    # --- messaging ---
+
+    def send(self, node, *message):
+        with self.lock:
+            link = self.links.get(node)
+        if link is not None:
+            link.send(*message)
+
+    def _announce(self, *message):
+        with self.lock:
+            links = list(self.links.values())
+        for link in links:
+            link.send(*message)
+
+    def on_ping(self, node):
+        pass
+
+    def on_sync(self, node, client_ids, identities, memberships, peers):
+        with self.lock:
+            for identity, stable_id in identities:
+                self._learn_identity(identity, stable_id)
+            client_ids = self._owned_ids(node, client_ids)
+            current = set(client_ids)
+            stale = [client_id for client_id, holder in self.locations.items()
+                     if holder == node and client_id not in current]
+            for client_id in stale:
+                del self.locations[client_id]
+            for client_id in client_ids:
+                self.locations[client_id] = node
+        self._reserve_ids(stable_id for _, stable_id in identities)
+        self.synced.set()
+        for client_id in stale:
+            server.groups.leave_all(client_id)
+        for group, client_id in memberships:
+            server.groups.join(group, client_id)
+        for peer_id, address in peers:
+            if peer_id != self.node_id:
+                self._maintain(tuple(address), peer_id)
+        self._hand_over(node, client_ids)
+
+    # --- client directory ---
+
+    def client_online(self, client_id):
+        self._announce("online", client_id)
+
+    def client_offline(self, client_id):
+        self._announce("offline", client_id)
+
+    def on_online(self, node, client_id):
+        with self.lock:
+            if not self._owned_ids(node, [client_id]):
+                return
+            self.locations[client_id] = node
+        self._hand_over(node, [client_id])
+
+    def on_offline(self, node, client_id):
+        with self.lock:
+            # An id that moved (IDENTIFY) may already be online elsewhere
+            if self.locations.get(client_id) != node:
+                return
+            del self.locations[client_id]
+        server.groups.leave_all(client_id)
+
+    def _owned_ids(self, node, client_ids):
+        """The ids in client_ids that node may announce: its own or stable ones (lock held)"""
+        owned = [client_id for client_id in client_ids
+                 if client_id % MAX_NODES == node or client_id in self.stable_ids]
+        if len(owned) < len(client_ids):
+            log.warning("MESH", "[MESH] Node %s announced %s client ids it does not own; ignored",
+                        node, len(client_ids) - len(owned))
+        return owned
+
+    def client_ids(self):
+        """Connected client ids of every node, from the local directory"""
+        with self.lock:
+            remote = list(self.locations)
+        return sorted(get_client_list(server.clients, server.clients_lock) + remote)
+
+    list_clients = client_ids
+
+    # --- routing ---
+
+    def route(self, sender_id, target_id, msg_id, content):
+        """Forward a message to the node holding target_id; False if it is offline"""
+        with self.lock:
+            link = self.links.get(self.locations.get(target_id))
+        if link is None:
+            return False
+        link.send("deliver", sender_id, target_id, msg_id, content)
+        return True
+
+    def on_deliver(self, node, sender_id, target_id, msg_id, content):
+        if not send_to_client(server.clients, server.clients_lock, target_id, f"MSG:{sender_id}:{content}"):
+            # Went offline while the message was in flight: the sender's node queues it
+            self.send(node, "pending_add", target_id, msg_id)
+
+    def multicast(self, recipient_ids, text):
+        """Deliver text to the recipients held by other nodes, one message per node"""
+        per_node = {}
+        with self.lock:
+            for client_id in recipient_ids:
+                node = self.locations.get(client_id)
+                if node is not None:
+                    per_node.setdefault(node, []).append(client_id)
+        for node, client_ids in per_node.items():
+            self.send(node, "multicast", client_ids, text)
+
+    def on_multicast(self, node, client_ids, text):
+        broadcast(server.clients, server.clients_lock, text, None, client_ids)
+
+    def broadcast(self, sender_id, content):
+        """Fan a broadcast out to the clients of every other node"""
+        self._announce("broadcast", sender_id, content)
+
+    def on_broadcast(self, node, sender_id, content):
+        broadcast(server.clients, server.clients_lock, f"MSG:{sender_id}:{content}", sender_id)
+
+    # --- groups (every node keeps the memberships of all clients) ---
+
+    def group_join(self, group, client_id):
+        self._announce("group_join", group, client_id)
+
+    def group_leave(self, group, client_id):
+        self._announce("group_leave", group, client_id)
+
+    def on_group_join(self, node, group, client_id):
+        server.groups.join(group, client_id)
+
+    def on_group_leave(self, node, group, client_id):
+        server.groups.leave(group, client_id)
+
+    def on_group_move(self, node, old_id, new_id):
+        server.groups.move(old_id, new_id)
+
+    # --- identities ---
+
+    def identify_client(self, client_id, identity):
+        """Mesh version of server.identify_client()"""
+        with server.clients_lock:
+            current = server.client_identities.get(client_id)
+        if current is not None:
+            return client_id if current == identity else None
+
+        with self.lock:
+            stable_id = self.identities.get(identity)
+            if stable_id is None:
+                self.identities[identity] = client_id
+                self.stable_ids.add(client_id)
+            elif stable_id in self.locations:
+                return None
+        if stable_id is None:
+            with server.clients_lock:
+                server.client_identities[client_id] = identity
+            self._announce("identity", identity, client_id)
+            return client_id
+
+        with server.clients_lock:
+            if stable_id in server.clients:
+                return None
+            connection = server.clients.pop(client_id)
+            connection.client_id = stable_id
+            server.clients[stable_id] = connection
+            server.client_identities[stable_id] = identity
+
+        # Announced before "offline", which would drop the old id's memberships
+        server.groups.move(client_id, stable_id)
+        self._announce("group_move", client_id, stable_id)
+        self.client_offline(client_id)
+        self.client_online(stable_id)
+        return stable_id
+
+    def on_identity(self, node, identity, client_id):
+        with self.lock:
+            # A new identity keeps the id its node allocated
+            if client_id % MAX_NODES != node:
+                log.warning("MESH", "[MESH] Node %s announced identity with foreign id %s; ignored", node, client_id)
+                return
+            self._learn_identity(identity, client_id)
+        self._reserve_ids((client_id,))
+
+    def _reserve_ids(self, client_ids):
+        """Move this node's id counter past the ids in client_ids that it allocated"""
+        counters = [client_id // MAX_NODES for client_id in client_ids if client_id % MAX_NODES == self.node_id]
+        if counters:
+            with server.clients_lock:
+                server.client_counter = max(server.client_counter, max(counters))
+
+    def _learn_identity(self, identity, client_id):
+        # Two nodes may hand out a new identity at once; all of them keep the lower id
+        self.stable_ids.add(client_id)
+        current = self.identities.get(identity)
+        if current is None or client_id < current:
+            self.identities[identity] = client_id
+
+    # --- pending deliveries ---
+
+    def _hand_over(self, node, client_ids, message_ids=None):
+        """
+        Send the backlog this node holds for clients that are now online at
+        node (only message_ids if given). The items stay pending here until
+        the client's ACK comes back.
+        """
+        for client_id in client_ids:
+            waiting = self.local_pending.get(client_id) if message_ids is None else message_ids
+            for start in range(0, len(waiting), server.FLUSH_BATCH_SIZE):
+                batch_ids = waiting[start:start + server.FLUSH_BATCH_SIZE]
+                messages = self.local_manager.get_messages(batch_ids)
+                gone = [mid for mid, msg in zip(batch_ids, messages) if msg is None]
+                if gone:
+                    self.local_pending.ack(client_id, gone)
+                items = [(msg.message_id, msg.sender_id, msg.content) for msg in messages if msg is not None]
+                if items:
+                    self.send(node, "queued", client_id, items)
+
+    def on_queued(self, node, client_id, items):
+        with server.clients_lock:
+            connection = server.clients.get(client_id)
+        if connection is None:
+            return  # gone again; the items are handed over on its next IDENTIFY
+        connection.send_batch([encode_message(f"QUEUED:{msg_id}:{sender_id}:{content}",
+                                              connection.framed, connection.compression)
+                               for msg_id, sender_id, content in items])
+
+    def on_pending_add(self, node, client_id, message_id):
+        self.local_pending.add(client_id, message_id)
+        with self.lock:
+            holder = self.locations.get(client_id)
+        if holder is not None:
+            # Already back on another node
+            self._hand_over(holder, [client_id], [message_id])
+
+    def on_pending_ack(self, node, client_id, message_ids):
+        self.local_pending.ack(client_id, message_ids)
+
+
+class MeshPendingDeliveries:
+    """PendingDeliveries for a mesh node; ACKs for messages stored on other nodes go back to them"""
+
+    def __init__(self, local, node):
+        self.local = local
+        self.node = node
+
+    def add(self, client_id, message_id):
+        self.local.add(client_id, message_id)
+
+    def get(self, client_id):
+        return self.local.get(client_id)
+
+    def count(self, client_id):
+        return self.local.count(client_id)
+
+    def ack(self, client_id, message_ids):
+        by_node = {}
+        for message_id in message_ids:
+            by_node.setdefault(message_id % MAX_NODES, []).append(message_id)
+        removed = self.local.ack(client_id, by_node.pop(self.node.node_id, ()))
+        for node, ids in by_node.items():
+            self.node.send(node, "pending_ack", client_id, ids)
+        return removed
+
+    def total(self):
+        return self.local.total()
+
+    def prune(self, get_messages):
+        return self.local.prune(get_messages)
+
+
+def is_loopback(host):
+    """Whether host only accepts connections from this machine"""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def parse_address(text):
+    """'host:port' -> (host, port)"""
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def run_node(node_id, host, port, mesh_port, peers, mode="async", secret=MESH_SECRET):
+    """Run one mesh node: the client server on port, the mesh links on mesh_port"""
+    log_dir = None
+    if server.MESSAGE_LOG_DIR:
+        log_dir = os.path.join(server.MESSAGE_LOG_DIR, f"node-{node_id}")
+    local_manager = server.start_message_manager(id_offset=node_id, id_stride=MAX_NODES, log_dir=log_dir)
+
+    node = MeshNode(node_id, mesh_port, peers, local_manager, server.pending_deliveries, secret)
+    # Nodes sharing a machine expose their metrics on consecutive ports
+    if metrics.http_port is not None:
+        metrics.http_port += node_id
+    metrics.gauge("mesh_links", node.link_count, "Nodes this node is linked to")
+    server.client_id_offset = node_id
+    server.client_id_stride = MAX_NODES
+    server.pending_deliveries = MeshPendingDeliveries(server.pending_deliveries, node)
+    server.cluster = node
+    server.HOST, server.PORT = host, port
+
+    if mode == "async":
+        import async_server
+
+        async def run():
+            node.dispatch = asyncio.get_running_loop().call_soon_threadsafe
+            await async_server.serve(host, port)
+
+        # Joins the mesh before the loop runs; until then link messages are handled on the reader threads
+        node.start(host)
+
+        async_server.raise_fd_limit()
+        try:
+            asyncio.run(run())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            node.stop()
+            local_manager.stop()
+            log.flush()
+    else:
+        node.start(host)
+        server.main()
+        node.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the chat server as one node of a mesh")
+    parser.add_argument("--node", type=int, required=True, help=f"this node's id, 0 to {MAX_NODES - 1}")
+    parser.add_argument("--host", default=server.HOST)
+    parser.add_argument("--port", type=int, default=server.PORT, help="port for clients")
+    parser.add_argument("--mesh-port", type=int, help=f"port for other nodes (default: port + {MESH_PORT_OFFSET})")
+    parser.add_argument("--peer", action="append", default=[], help="host:mesh-port of a node to join (repeatable)")
+    parser.add_argument("--mode", choices=("thread", "async"), default="async")
+    parser.add_argument("--secret", default=MESH_SECRET, help="shared secret all nodes must use")
+    args = parser.parse_args()
+    if not 0 <= args.node < MAX_NODES:
+        parser.error(f"--node must be between 0 and {MAX_NODES - 1}")
+    if args.secret is None and not is_loopback(args.host):
+        parser.error(f"--secret is required unless --host is a loopback address (got {args.host})")
+
+    mesh_port = args.mesh_port if args.mesh_port is not None else args.port + MESH_PORT_OFFSET
+    run_node(args.node, args.host, args.port, mesh_port, [parse_address(peer) for peer in args.peer],
+             args.mode, args.secret)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,408 @@
+"""
+Durable append-only message log for MessageManager.
+
+Store, delete, unlink and clear events are appended to numbered segment files
+(`segment-00000001.log`, ...). A background writer thread does all file I/O
+and commits records in groups: every record appended during one fsync
+batching window is written with a single write() and made durable with a
+single fsync().
+
+Durability levels:
+    "none"  - records are written by the background thread but never
+              fsynced; a machine crash can lose what the OS had buffered
+    "batch" - group commit every `fsync_interval` seconds; appenders never
+              wait, a crash loses at most one window of records
+    "sync"  - appenders wait until their record is fsynced; concurrent
+              appenders share the same fsync
+
+Compaction works through snapshots. MessageManager.checkpoint() rotates to
+a fresh segment and writes the highest id handed out so far, followed by
+every live message with a smaller id, into `snapshot-<segment>.snap`; the
+id header keeps ids from being reused once no message is left. When the
+snapshot is durable all older segments and snapshots are deleted. Recovery loads the newest snapshot and replays
+the segments from there on. Both are read through mmap and replay is
+idempotent, so a snapshot taken while the server keeps running is still
+exact after replay.
+
+Record layout (all integers big-endian):
+
+    +-------+------+--------+---------+
+    | crc32 | type | length | body    |
+    | 4 B   | 1 B  | 4 B    | length  |
+    +-------+------+--------+---------+
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from logger import log
+
+RECORD_HEADER = struct.Struct('!IBI')  # crc32 of type+body, type, body length
+STORE_BODY = struct.Struct('!qqqdd')  # id, sender, recipient, created (wall), expires (wall)
+MESSAGE_ID = struct.Struct('!q')
+RECIPIENT_COUNT = struct.Struct('!I')
+
+RECORD_STORE = 1
+RECORD_DELETE = 2  # body: one or more 8-byte message ids
+RECORD_CLEAR = 3
+RECORD_STORE_BROADCAST = 4  # body: STORE_BODY, recipient count, 8-byte recipient ids, content
+RECORD_UNLINK = 5  # body: 8-byte client id, then the broadcast ids it was removed from
+RECORD_LAST_ID = 6  # body: 8-byte highest message id handed out (snapshot header)
+
+DURABILITY_NONE = "none"
+DURABILITY_BATCH = "batch"
+DURABILITY_SYNC = "sync"
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+CHECKPOINT_MIN_BYTES = 64 * 1024 * 1024
+
+
+class LogError(Exception):
+    """Raised for an unusable log directory or configuration"""
+
+
+def encode_record(record_type, body=b""):
+    crc = zlib.crc32(body, zlib.crc32(bytes((record_type,))))
+    return RECORD_HEADER.pack(crc, record_type, len(body)) + body
+
+
+def encode_store(message_id, sender_id, recipient_id, content, created_wall, expires_wall):
+    body = STORE_BODY.pack(message_id, sender_id, recipient_id, created_wall, expires_wall)
+    return encode_record(RECORD_STORE, body + content.encode('utf-8'))
+
+
+def encode_store_broadcast(message_id, sender_id, recipient_id, recipients, content,
+                           created_wall, expires_wall):
+    body = STORE_BODY.pack(message_id, sender_id, recipient_id, created_wall, expires_wall)
+    recipient_ids = struct.pack(f'!I{len(recipients)}q', len(recipients), *recipients)
+    return encode_record(RECORD_STORE_BROADCAST, body + recipient_ids + content.encode('utf-8'))
+
+
+def decode_store_broadcast(body):
+    """Split a broadcast store body into (fields, recipients, content)"""
+    fields = STORE_BODY.unpack_from(body)
+    pos = STORE_BODY.size
+    (count,) = RECIPIENT_COUNT.unpack_from(body, pos)
+    pos += RECIPIENT_COUNT.size
+    recipients = struct.unpack_from(f'!{count}q', body, pos)
+    pos += count * 8
+    return fields, recipients, body[pos:].decode('utf-8')
+
+
+def encode_message_store(msg, wall_offset):
+    """Store record for a Message, broadcast or not"""
+    created_wall = msg.created_at + wall_offset
+    expires_wall = msg.expires_at + wall_offset
+    if msg.recipients is not None:
+        return encode_store_broadcast(msg.message_id, msg.sender_id, msg.recipient_id, msg.recipients,
+                                      msg.content, created_wall, expires_wall)
+    return encode_store(msg.message_id, msg.sender_id, msg.recipient_id, msg.content,
+                        created_wall, expires_wall)
+
+
+def encode_delete(message_ids):
+    return encode_record(RECORD_DELETE, struct.pack(f'!{len(message_ids)}q', *message_ids))
+
+
+def read_records(path):
+    """
+    Yield (type, body) for every intact record in a segment or snapshot.
+
+    Reading stops at the first truncated or corrupt record, which is what a
+    crash in the middle of a write leaves at the tail of the last segment.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = 0
+            header_size = RECORD_HEADER.size
+            while pos + header_size <= size:
+                crc, record_type, length = RECORD_HEADER.unpack_from(mm, pos)
+                start = pos + header_size
+                end = start + length
+                if end > size:
+                    break
+                body = mm[start:end]
+                if zlib.crc32(body, zlib.crc32(bytes((record_type,)))) != crc:
+                    break
+                yield record_type, body
+                pos = end
+
+
+class _Rotate:
+    """Marker in the pending queue: switch to segment `seq` at this point"""
+
+    __slots__ = ('seq',)
+
+    def __init__(self, seq):
+        self.seq = seq
+
+
+class MessageLog:
+    """
+    Segmented append-only log with group commit (see module docstring).
+
+    Appends are cheap: they encode the record and queue it for the writer
+    thread. Callers that need "sync" durability call wait(ticket) after
+    releasing their own locks.
+    """
+
+    def __init__(self, directory, durability=DURABILITY_BATCH, fsync_interval=0.005,
+                 segment_size=SEGMENT_SIZE, checkpoint_min_bytes=CHECKPOINT_MIN_BYTES):
+        if durability not in (DURABILITY_NONE, DURABILITY_BATCH, DURABILITY_SYNC):
+            raise LogError(f"Unknown durability level: {durability}")
+
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.durability = durability
+        self.fsync_interval = fsync_interval
+        self.segment_size = segment_size
+        self.checkpoint_min_bytes = checkpoint_min_bytes
+
+        self.cond = threading.Condition(threading.Lock())
+        self.pending = []
+        self.appended = 0   # tickets handed out
+        self.synced = 0     # highest ticket written (and fsynced, unless "none")
+        self.running = True
+        self.error = None
+
+        segments = self._list("segment-", ".log")
+        snapshots = self._list("snapshot-", ".snap")
+        # Always append to a fresh segment, never after a possibly torn tail
+        self.segment_seq = max(segments + snapshots + [0]) + 1
+        self.snapshot_bytes = 0
+        if snapshots:
+            self.snapshot_bytes = os.path.getsize(self._snapshot_path(max(snapshots)))
+        self.bytes_since_snapshot = sum(
+            os.path.getsize(self._segment_path(seq)) for seq in segments
+            if not snapshots or seq >= max(snapshots))
+
+        self.file = open(self._segment_path(self.segment_seq), 'ab')
+        self.segment_bytes = 0
+
+        self.writer_thread = threading.Thread(target=self._writer, daemon=True)
+        self.writer_thread.start()
+
+    # --- appending ---
+
+    def append(self, record):
+        """Queue an encoded record; returns a ticket for wait()"""
+        with self.cond:
+            if self.error is not None:
+                raise self.error
+            self.pending.append(record)
+            self.appended += 1
+            if self.durability == DURABILITY_SYNC:
+                self.cond.notify_all()
+            return self.appended
+
+    def append_store(self, msg, wall_offset):
+        return self.append(encode_message_store(msg, wall_offset))
+
+    def append_delete(self, message_ids):
+        return self.append(encode_delete(message_ids))
+
+    def append_unlink(self, client_id, message_ids):
+        """Record that a client was dropped from the recipients of these broadcasts"""
+        return self.append(encode_record(RECORD_UNLINK, struct.pack(
+            f'!q{len(message_ids)}q', client_id, *message_ids)))
+
+    def append_clear(self):
+        return self.append(encode_record(RECORD_CLEAR))
+
+    def rotate(self):
+        """
+        Start a new segment at this point of the record stream.
+
+        Returns its sequence number: every record appended before this call
+        lives in an older segment.
+        """
+        with self.cond:
+            self.segment_seq += 1
+            self.pending.append(_Rotate(self.segment_seq))
+            self.cond.notify_all()
+            return self.segment_seq
+
+    def wait(self, ticket):
+        """Block until the record with this ticket is durable ("sync" only)"""
+        if self.durability != DURABILITY_SYNC:
+            return
+        with self.cond:
+            self.cond.wait_for(lambda: self.synced >= ticket or self.error is not None)
+            if self.error is not None:
+                raise self.error
+
+    def flush(self):
+        """Block until everything appended so far has been written"""
+        with self.cond:
+            ticket = self.appended
+            self.cond.notify_all()
+            self.cond.wait_for(lambda: self.synced >= ticket or self.error is not None)
+
+    def close(self):
+        self.flush()
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.writer_thread.join(timeout=5)
+        self.file.close()
+
+    # --- snapshots / compaction ---
+
+    def needs_checkpoint(self):
+        """True once the segments since the last snapshot outgrow it"""
+        return self.bytes_since_snapshot > max(self.checkpoint_min_bytes, 2 * self.snapshot_bytes)
+
+    def write_snapshot(self, seq, messages, wall_offset, last_id=0):
+        """
+        Write live messages as snapshot `seq`, then drop what it supersedes.
+
+        `messages` must cover the state at rotate() == seq; segments from seq
+        onwards are replayed on top of it. `last_id` is the highest message
+        id handed out at that point and is written as the header record.
+        """
+        final_path = self._snapshot_path(seq)
+        temp_path = final_path + ".tmp"
+        size = 0
+        with open(temp_path, 'wb') as f:
+            batch = [encode_record(RECORD_LAST_ID, MESSAGE_ID.pack(last_id))]
+            for msg in messages:
+                batch.append(encode_message_store(msg, wall_offset))
+                if len(batch) >= 4096:
+                    size += f.write(b"".join(batch))
+                    batch = []
+            size += f.write(b"".join(batch))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, final_path)
+        self._fsync_directory()
+
+        for old in self._list("segment-", ".log"):
+            if old < seq:
+                os.remove(self._segment_path(old))
+        for old in self._list("snapshot-", ".snap"):
+            if old < seq:
+                os.remove(self._snapshot_path(old))
+
+        with self.cond:
+            self.snapshot_bytes = size
+            self.bytes_since_snapshot = sum(os.path.getsize(self._segment_path(seq))
+                                            for seq in self._list("segment-", ".log"))
+        log.info("MESSAGE LOG", "[MESSAGE LOG] Snapshot %s written (%s bytes)", seq, size)
+
+    # --- recovery ---
+
+    def replay(self):
+        """
+        Yield (type, body) for every record of the newest snapshot and of
+        all segments after it, oldest first.
+        """
+        snapshots = self._list("snapshot-", ".snap")
+        start = 0
+        if snapshots:
+            start = max(snapshots)
+            yield from read_records(self._snapshot_path(start))
+
+        for seq in self._list("segment-", ".log"):
+            if seq >= start and seq != self.segment_seq:
+                yield from read_records(self._segment_path(seq))
+
+    # --- internals ---
+
+    def _writer(self):
+        """Background thread: group-commits pending records"""
+        while True:
+            with self.cond:
+                if not self.pending and self.running:
+                    self.cond.wait()
+                if not self.pending and not self.running:
+                    return
+
+            # Let more records join this commit before writing
+            if self.durability != DURABILITY_SYNC and self.running:
+                time.sleep(self.fsync_interval)
+
+            with self.cond:
+                batch = self.pending
+                self.pending = []
+                ticket = self.appended
+
+            try:
+                self._write_batch(batch)
+            except OSError as e:
+                log.error("MESSAGE LOG", "[MESSAGE LOG] Write failed: %s", e)
+                with self.cond:
+                    self.error = e
+                    self.cond.notify_all()
+                return
+
+            with self.cond:
+                self.synced = ticket
+                self.cond.notify_all()
+
+    def _write_batch(self, batch):
+        chunk = []
+        for item in batch:
+            if isinstance(item, _Rotate):
+                self._commit(chunk)
+                chunk = []
+                self._open_segment(item.seq)
+            else:
+                chunk.append(item)
+        self._commit(chunk)
+
+        if self.segment_bytes >= self.segment_size:
+            with self.cond:
+                self.segment_seq += 1
+                seq = self.segment_seq
+            self._open_segment(seq)
+
+    def _commit(self, chunk):
+        if not chunk:
+            return
+        data = b"".join(chunk)
+        self.file.write(data)
+        self.file.flush()
+        if self.durability != DURABILITY_NONE:
+            os.fsync(self.file.fileno())
+        self.segment_bytes += len(data)
+        self.bytes_since_snapshot += len(data)
+
+    def _open_segment(self, seq):
+        self.file.flush()
+        if self.durability != DURABILITY_NONE:
+            os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = open(self._segment_path(seq), 'ab')
+        self.segment_bytes = 0
+        self._fsync_directory()
+
+    def _fsync_directory(self):
+        if not hasattr(os, 'O_DIRECTORY'):
+            return
+        fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _list(self, prefix, suffix):
+        seqs = []
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and name.endswith(suffix):
+                try:
+                    seqs.append(int(name[len(prefix):-len(suffix)]))
+                except ValueError:
+                    pass
+        return sorted(seqs)
+
+    def _segment_path(self, seq):
+        return os.path.join(self.directory, f"segment-{seq:08d}.log")
+
+    def _snapshot_path(self, seq):
+        return os.path.join(self.directory, f"snapshot-{seq:08d}.snap")
@@ -1,26 +1,218 @@
+import heapq
+import itertools
+import os
 import threading
 import time
-from datetime import datetime, timedelta
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from compact_store import CompactMessageStore
+from metrics import metrics, SIZE_BUCKETS
+from logger import log
+from message_log import (MessageLog, MESSAGE_ID, STORE_BODY, RECORD_STORE, RECORD_DELETE, RECORD_CLEAR,
+                         RECORD_STORE_BROADCAST, RECORD_UNLINK, RECORD_LAST_ID, decode_store_broadcast)
+
+# Converts monotonic timestamps to wall-clock time for display
+WALL_CLOCK_OFFSET = time.time() - time.monotonic()
+
+# recipient_id of a broadcast; its real recipients are in Message.recipients
+BROADCAST_RECIPIENT = -1
 
 
 class Message:
     """Represents a single message with metadata"""
 
-    def __init__(self, sender_id, recipient_id, content, message_id):
+    # No per-instance __dict__: a stored message costs a fixed handful of slots
+    __slots__ = ('sender_id', 'recipient_id', 'content', 'message_id', 'created_at', 'expires_at',
+                 'recipients')
+
+    def __init__(self, sender_id, recipient_id, content, message_id, ttl=120, recipients=None):
         self.sender_id = sender_id
         self.recipient_id = recipient_id
         self.content = content
         self.message_id = message_id
-        self.timestamp = datetime.now()
-
-    def is_expired(self, ttl_seconds=120):
-        """Check if message has expired (default 2 minutes)"""
-        return datetime.now() - self.timestamp > timedelta(seconds=ttl_seconds)
+        # Set of recipient ids for a broadcast stored once; None for a direct message
+        self.recipients = recipients
+        # Expiry runs on the monotonic clock so wall-clock jumps cannot
+        # expire messages early or keep them forever
+        self.created_at = time.monotonic()
+        self.expires_at = self.created_at + ttl
+
+    @classmethod
+    def from_row(cls, message_id, sender_id, recipient_id, content, created_at, expires_at,
+                 recipients=None):
+        """Build a Message from stored fields without recomputing its deadline"""
+        msg = cls.__new__(cls)
+        msg.recipients = recipients
+        msg.sender_id = sender_id
+        msg.recipient_id = recipient_id
+        msg.content = content
+        msg.message_id = message_id
+        msg.created_at = created_at
+        msg.expires_at = expires_at
+        return msg
+
+    @property
+    def is_broadcast(self):
+        return self.recipients is not None
+
+    @property
+    def ttl(self):
+        return self.expires_at - self.created_at
+
+    @property
+    def timestamp(self):
+        """Wall-clock creation time"""
+        return datetime.fromtimestamp(self.created_at + WALL_CLOCK_OFFSET)
+
+    def is_expired(self, ttl_seconds=None, now=None):
+        """Check if message has expired (uses its own TTL unless ttl_seconds is given)"""
+        if now is None:
+            now = time.monotonic()
+        if ttl_seconds is None:
+            return now >= self.expires_at
+        return now - self.created_at > ttl_seconds
 
     def __repr__(self):
         return f"Message(id={self.message_id}, from={self.sender_id}, to={self.recipient_id}, time={self.timestamp})"
 
 
+class ExpiryQueue:
+    """
+    Deadline-ordered queue of (expires_at, message_id) entries.
+
+    Messages stored with the default TTL arrive in deadline order, so they
+    are appended to two flat arrays and consumed from the head (16 bytes per
+    message). Deadlines that arrive out of order (shorter per-message TTLs)
+    or lie beyond the default-TTL horizon (longer ones) go into a min-heap,
+    so one long TTL never becomes the array tail that every later
+    default-TTL deadline falls behind. pop() returns the earlier of the two
+    heads.
+    """
+
+    def __init__(self, horizon=None):
+        """horizon: the default TTL in seconds (None sends nothing to the heap for being late)"""
+        self.deadlines = array('d')
+        self.ids = array('q')
+        self.head = 0
+        self.heap = []
+        self.horizon = horizon
+
+    def __len__(self):
+        return len(self.ids) - self.head + len(self.heap)
+
+    def push(self, expires_at, message_id):
+        if self.horizon is not None and expires_at > time.monotonic() + self.horizon:
+            heapq.heappush(self.heap, (expires_at, message_id))
+        elif self.head == len(self.ids) or expires_at >= self.deadlines[-1]:
+            self.deadlines.append(expires_at)
+            self.ids.append(message_id)
+        else:
+            heapq.heappush(self.heap, (expires_at, message_id))
+
+    def peek(self):
+        """Earliest deadline, or None when empty"""
+        deadline = self.deadlines[self.head] if self.head < len(self.ids) else None
+        if self.heap and (deadline is None or self.heap[0][0] < deadline):
+            return self.heap[0][0]
+        return deadline
+
+    def pop(self):
+        """Remove and return the (expires_at, message_id) with the earliest deadline"""
+        head = self.head
+        if self.heap and (head == len(self.ids) or self.heap[0][0] < self.deadlines[head]):
+            return heapq.heappop(self.heap)
+
+        entry = (self.deadlines[head], self.ids[head])
+        head += 1
+        if head == len(self.ids):
+            del self.deadlines[:]
+            del self.ids[:]
+            head = 0
+        elif head >= 4096 and head * 2 >= len(self.ids):
+            del self.deadlines[:head]
+            del self.ids[:head]
+            head = 0
+        self.head = head
+        return entry
+
+    def clear(self):
+        del self.deadlines[:]
+        del self.ids[:]
+        self.head = 0
+        self.heap = []
+
+    def rebuild(self, entries):
+        """Replace the contents with the given (expires_at, message_id) entries"""
+        self.clear()
+        entries = sorted(entries)
+        split = len(entries)
+        if self.horizon is not None:
+            horizon = time.monotonic() + self.horizon
+            split = next((i for i, (expires_at, _) in enumerate(entries) if expires_at > horizon), split)
+        for expires_at, message_id in entries[:split]:
+            self.deadlines.append(expires_at)
+            self.ids.append(message_id)
+        # A sorted list is already a valid heap
+        self.heap = entries[split:]
+
+
+class ClientIndex:
+    """
+    One client's message ids in ascending order.
+
+    Ids are appended to a flat array('q') (8 bytes each), so a page can
+    bisect straight to its cursor instead of walking from the start.
+    Removed ids are only tombstoned and skipped while iterating; the array
+    is compacted once tombstones make up half of it.
+    """
+
+    __slots__ = ('ids', 'removed')
+
+    def __init__(self):
+        self.ids = array('q')
+        self.removed = set()
+
+    def __len__(self):
+        return len(self.ids) - len(self.removed)
+
+    def __iter__(self):
+        return self.iter_after(0)
+
+    def add(self, message_id):
+        ids = self.ids
+        if not ids or message_id > ids[-1]:
+            ids.append(message_id)
+            return
+        if message_id in self.removed:
+            self.removed.discard(message_id)
+            return
+        # Out-of-order insert (not produced by a single manager's counter)
+        i = bisect_left(ids, message_id)
+        if i == len(ids) or ids[i] != message_id:
+            ids.insert(i, message_id)
+
+    def discard(self, message_id):
+        ids = self.ids
+        i = bisect_left(ids, message_id)
+        if i == len(ids) or ids[i] != message_id or message_id in self.removed:
+            return
+        self.removed.add(message_id)
+        if len(self.removed) * 2 > len(ids):
+            removed = self.removed
+            self.ids = array('q', [mid for mid in ids if mid not in removed])
+            self.removed = set()
+
+    def iter_after(self, after_id):
+        """Iterate live ids greater than after_id (lock held)"""
+        ids = self.ids
+        removed = self.removed
+        for i in range(bisect_right(ids, after_id), len(ids)):
+            message_id = ids[i]
+            if message_id not in removed:
+                yield message_id
+
+
 class MessageManager:
     """
     Manages message storage with auto-deletion and manual deletion controls.
@@ -28,69 +220,214 @@ class MessageManager:
     Features:
     - Stores messages with timestamps
     - Auto-deletes messages older than 2 minutes (background thread runs every 10 seconds)
+    - Per-message TTL overrides
+    - Expiry deadlines are kept in deadline order (ExpiryQueue), so each sweep
+      only touches messages that are actually due and removes them in
+      bounded batches
+    - Optional compact columnar storage backend (see compact_store.py)
+    - Optional durable append-only log with crash recovery (see message_log.py)
     - Manual deletion options:
         - Delete all messages for a specific client
         - Delete a specific message by ID
         - Clear entire message storage
     """
 
-    def __init__(self, auto_delete_interval=10, message_ttl=120):
+    def __init__(self, auto_delete_interval=10, message_ttl=120, expiry_batch_size=1000,
+                 storage="dict", id_offset=0, id_stride=1, start_worker=True,
+                 log_dir=None, durability="batch"):
         """
         Initialize message manager.
 
         Args:
             auto_delete_interval: Seconds between auto-delete checks
-            message_ttl: Time-to-live for messages in seconds
+            message_ttl: Default time-to-live for messages in seconds
+            expiry_batch_size: Max expiry entries handled per lock acquisition
+                during an auto-delete sweep
+            storage: "dict" keeps one Message object per message; "compact"
+                packs them into a CompactMessageStore
+            id_offset, id_stride: Message ids are allocated as
+                counter * id_stride + id_offset, so several managers (shards)
+                can hand out ids that never collide
+            start_worker: Run the background auto-delete thread (shards leave
+                this to ShardedMessageManager)
+            log_dir: Directory for the durable message log; None keeps
+                messages in memory only
+            durability: "none", "batch" or "sync" (see message_log.py)
         """
-        self.messages = {}  # message_id -> Message
-        self.client_messages = {}  # client_id -> [message_ids]
+        if storage == "compact":
+            self.messages = CompactMessageStore(Message.from_row)  # message_id -> Message
+        else:
+            self.messages = {}  # message_id -> Message
+        # Per-client indexes: client_id -> ClientIndex (ids in ascending order)
+        self.sent_messages = {}
+        self.received_messages = {}
+        self.expiry_queue = ExpiryQueue(message_ttl)  # may hold stale entries of deleted messages
         self.message_counter = 0
-        self.lock = threading.Lock()
+        self.id_offset = id_offset
+        self.id_stride = id_stride
+        self.lock = metrics.instrument_lock(threading.Lock(), "message_manager")
 
         self.auto_delete_interval = auto_delete_interval
         self.message_ttl = message_ttl
+        self.expiry_batch_size = expiry_batch_size
         self.running = True
+        self.stop_event = threading.Event()
+
+        self.log = None
+        if log_dir is not None:
+            self.log = MessageLog(log_dir, durability)
+            self._recover()
 
         # Start background auto-delete thread
         self.auto_delete_thread = threading.Thread(target=self._auto_delete_worker, daemon=True)
-        self.auto_delete_thread.start()
-        print(f"[MESSAGE MANAGER] Started (auto-delete every {auto_delete_interval}s, TTL: {message_ttl}s)")
+        if start_worker:
+            self.auto_delete_thread.start()
+            log.info("MESSAGE MANAGER", "[MESSAGE MANAGER] Started (auto-delete every %ss, TTL: %ss)",
+                     auto_delete_interval, message_ttl)
 
-    def store_message(self, sender_id, recipient_id, content):
+    def store_message(self, sender_id, recipient_id, content, ttl=None):
         """
         Store a new message.
+
+        Args:
+            ttl: Optional per-message time-to-live in seconds
+                (defaults to message_ttl)
+        """
+        if ttl is None:
+            ttl = self.message_ttl
+
+        with self.lock:
+            self.message_counter += 1
+            message_id = self.message_counter * self.id_stride + self.id_offset
+
+            msg = Message(sender_id, recipient_id, content, message_id, ttl)
+            self._insert_message(msg)
+            if self.log is not None:
+                ticket = self.log.append_store(msg, WALL_CLOCK_OFFSET)
+
+            log.debug("MESSAGE STORED", "[MESSAGE STORED] ID=%s, From=%s, To=%s", message_id, sender_id, recipient_id)
+
+        # Wait for durability (if required) without holding up other threads
+        if self.log is not None:
+            self.log.wait(ticket)
+        return message_id
+
+    def store_broadcast(self, sender_id, recipient_ids, content, ttl=None):
+        """
+        Store one broadcast for many recipients.
+
+        The content is stored once; every recipient's received index points
+        at the same record, so MSG_LIST and per-client deletion work as for
+        direct messages.
         """
+        if ttl is None:
+            ttl = self.message_ttl
+
         with self.lock:
             self.message_counter += 1
-            message_id = self.message_counter
+            message_id = self.message_counter * self.id_stride + self.id_offset
+
+            msg = Message(sender_id, BROADCAST_RECIPIENT, content, message_id, ttl, set(recipient_ids))
+            self._insert_message(msg)
+            if self.log is not None:
+                ticket = self.log.append_store(msg, WALL_CLOCK_OFFSET)
+
+            log.debug("MESSAGE STORED", "[MESSAGE STORED] ID=%s, From=%s, To=%s clients",
+                      message_id, sender_id, len(msg.recipients))
 
-            msg = Message(sender_id, recipient_id, content, message_id)
-            self.messages[message_id] = msg
+        if self.log is not None:
+            self.log.wait(ticket)
+        return message_id
+
+    def store_many(self, messages, ttl=None):
+        """
+        Store several direct messages in one lock acquisition.
 
-            if sender_id not in self.client_messages:
-                self.client_messages[sender_id] = []
-            self.client_messages[sender_id].append(message_id)
+        Args:
+            messages: (sender_id, recipient_id, content) tuples
+            ttl: Optional time-to-live for all of them
+        Returns their message ids, in the same order.
+        """
+        if ttl is None:
+            ttl = self.message_ttl
+
+        message_ids = []
+        with self.lock:
+            for sender_id, recipient_id, content in messages:
+                self.message_counter += 1
+                message_id = self.message_counter * self.id_stride + self.id_offset
 
-            if recipient_id not in self.client_messages:
-                self.client_messages[recipient_id] = []
-            self.client_messages[recipient_id].append(message_id)
+                msg = Message(sender_id, recipient_id, content, message_id, ttl)
+                self._insert_message(msg)
+                if self.log is not None:
+                    ticket = self.log.append_store(msg, WALL_CLOCK_OFFSET)
+                message_ids.append(message_id)
 
-            print(f"[MESSAGE STORED] ID={message_id}, From={sender_id}, To={recipient_id}")
-            return message_id
+            log.debug("MESSAGE STORED", "[MESSAGES STORED] %s messages, IDs=%s", len(message_ids), message_ids)
+
+        # Tickets are ordered, so the last one covers the whole batch
+        if self.log is not None and message_ids:
+            self.log.wait(ticket)
+        return message_ids
 
     def get_message(self, message_id):
         """Get a message by ID"""
         with self.lock:
             return self.messages.get(message_id)
 
-    def get_client_messages(self, client_id):
-        """Get all messages associated with a client (sent or received)"""
+    def get_messages(self, message_ids):
+        """Get several messages by ID in one lock acquisition (None for missing ones)"""
         with self.lock:
-            if client_id not in self.client_messages:
-                return []
+            return [self.messages.get(mid) for mid in message_ids]
+
+    def get_client_messages(self, client_id, direction=None):
+        """
+        Get all messages associated with a client (sent or received), oldest first.
+
+        Args:
+            direction: "sent" or "received" to read only one index
+        """
+        with self.lock:
+            return [self.messages[mid] for mid in self._client_message_ids(client_id, direction)]
+
+    def get_client_messages_page(self, client_id, cursor=(), limit=100, direction=None,
+                                 since=None, until=None):
+        """
+        One page of a client's messages after the cursor, in id order.
 
-            msg_ids = self.client_messages[client_id]
-            return [self.messages[mid] for mid in msg_ids if mid in self.messages]
+        Returns (messages, more). Each client index bisects to the cursor,
+        so a page costs O(log n + limit) however deep the cursor is. Ids
+        grow with creation time, so the time range (wall-clock seconds)
+        is applied while walking.
+
+        Args:
+            cursor: Message ids from next_cursor() of the previous page
+                (empty = start); only the one this manager allocated counts
+            limit: Max messages returned
+            direction: "sent" or "received" to read only one index
+            since, until: Only messages created in this wall-clock range
+        """
+        residue = self.id_offset % self.id_stride
+        after_id = max((mid for mid in cursor if mid % self.id_stride == residue), default=0)
+        since = None if since is None else since - WALL_CLOCK_OFFSET
+        until = None if until is None else until - WALL_CLOCK_OFFSET
+        page = []
+        with self.lock:
+            messages = self.messages
+            for msg_id in self._client_message_ids(client_id, direction, after_id):
+                msg = messages[msg_id]
+                if since is not None and msg.created_at < since:
+                    continue
+                if until is not None and msg.created_at > until:
+                    break
+                if len(page) == limit:
+                    return page, True
+                page.append(msg)
+        return page, False
+
+    def next_cursor(self, cursor, messages):
+        """Cursor for the page after `messages` (see advance_cursor())"""
+        return advance_cursor(cursor, messages, self.id_stride)
 
     def get_all_messages(self):
         """Get all stored messages"""
@@ -105,51 +442,78 @@ class MessageManager:
             if message_id not in self.messages:
                 return False
 
-            msg = self.messages[message_id]
+            self._remove_message(self.messages[message_id])
+            self._maybe_rebuild_expiry_queue()
+            if self.log is not None:
+                ticket = self.log.append_delete([message_id])
+            log.debug("MESSAGE DELETED", "[MESSAGE DELETED] ID=%s", message_id)
 
-            if msg.sender_id in self.client_messages:
-                if message_id in self.client_messages[msg.sender_id]:
-                    self.client_messages[msg.sender_id].remove(message_id)
+        if self.log is not None:
+            self.log.wait(ticket)
+        return True
 
-            if msg.recipient_id in self.client_messages:
-                if message_id in self.client_messages[msg.recipient_id]:
-                    self.client_messages[msg.recipient_id].remove(message_id)
+    def delete_many(self, message_ids):
+        """
+        Delete several messages by ID in one lock acquisition.
 
-            del self.messages[message_id]
-            print(f"[MESSAGE DELETED] ID={message_id}")
-            return True
+        Returns one flag per id: True if it was deleted, False if it was
+        not stored (or was listed twice).
+        """
+        deleted = []
+        with self.lock:
+            results = []
+            for message_id in message_ids:
+                msg = self.messages.get(message_id)
+                if msg is None:
+                    results.append(False)
+                    continue
+                self._remove_message(msg)
+                deleted.append(message_id)
+                results.append(True)
+
+            if deleted:
+                self._maybe_rebuild_expiry_queue()
+                if self.log is not None:
+                    ticket = self.log.append_delete(deleted)
+            log.debug("MESSAGE DELETED", "[MESSAGES DELETED] IDs=%s", deleted)
+
+        if self.log is not None and deleted:
+            self.log.wait(ticket)
+        return results
 
     def delete_client_messages(self, client_id):
         """
         Delete all messages for a specific client.
+
+        A broadcast the client only received is kept for its other
+        recipients; the client is just dropped from its recipient set.
         """
         with self.lock:
-            if client_id not in self.client_messages:
-                return 0
-
-            msg_ids = self.client_messages[client_id].copy()
-            count = 0
-
-            for msg_id in msg_ids:
-                if msg_id in self.messages:
-                    msg = self.messages[msg_id]
-
-                    if msg.sender_id in self.client_messages:
-                        if msg_id in self.client_messages[msg.sender_id]:
-                            self.client_messages[msg.sender_id].remove(msg_id)
-
-                    if msg.recipient_id in self.client_messages:
-                        if msg_id in self.client_messages[msg.recipient_id]:
-                            self.client_messages[msg.recipient_id].remove(msg_id)
-
-                    del self.messages[msg_id]
-                    count += 1
-
-            if client_id in self.client_messages and not self.client_messages[client_id]:
-                del self.client_messages[client_id]
-
-            print(f"[MESSAGES DELETED] Client {client_id}: {count} messages")
-            return count
+            msg_ids = []
+            unlinked_ids = []
+            for msg_id in list(self._client_message_ids(client_id)):
+                msg = self.messages[msg_id]
+                if msg.recipients is not None and msg.sender_id != client_id and len(msg.recipients) > 1:
+                    msg.recipients.discard(client_id)
+                    self._unindex(self.received_messages, client_id, msg_id)
+                    unlinked_ids.append(msg_id)
+                else:
+                    self._remove_message(msg)
+                    msg_ids.append(msg_id)
+            count = len(msg_ids) + len(unlinked_ids)
+
+            self._maybe_rebuild_expiry_queue()
+            ticket = 0
+            if self.log is not None and msg_ids:
+                ticket = self.log.append_delete(msg_ids)
+            if self.log is not None and unlinked_ids:
+                ticket = self.log.append_unlink(client_id, unlinked_ids)
+
+            log.debug("MESSAGE DELETED", "[MESSAGES DELETED] Client %s: %s messages", client_id, count)
+
+        if ticket:
+            self.log.wait(ticket)
+        return count
 
     def clear_all_messages(self):
         """
@@ -158,57 +522,259 @@ class MessageManager:
         with self.lock:
             count = len(self.messages)
             self.messages.clear()
-            self.client_messages.clear()
-            print(f"[ALL MESSAGES CLEARED] {count} messages deleted")
-            return count
+            self.sent_messages.clear()
+            self.received_messages.clear()
+            self.expiry_queue.clear()
+            if self.log is not None:
+                ticket = self.log.append_clear()
+            log.info("MESSAGE DELETED", "[ALL MESSAGES CLEARED] %s messages deleted", count)
+
+        if self.log is not None:
+            self.log.wait(ticket)
+        return count
+
+    def _client_message_ids(self, client_id, direction=None, after_id=0):
+        """
+        Iterate a client's message ids above after_id in ascending order (lock held).
 
-    def _auto_delete_expired(self):
+        Both indexes are already sorted by id, so they are merged lazily
+        instead of being copied and sorted.
         """
-        Delete expired messages (internal method).
+        sent = self.sent_messages.get(client_id) if direction != "received" else None
+        received = self.received_messages.get(client_id) if direction != "sent" else None
+        if received is None:
+            return sent.iter_after(after_id) if sent is not None else iter(())
+        if sent is None:
+            return received.iter_after(after_id)
+        return self._merge_unique(sent.iter_after(after_id), received.iter_after(after_id))
+
+    @staticmethod
+    def _merge_unique(sent, received):
+        last = None
+        for msg_id in heapq.merge(sent, received):
+            # A message a client sent to itself is in both indexes
+            if msg_id != last:
+                yield msg_id
+                last = msg_id
+
+    @staticmethod
+    def _unindex(index, client_id, msg_id):
+        ids = index.get(client_id)
+        if ids is not None:
+            ids.discard(msg_id)
+            if not ids:
+                del index[client_id]
+
+    @staticmethod
+    def _index(index, client_id, msg_id):
+        ids = index.get(client_id)
+        if ids is None:
+            ids = index[client_id] = ClientIndex()
+        ids.add(msg_id)
+
+    def _insert_message(self, msg):
+        """Add a message to storage, both client indexes and the expiry queue (lock held)"""
+        message_id = msg.message_id
+        self.messages[message_id] = msg
+        self.expiry_queue.push(msg.expires_at, message_id)
+        self._index(self.sent_messages, msg.sender_id, message_id)
+        if msg.recipients is None:
+            self._index(self.received_messages, msg.recipient_id, message_id)
+        else:
+            for recipient_id in msg.recipients:
+                self._index(self.received_messages, recipient_id, message_id)
+
+    def _remove_message(self, msg):
+        """Remove a message from storage and both client indexes (lock held)"""
+        self._unindex(self.sent_messages, msg.sender_id, msg.message_id)
+        if msg.recipients is None:
+            self._unindex(self.received_messages, msg.recipient_id, msg.message_id)
+        else:
+            for recipient_id in msg.recipients:
+                self._unindex(self.received_messages, recipient_id, msg.message_id)
+        del self.messages[msg.message_id]
+
+    def _maybe_rebuild_expiry_queue(self):
         """
-        with self.lock:
-            expired_ids = [
-                msg_id for msg_id, msg in self.messages.items()
-                if msg.is_expired(self.message_ttl)
-            ]
+        Drop expiry entries of manually deleted messages once they outnumber
+        the live ones (lock held)
+        """
+        if len(self.expiry_queue) > 2 * len(self.messages) + 1024:
+            self.expiry_queue.rebuild((msg.expires_at, msg_id) for msg_id, msg in self.messages.items())
 
-            for msg_id in expired_ids:
-                msg = self.messages[msg_id]
+    def _auto_delete_expired(self):
+        """
+        Delete expired messages (internal method).
 
-                if msg.sender_id in self.client_messages:
-                    if msg_id in self.client_messages[msg.sender_id]:
-                        self.client_messages[msg.sender_id].remove(msg_id)
-                    if not self.client_messages[msg.sender_id]:
-                        del self.client_messages[msg.sender_id]
+        Pops due deadlines off the expiry queue in batches of at most
+        expiry_batch_size, releasing the lock between batches so other
+        threads are never held up for a whole sweep.
+        """
+        started = time.perf_counter()
+        now = time.monotonic()
+        removed = 0
+
+        while True:
+            with self.lock:
+                queue = self.expiry_queue
+                popped = 0
+                while len(queue) and queue.peek() <= now and popped < self.expiry_batch_size:
+                    expires_at, msg_id = queue.pop()
+                    popped += 1
+
+                    msg = self.messages.get(msg_id)
+                    # Skip entries left behind by manual deletes
+                    if msg is None or msg.expires_at != expires_at:
+                        continue
+
+                    self._remove_message(msg)
+                    removed += 1
+
+                more_due = len(queue) > 0 and queue.peek() <= now
+
+            if metrics.enabled and popped:
+                metrics.observe("expiry_batch_size", popped, buckets=SIZE_BUCKETS)
+            if not more_due:
+                break
+
+        if metrics.enabled:
+            metrics.inc("expiry_sweeps_total")
+            metrics.inc("expiry_removed_total", removed)
+            metrics.observe("expiry_sweep_duration_seconds", time.perf_counter() - started)
+        if removed:
+            log.info("AUTO-DELETE", "[AUTO-DELETE] %s expired messages removed", removed)
+
+        return removed
 
-                if msg.recipient_id in self.client_messages:
-                    if msg_id in self.client_messages[msg.recipient_id]:
-                        self.client_messages[msg.recipient_id].remove(msg_id)
-                    if not self.client_messages[msg.recipient_id]:
-                        del self.client_messages[msg.recipient_id]
+    def _auto_delete_worker(self):
+        """Background worker thread"""
+        log.info("AUTO-DELETE", "[AUTO-DELETE THREAD] Started")
 
-                del self.messages[msg_id]
+        while not self.stop_event.wait(self.auto_delete_interval):
+            self._auto_delete_expired()
+            self._maybe_checkpoint()
 
-            if expired_ids:
-                print(f"[AUTO-DELETE] {len(expired_ids)} expired messages removed")
+    def _recover(self):
+        """
+        Rebuild in-memory state from the message log (snapshot + segments).
 
-            return len(expired_ids)
+        Messages whose deadline passed while the server was down are
+        skipped. The id counter resumes after the highest id ever logged,
+        including the high-water id in the snapshot header, so ids are never
+        reused after DELETE_ALL or expiry followed by a checkpoint.
+        """
+        started = time.monotonic()
+        now_wall = time.time()
+        max_id = 0
+        messages = self.messages
+
+        for record_type, body in self.log.replay():
+            if record_type == RECORD_LAST_ID:
+                (last_id,) = MESSAGE_ID.unpack_from(body)
+                max_id = max(max_id, last_id)
+
+            elif record_type == RECORD_STORE:
+                message_id, sender_id, recipient_id, created_wall, expires_wall = STORE_BODY.unpack_from(body)
+                if message_id > max_id:
+                    max_id = message_id
+                if expires_wall <= now_wall or message_id in messages:
+                    continue
+                content = body[STORE_BODY.size:].decode('utf-8')
+                self._insert_message(Message.from_row(
+                    message_id, sender_id, recipient_id, content,
+                    created_wall - WALL_CLOCK_OFFSET, expires_wall - WALL_CLOCK_OFFSET))
+
+            elif record_type == RECORD_STORE_BROADCAST:
+                fields, recipients, content = decode_store_broadcast(body)
+                message_id, sender_id, recipient_id, created_wall, expires_wall = fields
+                if message_id > max_id:
+                    max_id = message_id
+                if expires_wall <= now_wall or message_id in messages:
+                    continue
+                self._insert_message(Message.from_row(
+                    message_id, sender_id, recipient_id, content,
+                    created_wall - WALL_CLOCK_OFFSET, expires_wall - WALL_CLOCK_OFFSET, set(recipients)))
+
+            elif record_type == RECORD_DELETE:
+                for (message_id,) in MESSAGE_ID.iter_unpack(body):
+                    msg = messages.get(message_id)
+                    if msg is not None:
+                        self._remove_message(msg)
+
+            elif record_type == RECORD_UNLINK:
+                ids = MESSAGE_ID.iter_unpack(body)
+                (client_id,) = next(ids)
+                for (message_id,) in ids:
+                    msg = messages.get(message_id)
+                    if msg is None or msg.recipients is None:
+                        continue
+                    if msg.recipients == {client_id}:
+                        self._remove_message(msg)
+                    else:
+                        msg.recipients.discard(client_id)
+                        self._unindex(self.received_messages, client_id, message_id)
+
+            elif record_type == RECORD_CLEAR:
+                messages.clear()
+                self.sent_messages.clear()
+                self.received_messages.clear()
+                self.expiry_queue.clear()
+
+        if max_id:
+            self.message_counter = max(self.message_counter, (max_id - self.id_offset) // self.id_stride)
+        log.info("MESSAGE LOG", "[MESSAGE LOG] Recovered %s messages in %.2fs", len(messages), time.monotonic() - started)
+
+    def _maybe_checkpoint(self):
+        if self.log is not None and self.log.needs_checkpoint():
+            self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Snapshot live messages into the log and drop older segments.
 
-    def _auto_delete_worker(self):
-        """Background worker thread"""
-        print(f"[AUTO-DELETE THREAD] Started")
+        The segment switch and the id list are taken under the lock; messages
+        are then copied in small batches so the lock is never held for the
+        whole snapshot. Changes made meanwhile are in the new segment and
+        are replayed on top of the snapshot during recovery.
+        """
+        if self.log is None:
+            return
 
-        while self.running:
-            time.sleep(self.auto_delete_interval)
-            if self.running:
-                self._auto_delete_expired()
+        with self.lock:
+            seq = self.log.rotate()
+            message_ids = list(self.messages.keys())
+            last_id = self.message_counter * self.id_stride + self.id_offset if self.message_counter else 0
+
+        def live_messages():
+            for start in range(0, len(message_ids), self.expiry_batch_size):
+                with self.lock:
+                    batch = [self._detached(self.messages.get(mid))
+                             for mid in message_ids[start:start + self.expiry_batch_size]]
+                for msg in batch:
+                    if msg is not None:
+                        yield msg
+
+        self.log.write_snapshot(seq, live_messages(), WALL_CLOCK_OFFSET, last_id)
+
+    @staticmethod
+    def _detached(msg):
+        """Copy a broadcast's recipient set so it can be read without the lock (lock held)"""
+        if msg is None or msg.recipients is None:
+            return msg
+        return Message.from_row(msg.message_id, msg.sender_id, msg.recipient_id, msg.content,
+                                msg.created_at, msg.expires_at, frozenset(msg.recipients))
+
+    def get_client_ids(self):
+        """Ids of all clients that have sent or received a stored message"""
+        with self.lock:
+            return self.sent_messages.keys() | self.received_messages.keys()
 
     def get_stats(self):
         """Get message storage statistics"""
         with self.lock:
             return {
                 'total_messages': len(self.messages),
-                'total_clients_with_messages': len(self.client_messages),
+                'total_clients_with_messages': len(self.sent_messages.keys() | self.received_messages.keys()),
                 'message_ttl_seconds': self.message_ttl,
                 'auto_delete_interval_seconds': self.auto_delete_interval
             }
@@ -216,6 +782,240 @@ class MessageManager:
     def stop(self):
         """Stop the message manager"""
         self.running = False
+        self.stop_event.set()
+        if self.auto_delete_thread.is_alive():
+            self.auto_delete_thread.join(timeout=2)
+        if self.log is not None:
+            self.log.close()
+        log.info("MESSAGE MANAGER", "[MESSAGE MANAGER] Stopped")
+
+
+def merge_pages(pages, limit):
+    """
+    Combine (messages, more) pages of several managers into one page in
+    creation order. Ids of different managers interleave by stride, not by
+    time, so only (created_at, id) orders them.
+    """
+    merged = list(heapq.merge(*(messages for messages, _ in pages),
+                              key=lambda msg: (msg.created_at, msg.message_id)))
+    more = len(merged) > limit or any(more for _, more in pages)
+    return merged[:limit], more
+
+
+def advance_cursor(cursor, messages, partitions):
+    """
+    Cursor after a page: the last id returned from each id partition.
+
+    Ids are allocated as counter * stride + offset, so `id % partitions`
+    names the shard (or worker) that allocated an id, and within one
+    partition ids grow with creation time. Each partition resumes after its
+    own entry, so a message stored later by a partition whose counter is
+    behind the others is never skipped. With a single partition the cursor
+    is just the last id.
+    """
+    last = {}
+    for message_id in itertools.chain(cursor, (msg.message_id for msg in messages)):
+        key = message_id % partitions
+        if message_id > last.get(key, 0):
+            last[key] = message_id
+    return tuple(sorted(last.values()))
+
+
+class ShardedMessageManager:
+    """
+    MessageManager partitioned by sender id into independently locked shards.
+
+    Handler threads storing messages for different senders take different
+    locks, so they no longer serialize on a single mutex. Each shard
+    allocates ids as counter * num_shards + shard_index, which keeps ids
+    globally unique without any shared counter and lets a message id be
+    routed straight to its shard.
+
+    Reads that span shards (a client's received messages, stats, clear)
+    visit the shards one at a time, so at most one shard lock is held at
+    any moment. One background thread runs the expiry sweep for all shards.
+
+    With a log_dir, every shard keeps its own message log in a shard-<n>
+    subdirectory; reopen it with the same num_shards.
+    """
+
+    def __init__(self, num_shards=8, auto_delete_interval=10, message_ttl=120,
+                 expiry_batch_size=1000, storage="dict", log_dir=None, durability="batch",
+                 id_offset=0, id_stride=1):
+        # Shard ids interleave inside the id_offset / id_stride sequence, so a
+        # sharded manager can itself be one partition of a larger id space
+        self.shards = [
+            MessageManager(auto_delete_interval, message_ttl, expiry_batch_size, storage,
+                           id_offset=id_offset + index * id_stride, id_stride=num_shards * id_stride,
+                           start_worker=False,
+                           log_dir=os.path.join(log_dir, f"shard-{index}") if log_dir else None,
+                           durability=durability)
+            for index in range(num_shards)
+        ]
+        self.num_shards = num_shards
+        self.id_offset = id_offset
+        self.id_stride = id_stride
+        self.auto_delete_interval = auto_delete_interval
+        self.message_ttl = message_ttl
+        self.running = True
+        self.stop_event = threading.Event()
+
+        self.auto_delete_thread = threading.Thread(target=self._auto_delete_worker, daemon=True)
+        self.auto_delete_thread.start()
+        log.info("MESSAGE MANAGER", "[MESSAGE MANAGER] Started with %s shards (auto-delete every %ss, TTL: %ss)",
+                 num_shards, auto_delete_interval, message_ttl)
+
+    def shard_for_client(self, client_id):
+        return self.shards[self._client_shard_index(client_id)]
+
+    def _client_shard_index(self, client_id):
+        # Cluster and mesh client ids share the message id stride
+        # (counter * id_stride + worker), so drop the worker part first or
+        # every sender on a worker would land in the same shard
+        return client_id // self.id_stride % self.num_shards
+
+    def shard_for_message(self, message_id):
+        return self.shards[self._shard_index(message_id)]
+
+    def _shard_index(self, message_id):
+        return (message_id - self.id_offset) // self.id_stride % self.num_shards
+
+    def store_message(self, sender_id, recipient_id, content, ttl=None):
+        """Store a new message in the sender's shard"""
+        return self.shard_for_client(sender_id).store_message(sender_id, recipient_id, content, ttl)
+
+    def store_broadcast(self, sender_id, recipient_ids, content, ttl=None):
+        """Store one broadcast in the sender's shard"""
+        return self.shard_for_client(sender_id).store_broadcast(sender_id, recipient_ids, content, ttl)
+
+    def store_many(self, messages, ttl=None):
+        """Store several messages, each in its sender's shard, one lock acquisition per shard involved"""
+        by_shard = {}
+        for position, message in enumerate(messages):
+            by_shard.setdefault(self._client_shard_index(message[0]), []).append(position)
+
+        result = [None] * len(messages)
+        for shard_index, positions in by_shard.items():
+            stored = self.shards[shard_index].store_many([messages[p] for p in positions], ttl)
+            for position, message_id in zip(positions, stored):
+                result[position] = message_id
+        return result
+
+    def get_message(self, message_id):
+        return self.shard_for_message(message_id).get_message(message_id)
+
+    def get_messages(self, message_ids):
+        """Get several messages by ID, one lock acquisition per shard involved"""
+        by_shard = {}
+        for position, message_id in enumerate(message_ids):
+            by_shard.setdefault(self._shard_index(message_id), []).append(position)
+
+        result = [None] * len(message_ids)
+        for shard_index, positions in by_shard.items():
+            found = self.shards[shard_index].get_messages([message_ids[p] for p in positions])
+            for position, msg in zip(positions, found):
+                result[position] = msg
+        return result
+
+    def get_client_messages(self, client_id, direction=None):
+        """Get all messages associated with a client (sent or received), oldest first"""
+        if direction == "sent":
+            # Everything a client sent lives in its own shard
+            return self.shard_for_client(client_id).get_client_messages(client_id, direction)
+
+        per_shard = [shard.get_client_messages(client_id, direction) for shard in self.shards]
+        return list(heapq.merge(*per_shard, key=lambda msg: (msg.created_at, msg.message_id)))
+
+    def get_client_messages_page(self, client_id, cursor=(), limit=100, direction=None,
+                                 since=None, until=None):
+        """
+        One page of a client's messages in creation order, merged from every
+        shard's page. Each shard resumes after its own entry of the cursor.
+        """
+        if direction == "sent":
+            return self.shard_for_client(client_id).get_client_messages_page(
+                client_id, cursor, limit, direction, since, until)
+
+        pages = [shard.get_client_messages_page(client_id, cursor, limit, direction, since, until)
+                 for shard in self.shards]
+        return merge_pages(pages, limit)
+
+    def next_cursor(self, cursor, messages):
+        """Cursor for the page after `messages`: the last id of each shard"""
+        return advance_cursor(cursor, messages, self.id_stride * self.num_shards)
+
+    def get_all_messages(self):
+        messages = []
+        for shard in self.shards:
+            messages.extend(shard.get_all_messages())
+        return messages
+
+    def delete_message(self, message_id):
+        return self.shard_for_message(message_id).delete_message(message_id)
+
+    def delete_many(self, message_ids):
+        """Delete several messages by ID, one lock acquisition per shard involved"""
+        by_shard = {}
+        for position, message_id in enumerate(message_ids):
+            by_shard.setdefault(self._shard_index(message_id), []).append(position)
+
+        result = [False] * len(message_ids)
+        for shard_index, positions in by_shard.items():
+            deleted = self.shards[shard_index].delete_many([message_ids[p] for p in positions])
+            for position, flag in zip(positions, deleted):
+                result[position] = flag
+        return result
+
+    def delete_client_messages(self, client_id):
+        return sum(shard.delete_client_messages(client_id) for shard in self.shards)
+
+    def clear_all_messages(self):
+        """Clear every shard, one lock at a time"""
+        return sum(shard.clear_all_messages() for shard in self.shards)
+
+    def get_client_ids(self):
+        client_ids = set()
+        for shard in self.shards:
+            client_ids |= shard.get_client_ids()
+        return client_ids
+
+    def get_stats(self):
+        """Aggregate statistics across shards without locking them all at once"""
+        total = 0
+        client_ids = set()
+        for shard in self.shards:
+            with shard.lock:
+                total += len(shard.messages)
+                client_ids |= shard.sent_messages.keys()
+                client_ids |= shard.received_messages.keys()
+
+        return {
+            'total_messages': total,
+            'total_clients_with_messages': len(client_ids),
+            'message_ttl_seconds': self.message_ttl,
+            'auto_delete_interval_seconds': self.auto_delete_interval,
+            'shards': self.num_shards
+        }
+
+    def _auto_delete_expired(self):
+        return sum(shard._auto_delete_expired() for shard in self.shards)
+
+    def _auto_delete_worker(self):
+        """Background worker thread sweeping every shard"""
+        log.info("AUTO-DELETE", "[AUTO-DELETE THREAD] Started")
+
+        while not self.stop_event.wait(self.auto_delete_interval):
+            for shard in self.shards:
+                shard._auto_delete_expired()
+                shard._maybe_checkpoint()
+
+    def stop(self):
+        """Stop the message manager"""
+        self.running = False
+        self.stop_event.set()
         if self.auto_delete_thread.is_alive():
             self.auto_delete_thread.join(timeout=2)
-        print(f"[MESSAGE MANAGER] Stopped")
+        for shard in self.shards:
+            if shard.log is not None:
+                shard.log.close()
+        log.info("MESSAGE MANAGER", "[MESSAGE MANAGER] Stopped")
@@ -0,0 +1,351 @@
+"""
+Low-overhead server metrics.
+
+The server records:
+    - a counter and a latency histogram per command
+    - wait times of clients_lock and MessageManager.lock (TimedLock)
+    - expiry sweep duration, batch sizes and removed messages
+    - bytes received/sent and connections opened/closed
+    - gauges computed on demand: connected clients, outbound queue depth
+
+They are read with the METRICS command (one summary line) or scraped in
+Prometheus text format from http://127.0.0.1:9100/metrics.
+
+Metrics are off by default (METRICS_ENABLED = False): the hot paths only
+test `metrics.enabled`, locks are not wrapped and no port is opened, so the
+cost is one attribute check per event. When enabled, every thread records
+into its own counters and histograms, so recording takes no shared lock;
+the per-thread values are merged when metrics are read.
+"""
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from logger import log
+
+METRICS_ENABLED = False
+HTTP_HOST = '127.0.0.1'
+HTTP_PORT = 9100  # None disables the Prometheus endpoint (only served when enabled)
+PREFIX = "chat_"
+
+# Upper bounds in seconds; one extra bucket catches everything above
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                   0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+
+
+class Histogram:
+    """Fixed-bucket histogram; callers serialize observe()"""
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, q):
+        """Estimate a quantile by linear interpolation inside its bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class TimedLock:
+    """
+    threading.Lock wrapper that records how long acquirers had to wait.
+
+    Only contended acquisitions are timed: the uncontended path is a single
+    non-blocking acquire. The statistics are updated while the lock is
+    held, so they need no lock of their own.
+    """
+
+    __slots__ = ('lock', 'name', 'acquisitions', 'contended', 'wait')
+
+    def __init__(self, lock, name):
+        self.lock = lock
+        self.name = name
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait = Histogram()
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not self.lock.acquire(False):
+            if not blocking:
+                return False
+            start = time.perf_counter()
+            if not self.lock.acquire(True, timeout):
+                return False
+            self.contended += 1
+            self.wait.observe(time.perf_counter() - start)
+        self.acquisitions += 1
+        return True
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return True
+
+    def __exit__(self, exc_type, exc, tb):
+        self.lock.release()
+
+
+class _Shard:
+    """Counters and histograms written by a single thread"""
+
+    __slots__ = ('counters', 'histograms')
+
+    def __init__(self):
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+
+    def merge_into(self, counters, histograms):
+        # dict.copy() is atomic under the GIL, so the owner may keep writing
+        for key, value in self.counters.copy().items():
+            counters[key] = counters.get(key, 0) + value
+        for key, histogram in self.histograms.copy().items():
+            total = histograms.get(key)
+            if total is None:
+                total = histograms[key] = Histogram(histogram.buckets)
+            total.merge(histogram)
+
+
+class Metrics:
+    """Registry of counters, histograms, gauges and timed locks"""
+
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self.http_port = HTTP_PORT
+        self.started = time.monotonic()
+        self.lock = threading.Lock()  # guards the registries below, never taken while recording
+        self.local = threading.local()
+        self.shards = []         # (thread, _Shard) of every live thread that recorded something
+        self.retired = _Shard()  # values recorded by threads that have exited
+        self.gauges = {}         # name -> callable returning the current value
+        self.timed_locks = []
+        self.descriptions = {}
+
+    # --- recording ---
+
+    def _shard(self):
+        """The calling thread's shard, registered on first use"""
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = _Shard()
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+            return shard
+
+    def inc(self, name, value=1, labels=()):
+        key = (name, labels)
+        counters = self._shard().counters
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS):
+        key = (name, labels)
+        histograms = self._shard().histograms
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def observe_command(self, command, seconds):
+        """Count one command and record how long it took"""
+        labels = (("command", command),)
+        key = ("command_duration_seconds", labels)
+        shard = self._shard()
+        counters = shard.counters
+        counters[("commands_total", labels)] = counters.get(("commands_total", labels), 0) + 1
+        histogram = shard.histograms.get(key)
+        if histogram is None:
+            histogram = shard.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def gauge(self, name, func, description=""):
+        """Register a value computed when metrics are read"""
+        self.gauges[name] = func
+        self.descriptions[name] = description
+
+    def instrument_lock(self, lock, name):
+        """Wrap a lock in a TimedLock, or return it unchanged when disabled"""
+        if not self.enabled:
+            return lock
+        timed = TimedLock(lock, name)
+        with self.lock:
+            self.timed_locks.append(timed)
+        return timed
+
+    # --- reading ---
+
+    def snapshot(self):
+        """Copy of all values: (counters, histograms, gauges)"""
+        counters = {}
+        histograms = {}
+        with self.lock:
+            # Fold the shards of exited threads (one per client in thread mode) into one
+            live = []
+            for thread, shard in self.shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    shard.merge_into(self.retired.counters, self.retired.histograms)
+            self.shards = live
+            self.retired.merge_into(counters, histograms)
+            for _, shard in live:
+                shard.merge_into(counters, histograms)
+            timed_locks = list(self.timed_locks)
+
+        # Locks with the same name (e.g. one per shard) are reported together
+        for timed in timed_locks:
+            labels = (("lock", timed.name),)
+            counters[("lock_acquisitions_total", labels)] = \
+                counters.get(("lock_acquisitions_total", labels), 0) + timed.acquisitions
+            counters[("lock_contended_total", labels)] = \
+                counters.get(("lock_contended_total", labels), 0) + timed.contended
+            histogram = histograms.setdefault(("lock_wait_seconds", labels), Histogram())
+            histogram.merge(timed.wait)
+
+        gauges = {"uptime_seconds": time.monotonic() - self.started}
+        for name, func in list(self.gauges.items()):
+            try:
+                gauges[name] = func()
+            except Exception as e:
+                log.warning("METRICS", "[METRICS] Gauge %s failed: %s", name, e)
+        return counters, histograms, gauges
+
+    def summary(self):
+        """One-line summary for the METRICS command"""
+        counters, histograms, gauges = self.snapshot()
+        parts = [f"{name}={_format(value)}" for name, value in sorted(gauges.items())]
+        for (name, labels), value in sorted(counters.items()):
+            if name not in ("commands_total", "lock_acquisitions_total", "lock_contended_total"):
+                parts.append(f"{_label_name(name, labels)}={value}")
+
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name == "command_duration_seconds":
+                command = labels[0][1]
+                parts.append(f"cmd.{command}={histogram.count}"
+                             f"/p50:{histogram.quantile(0.5) * 1000:.3f}ms"
+                             f"/p99:{histogram.quantile(0.99) * 1000:.3f}ms")
+            elif name == "lock_wait_seconds":
+                lock = labels[0][1]
+                acquisitions = counters.get(("lock_acquisitions_total", labels), 0)
+                parts.append(f"lock.{lock}={acquisitions}"
+                             f"/contended:{histogram.count}"
+                             f"/p99:{histogram.quantile(0.99) * 1000:.3f}ms")
+            else:
+                parts.append(f"{_label_name(name, labels)}={histogram.count}"
+                             f"/p50:{_format(histogram.quantile(0.5))}"
+                             f"/p99:{_format(histogram.quantile(0.99))}")
+        return ";".join(parts)
+
+    def render_prometheus(self):
+        """All metrics in the Prometheus text exposition format"""
+        counters, histograms, gauges = self.snapshot()
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if self.descriptions.get(name):
+                    lines.append(f"# HELP {PREFIX}{name} {self.descriptions[name]}")
+                lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+        for name, value in sorted(gauges.items()):
+            declare(name, "gauge")
+            lines.append(f"{PREFIX}{name} {_format(value)}")
+
+        for (name, labels), value in sorted(counters.items()):
+            declare(name, "counter")
+            lines.append(f"{PREFIX}{name}{_labels(labels)} {value}")
+
+        for (name, labels), histogram in sorted(histograms.items()):
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{PREFIX}{name}_bucket{_labels(labels + (('le', _format(bound)),))} {cumulative}")
+            lines.append(f"{PREFIX}{name}_bucket{_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+            lines.append(f"{PREFIX}{name}_sum{_labels(labels)} {_format(histogram.sum)}")
+            lines.append(f"{PREFIX}{name}_count{_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def start_http_server(self, host=HTTP_HOST, port=None):
+        """Serve /metrics on a local port from a daemon thread; None if disabled or busy"""
+        port = self.http_port if port is None else port
+        if not self.enabled or port is None:
+            return None
+
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+        except OSError as e:
+            log.warning("METRICS", "[METRICS] Endpoint not started on %s:%s: %s", host, port, e)
+            return None
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        log.info("METRICS", "[METRICS] Serving http://%s:%s/metrics", host, port)
+        return httpd
+
+
+def _format(value):
+    if isinstance(value, float):
+        return f"{value:.6g}"
+    return str(value)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def _label_name(name, labels):
+    return ".".join([name] + [str(value) for _, value in labels])
+
+
+metrics = Metrics()
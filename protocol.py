@@ -0,0 +1,309 @@
+"""
+Wire protocol shared by server.py, async_server.py, server_utils.py and client.py.
+
+Every framed record starts with a fixed 7-byte header:
+
+    +-------+---------+------+----------------+
+    | magic | version | type | payload length |
+    | 1 B   | 1 B     | 1 B  | 4 B big-endian |
+    +-------+---------+------+----------------+
+
+followed by `length` payload bytes. The magic byte (0xFE) can never appear in
+UTF-8 text, so the decoder can tell a framed record from a plain text line by
+looking at its first byte. That keeps the old text protocol usable for
+telnet/netcat debugging: newline-terminated lines are accepted on the same
+port and replies to such clients are sent back as text lines.
+
+Compression: a type byte with FLAG_COMPRESSED set carries a zlib stream of
+the real payload. Each frame is compressed on its own (so one compressed
+broadcast can be sent to many connections), optionally against a preset
+dictionary; the zlib header names the dictionary by its Adler-32 id, so
+any decoder that has it registered can inflate the frame. Peers only send
+compressed frames after agreeing with HELLO:zlib[:<dict_id>].
+"""
+import re
+import struct
+import zlib
+from collections import Counter
+
+MAGIC = 0xFE
+VERSION = 1
+
+HEADER = struct.Struct('!BBBI')  # magic, version, type, payload length
+HEADER_SIZE = HEADER.size
+
+# Frame types
+FRAME_LINE = 0x00  # legacy newline-terminated text (never sent as a frame)
+FRAME_TEXT = 0x01  # UTF-8 command or reply
+FRAME_CLUSTER = 0x02  # worker-to-worker fabric message (cluster.py), never sent to clients
+FRAME_REQUEST = 0x03  # command tagged with a request id: 4-byte id + UTF-8 command
+FRAME_REPLY = 0x04    # answer to a FRAME_REQUEST: the same 4-byte id + UTF-8 reply
+FRAME_MESH = 0x05     # node-to-node batch of JSON messages (mesh.py), never sent to clients
+
+FLAG_COMPRESSED = 0x80  # type bit: payload is zlib-compressed
+
+REQUEST_ID = struct.Struct('!I')
+
+# Payloads shorter than this are never compressed (the zlib framing and the
+# CPU time cost more than they save)
+COMPRESSION_THRESHOLD = 512
+COMPRESSION_LEVEL = 1
+DICTIONARY_SIZE = 4096
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+MAX_LINE_SIZE = 64 * 1024
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends bytes that cannot be decoded"""
+
+
+def encode_frame(payload, frame_type=FRAME_TEXT, compression=None):
+    """Encode a payload (bytes) as a single frame, compressed if compression is given and it pays off"""
+    if compression is not None and len(payload) >= compression.threshold:
+        packed = compression.compress(payload)
+        if len(packed) < len(payload):
+            payload = packed
+            frame_type |= FLAG_COMPRESSED
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {len(payload)} bytes exceeds {MAX_FRAME_SIZE}")
+    return HEADER.pack(MAGIC, VERSION, frame_type, len(payload)) + payload
+
+
+def encode_message(message, framed=True, compression=None):
+    """Encode a text command/reply for a framed or a legacy text peer"""
+    data = message.encode('utf-8')
+    if framed:
+        return encode_frame(data, FRAME_TEXT, compression)
+    return data + b"\n"
+
+
+def encode_request(request_id, message, compression=None):
+    """Encode a command whose reply should carry request_id"""
+    return encode_frame(REQUEST_ID.pack(request_id) + message.encode('utf-8'), FRAME_REQUEST, compression)
+
+
+def encode_reply(request_id, message, compression=None):
+    """Encode the reply to a FRAME_REQUEST"""
+    return encode_frame(REQUEST_ID.pack(request_id) + message.encode('utf-8'), FRAME_REPLY, compression)
+
+
+# --- compression ---
+
+# Preset dictionaries by Adler-32 id (the id zlib writes into the stream header)
+DICTIONARIES = {}
+
+# Protocol boilerplate and common chat words; what is used most goes last,
+# where zlib references it most cheaply
+DEFAULT_DICTIONARY = (
+    b" would there their about which could other after first these think where being those "
+    b"really going because something people thanks please right know just have with this that "
+    b"what your from will when like they them then than some time good here sure okay yes "
+    b"the and you for are was but not all can get out see now new one how did its our "
+    b"SUCCESS:Message  deleted;SUCCESS:Deleted  messages for Client ;"
+    b"STATS:Total=,Clients=,TTL=120s;CLIENTS:1,2,3,4,5,6,7,8,9,10;"
+    b"SENT:Message queued for offline Client  (ID:;SENT:Message stored (ID:);"
+    b"MESSAGES:ID:,received,Client:broadcast,At:;NEXT:;ID:,sent,Client:,At:17;"
+    b"QUEUED:;MSG:1:;MSG:2:;MSG:3:;MSG:"
+)
+
+
+def register_dictionary(zdict):
+    """Make a preset dictionary available for compression; returns its id"""
+    dict_id = zlib.adler32(zdict)
+    DICTIONARIES[dict_id] = zdict
+    return dict_id
+
+
+DEFAULT_DICTIONARY_ID = register_dictionary(DEFAULT_DICTIONARY)
+
+
+def build_dictionary(samples, size=DICTIONARY_SIZE, base=DEFAULT_DICTIONARY):
+    """
+    Train a preset dictionary on sample payloads (e.g. recorded messages).
+
+    Words and protocol fields are scored by frequency times length and the
+    best ones packed into size bytes, most valuable last, ahead of the
+    protocol boilerplate in base. Register the result on both peers.
+    """
+    counts = Counter()
+    for sample in samples:
+        counts.update(re.findall(rb"[^\s:;,]+[\s:;,]?", sample))
+    ranked = sorted((token for token, n in counts.items() if n > 1),
+                    key=lambda token: counts[token] * len(token))
+    budget = size - len(base)
+    chosen = []
+    for token in reversed(ranked):
+        if budget - len(token) < 0:
+            continue
+        chosen.append(token)
+        budget -= len(token)
+    return b"".join(reversed(chosen)) + base
+
+
+class Compression:
+    """
+    Compression settings agreed for a connection.
+
+    Connections that negotiated the same settings share one instance (see
+    compression_for()), so a broadcast is compressed once per instance.
+    """
+
+    __slots__ = ('zdict', 'dict_id', 'level', 'threshold', '_primed')
+
+    def __init__(self, zdict=None, level=COMPRESSION_LEVEL, threshold=COMPRESSION_THRESHOLD):
+        self.zdict = zdict
+        self.dict_id = zlib.adler32(zdict) if zdict else None
+        self.level = level
+        self.threshold = threshold
+        # Loading a dictionary costs more than copying a compressor that already has it
+        self._primed = zlib.compressobj(level, zdict=zdict) if zdict else None
+
+    def compress(self, payload):
+        if self._primed is None:
+            return zlib.compress(payload, self.level)
+        compressor = self._primed.copy()
+        return compressor.compress(payload) + compressor.flush()
+
+
+_compressions = {}
+
+
+def compression_for(dict_id=None):
+    """Shared Compression for a registered dictionary id (no dictionary if unknown or None)"""
+    zdict = DICTIONARIES.get(dict_id)
+    dict_id = dict_id if zdict is not None else None
+    compression = _compressions.get(dict_id)
+    if compression is None:
+        compression = _compressions.setdefault(dict_id, Compression(zdict))
+    return compression
+
+
+def decompress(payload):
+    """Inflate a FLAG_COMPRESSED payload, using the preset dictionary its header names"""
+    zdict = None
+    if len(payload) >= 6 and payload[1] & 0x20:  # FDICT: 4-byte dictionary id follows
+        dict_id = int.from_bytes(payload[2:6], 'big')
+        zdict = DICTIONARIES.get(dict_id)
+        if zdict is None:
+            raise ProtocolError(f"Unknown compression dictionary {dict_id}")
+    inflater = zlib.decompressobj(zdict=zdict) if zdict else zlib.decompressobj()
+    try:
+        data = inflater.decompress(payload, MAX_FRAME_SIZE)
+    except zlib.error as e:
+        raise ProtocolError(f"Bad compressed frame: {e}")
+    if inflater.unconsumed_tail:
+        raise ProtocolError(f"Compressed frame inflates beyond {MAX_FRAME_SIZE} bytes")
+    if not inflater.eof:
+        raise ProtocolError("Truncated compressed frame")
+    return data
+
+
+def split_request(payload):
+    """Split a FRAME_REQUEST/FRAME_REPLY payload into (request id, body bytes)"""
+    if len(payload) < REQUEST_ID.size:
+        raise ProtocolError("Request frame too short")
+    return REQUEST_ID.unpack_from(payload)[0], payload[REQUEST_ID.size:]
+
+
+class FrameDecoder:
+    """
+    Incremental decoder for a byte stream of frames and/or text lines.
+
+    Designed around recv_into(): get_buffer() returns the free tail of a
+    preallocated buffer, the caller reads straight into it and reports the
+    byte count with advance(), then frames() yields every complete record.
+    A single large read can therefore yield many pipelined commands, and a
+    record split across reads is simply kept until the rest arrives.
+
+    The underlying bytearray is never resized in place (only replaced), so
+    a memoryview handed out by get_buffer() stays valid even if the caller
+    still holds it while frames() runs. A buffer grown for a large record
+    is replaced by one of the initial size once everything is consumed.
+    """
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE):
+        self._buf = bytearray(buffer_size)
+        self._buffer_size = buffer_size
+        self._start = 0  # first unconsumed byte
+        self._end = 0    # end of received data
+
+    def get_buffer(self, min_size=1024):
+        """Return a writable memoryview of at least min_size free bytes"""
+        if len(self._buf) - self._end < min_size:
+            self._make_room(min_size)
+        return memoryview(self._buf)[self._end:]
+
+    def advance(self, nbytes):
+        """Record that nbytes were written into the last get_buffer() view"""
+        self._end += nbytes
+
+    def feed(self, data):
+        """Copy received bytes into the buffer (for callers without recv_into)"""
+        size = len(data)
+        self.get_buffer(size)[:size] = data
+        self._end += size
+
+    def pending(self):
+        """Number of buffered bytes not yet returned as records"""
+        return self._end - self._start
+
+    def frames(self):
+        """Yield (frame_type, payload) for every complete record in the buffer"""
+        buf = self._buf
+        while self._start < self._end:
+            start = self._start
+            if buf[start] == MAGIC:
+                if self._end - start < HEADER_SIZE:
+                    break
+                magic, version, frame_type, length = HEADER.unpack_from(buf, start)
+                if version != VERSION:
+                    raise ProtocolError(f"Unsupported protocol version {version}")
+                if length > MAX_FRAME_SIZE:
+                    raise ProtocolError(f"Frame of {length} bytes exceeds {MAX_FRAME_SIZE}")
+                body = start + HEADER_SIZE
+                if self._end - body < length:
+                    self._reserve(HEADER_SIZE + length)
+                    break
+                self._start = body + length
+                if frame_type & FLAG_COMPRESSED:
+                    yield frame_type & ~FLAG_COMPRESSED, decompress(bytes(buf[body:body + length]))
+                else:
+                    yield frame_type, bytes(buf[body:body + length])
+            else:
+                newline = buf.find(b"\n", start, self._end)
+                if newline < 0:
+                    if self._end - start > MAX_LINE_SIZE:
+                        raise ProtocolError(f"Text line exceeds {MAX_LINE_SIZE} bytes")
+                    break
+                self._start = newline + 1
+                line = bytes(buf[start:newline]).strip()
+                if line:
+                    yield FRAME_LINE, line
+
+        if self._start == self._end:
+            self._start = self._end = 0
+            if len(self._buf) > self._buffer_size:
+                # Don't keep up to MAX_FRAME_SIZE per connection after one large record
+                self._buf = bytearray(self._buffer_size)
+
+    def _reserve(self, record_size):
+        """Make sure a record of record_size bytes fits once it arrives"""
+        if record_size > len(self._buf) - self._start:
+            self._make_room(record_size - (self._end - self._start))
+
+    def _make_room(self, min_free):
+        """Move unconsumed bytes to the front, growing the buffer if needed"""
+        pending = self._end - self._start
+        size = len(self._buf)
+        if pending + min_free > size:
+            while pending + min_free > size:
+                size *= 2
+            new_buf = bytearray(size)
+            new_buf[:pending] = self._buf[self._start:self._end]
+            self._buf = new_buf
+        elif self._start:
+            self._buf[:pending] = self._buf[self._start:self._end]
+        self._start = 0
+        self._end = pending
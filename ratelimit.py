@@ -0,0 +1,91 @@
+"""
+Per-client admission control with token buckets.
+
+Every connection gets a RateLimiter holding one bucket per command class
+(e.g. "write", "broadcast", "bulk") plus an overall "all" bucket. A bucket
+refills at `rate` tokens per second up to `burst`; each command takes one
+token (one per item for batch commands) from its class bucket and from
+"all". When either runs short the command is refused and the caller learns
+how long until the tokens are back, which the server reports to the client
+as a retry-after hint instead of queuing the command.
+
+A connection's commands are handled by one thread (or the event loop) at a
+time, so the buckets need no lock, and they are only created when a class
+is first used, so idle connections stay cheap.
+"""
+from time import monotonic
+
+ALL = "all"
+
+
+class TokenBucket:
+    """Refills at rate tokens per second, holds at most burst tokens"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, now, count=1):
+        """Take count tokens; returns 0.0, or the seconds until they are available"""
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.stamp = now
+        # A batch larger than the burst is charged the whole burst
+        if count > self.burst:
+            count = self.burst
+        if tokens >= count:
+            self.tokens = tokens - count
+            return 0.0
+        self.tokens = tokens
+        return (count - tokens) / self.rate
+
+    def give_back(self, count):
+        self.tokens += min(count, self.burst)
+
+
+class RateLimiter:
+    """
+    The token buckets of one client.
+
+    limits maps a command class to (commands per second, burst); classes
+    without an entry are not limited on their own but still count against
+    "all" if that is set.
+    """
+
+    __slots__ = ('limits', 'buckets')
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.buckets = {}  # command class -> TokenBucket, or None if unlimited
+
+    def admit(self, command_class, count=1):
+        """Returns 0.0 if a command of this class (count items) may run now, else seconds to wait"""
+        now = monotonic()
+        bucket = self._bucket(command_class, now)
+        if bucket is not None:
+            wait = bucket.take(now, count)
+            if wait:
+                return wait
+        if command_class != ALL:
+            overall = self._bucket(ALL, now)
+            if overall is not None:
+                wait = overall.take(now, count)
+                if wait:
+                    if bucket is not None:
+                        bucket.give_back(count)
+                    return wait
+        return 0.0
+
+    def _bucket(self, command_class, now):
+        try:
+            return self.buckets[command_class]
+        except KeyError:
+            limit = self.limits.get(command_class)
+            bucket = None if limit is None else TokenBucket(limit[0], limit[1], now)
+            self.buckets[command_class] = bucket
+            return bucket
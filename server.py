@@ -1,150 +1,1137 @@
+import math
 import socket
 import threading
-from server_utils import send_to_client, broadcast, get_client_list
-from message_manager import MessageManager
+import time
+from server_utils import (ClientConnection, SlowConsumerError, send_to_client, broadcast, get_client_list,
+                          set_keepalive)
+from message_manager import MessageManager, ShardedMessageManager, WALL_CLOCK_OFFSET
+from protocol import (FrameDecoder, ProtocolError, FRAME_LINE, FRAME_TEXT, FRAME_REQUEST, encode_message,
+                      encode_reply, split_request, compression_for)
+from delivery import PendingDeliveries
+from ratelimit import RateLimiter, ALL
+from groups import GroupIndex, HOST_GROUP_PREFIX, host_group, valid_group_name
+from metrics import metrics
+from logger import log, DEBUG
 
 HOST = '0.0.0.0'  # Accept connections from all network interfaces
 PORT = 5000
 
 clients = {}
 client_counter = 0
-clients_lock = threading.Lock()
+clients_lock = metrics.instrument_lock(threading.Lock(), "clients_lock")
+# Client ids are client_counter * client_id_stride + client_id_offset; a
+# cluster worker (cluster.py) or mesh node (mesh.py) sets these so ids never
+# collide across workers / nodes
+client_id_offset = 0
+client_id_stride = 1
 
+# Routing fabric to the other workers when running under cluster.py, or the
+# links to the other nodes under mesh.py (both have the same interface)
+cluster = None
 
-message_manager = MessageManager(auto_delete_interval=10, message_ttl=120)
+# Stable client identities (IDENTIFY:<name>), guarded by clients_lock
+identities = {}  # identity -> stable client id
+client_identities = {}  # stable client id -> identity
 
-def handle_client(client_socket, client_id):
-    print(f"[THREAD STARTED] Handler for Client {client_id}")
+# Messages waiting for offline recipients
+pending_deliveries = PendingDeliveries()
+FLUSH_BATCH_SIZE = 512
+# Seconds between reaper passes that drop queued ids of expired or deleted
+# messages (None turns it off)
+PENDING_PRUNE_INTERVAL = 60
+
+# Group memberships (JOIN/LEAVE/PUBLISH, plus one "@<ip>" group per source
+# host); in cluster mode every worker holds the memberships of all clients
+groups = GroupIndex()
+
+# Messages per MSG_LIST reply (or streamed frame) by default and at most
+MSG_LIST_PAGE_SIZE = 100
+MSG_LIST_MAX_PAGE_SIZE = 1000
+
+# Most targets / message ids in one SEND_MULTI or DELETE_MSGS
+MAX_BATCH_SIZE = 1000
+
+# Longest TTL a SEND_TTL may ask for, in seconds; longer ones are clamped
+MAX_MESSAGE_TTL = 24 * 3600
+
+# Let clients turn on compression of large frames with HELLO:zlib
+COMPRESSION_ENABLED = True
+
+# Token buckets per connection: command class -> (commands per second, burst).
+# "all" covers every command of a client together; commands over a limit
+# are answered with BUSY and a retry-after hint. None turns limiting off.
+RATE_LIMITS = {
+    ALL: (5000, 10000),
+    "write": (2000, 4000),     # SEND, SEND_TTL, DELETE_MSG
+    "broadcast": (100, 200),   # BROADCAST (fans out to every client)
+    "read": (500, 1000),       # LIST, MSG_LIST, MSG_STATS, METRICS
+    "bulk": (1, 5),            # DELETE_CLIENT, DELETE_ALL
+}
+# Connections served at once by this process (one thread each); further
+# ones get a BUSY line and are closed. None means no cap.
+MAX_CONNECTIONS = 2000
+CONNECTION_RETRY_AFTER = 1.0  # seconds, suggested to refused connections
+
+# Heartbeats: a client not heard from for HEARTBEAT_INTERVAL seconds is sent
+# PING (any command, e.g. PONG, counts as a sign of life). The reaper, run
+# every REAP_INTERVAL, evicts clients silent for IDLE_TIMEOUT, or for
+# READ_TIMEOUT in the middle of a record. None turns each one off.
+HEARTBEAT_INTERVAL = 30
+IDLE_TIMEOUT = 90
+READ_TIMEOUT = 30
+REAP_INTERVAL = 5
+
+# Admission control counters, reported by MSG_STATS
+throttled_commands = 0
+refused_connections = 0
+
+
+# "dict" keeps one Message object per message; "compact" stores them in
+# typed columns plus a payload arena (see compact_store.py)
+MESSAGE_STORAGE = "dict"
+# Independently locked storage shards (partitioned by sender id); 1 keeps a
+# single MessageManager
+MESSAGE_SHARDS = 1
+# Directory for the durable message log (None = in-memory only) and its
+# durability level: "none", "batch" (group commit) or "sync"
+MESSAGE_LOG_DIR = None
+MESSAGE_LOG_DURABILITY = "batch"
+
+message_manager = None
+
+
+def start_message_manager(id_offset=0, id_stride=1, log_dir=MESSAGE_LOG_DIR):
+    """
+    Create the message manager (once, before serving).
+
+    Cluster workers pass their own id partition and log directory.
+    """
+    global message_manager
+
+    if message_manager is None:
+        if MESSAGE_SHARDS > 1:
+            message_manager = ShardedMessageManager(MESSAGE_SHARDS, auto_delete_interval=10, message_ttl=120,
+                                                    storage=MESSAGE_STORAGE, log_dir=log_dir,
+                                                    durability=MESSAGE_LOG_DURABILITY,
+                                                    id_offset=id_offset, id_stride=id_stride)
+        else:
+            message_manager = MessageManager(auto_delete_interval=10, message_ttl=120, storage=MESSAGE_STORAGE,
+                                             id_offset=id_offset, id_stride=id_stride,
+                                             log_dir=log_dir, durability=MESSAGE_LOG_DURABILITY)
+    return message_manager
+
+
+def outbound_queue_stats():
+    """Total and largest number of bytes waiting to be written to clients"""
+    with clients_lock:
+        connections = list(clients.values())
+    sizes = [conn.pending_bytes() for conn in connections]
+    return sum(sizes), max(sizes, default=0)
+
+
+metrics.gauge("clients_connected", lambda: len(clients), "Clients connected to this process")
+metrics.gauge("outbound_queued_bytes", lambda: outbound_queue_stats()[0], "Bytes queued for all clients")
+metrics.gauge("outbound_queue_max_bytes", lambda: outbound_queue_stats()[1], "Largest per-client outbound queue")
+metrics.gauge("messages_stored", lambda: message_manager.get_stats()['total_messages'] if message_manager else 0,
+              "Messages held by the message manager")
+metrics.gauge("pending_deliveries", lambda: pending_deliveries.total(), "Messages queued for offline clients")
+
+
+def admit_connection(address, max_connections):
+    """
+    Check the connection cap before serving a new client.
+
+    Returns None if the connection may be served, otherwise the BUSY line
+    to send it before closing (it has not said which wire format it
+    speaks yet, so this is a plain text line).
+    """
+    global refused_connections
+
+    if max_connections is None or len(clients) < max_connections:
+        return None
+    refused_connections += 1
+    if metrics.enabled:
+        metrics.inc("connections_refused_total")
+    log.warning("CONNECTION", "[REFUSED] %s:%s, already serving %s clients", address[0], address[1], len(clients))
+    return encode_message(busy_message("connections", CONNECTION_RETRY_AFTER), framed=False)
+
+
+def register_client(connection, address=None):
+    """
+    Assign a new client id and add the connection to the clients table.
+
+    With the peer address the client also joins the group of its host.
+    """
+    global client_counter
+
+    connection.limiter = RateLimiter(RATE_LIMITS) if RATE_LIMITS else None
+    with clients_lock:
+        client_counter += 1
+        client_id = client_counter * client_id_stride + client_id_offset
+        connection.client_id = client_id
+        clients[client_id] = connection
+
+    if metrics.enabled:
+        metrics.inc("connections_opened_total")
+    if cluster is not None:
+        cluster.client_online(client_id)
+    if address is not None:
+        join_group(client_id, host_group(address[0]))
+    return client_id
+
+
+def unregister_client(client_id, connection):
+    """Remove a connection from the clients table (if the reaper has not already)"""
+    unregister_clients([(client_id, connection)])
+
+
+def unregister_clients(entries):
+    """
+    Remove (client_id, connection) pairs from the clients table under one
+    lock acquisition. An id that now belongs to another connection (taken
+    over by IDENTIFY after this one was reaped) is left alone.
+    Returns the ids removed.
+    """
+    with clients_lock:
+        removed = [client_id for client_id, connection in entries if clients.get(client_id) is connection]
+        for client_id in removed:
+            del clients[client_id]
+
+    for client_id in removed:
+        groups.leave_all(client_id)
+    if metrics.enabled and removed:
+        metrics.inc("connections_closed_total", len(removed))
+    if cluster is not None:
+        for client_id in removed:
+            cluster.client_offline(client_id)
+    return removed
+
+
+def reap_idle_clients(now=None):
+    """
+    One heartbeat pass over every connection.
+
+    PINGs clients that have been quiet for HEARTBEAT_INTERVAL and evicts the
+    ones past IDLE_TIMEOUT (READ_TIMEOUT with a partial record buffered) in
+    bulk: they leave the clients table together, so broadcasts stop queueing
+    for them at once, and are then closed without flushing. Their handler
+    thread (or connection_lost) finishes the cleanup.
+    Returns the number of connections evicted.
+    """
+    if now is None:
+        now = time.monotonic()
+    with clients_lock:
+        entries = list(clients.items())
+
+    dead = []
+    for client_id, connection in entries:
+        quiet = now - connection.last_seen
+        if ((IDLE_TIMEOUT is not None and quiet >= IDLE_TIMEOUT) or
+                (READ_TIMEOUT is not None and connection.partial and quiet >= READ_TIMEOUT)):
+            dead.append((client_id, connection))
+        elif HEARTBEAT_INTERVAL is not None and now - max(connection.last_seen, connection.pinged) >= HEARTBEAT_INTERVAL:
+            connection.pinged = now
+            try:
+                connection.send_message("PING")
+            except SlowConsumerError:
+                pass  # the connection is being closed already
+
+    if not dead:
+        return 0
+    removed = set(unregister_clients(dead))
+    for client_id, connection in dead:
+        if client_id in removed:
+            connection.close(flush_timeout=0)
+    if metrics.enabled:
+        metrics.inc("connections_reaped_total", len(removed))
+    log.info("REAPER", "[REAPER] Evicted %s dead connections", len(removed))
+    return len(removed)
+
+
+def prune_pending_deliveries():
+    """Drop queued deliveries whose message expired or was deleted"""
+    removed = pending_deliveries.prune(message_manager.get_messages)
+    if removed:
+        log.info("REAPER", "[REAPER] Dropped %s queued deliveries of expired or deleted messages", removed)
+    return removed
+
+
+def run_reaper():
+    """Reaper loop for the threaded server (async_server.py schedules passes on its loop)"""
+    next_prune = time.monotonic() + (PENDING_PRUNE_INTERVAL or 0)
+    while True:
+        time.sleep(REAP_INTERVAL)
+        try:
+            reap_idle_clients()
+        except Exception as e:
+            log.error("ERROR", "[ERROR] Reaper: %s", e)
+
+        if PENDING_PRUNE_INTERVAL is not None and time.monotonic() >= next_prune:
+            next_prune = time.monotonic() + PENDING_PRUNE_INTERVAL
+            try:
+                prune_pending_deliveries()
+            except Exception as e:
+                log.error("ERROR", "[ERROR] Pending delivery prune: %s", e)
+
+
+def list_clients():
+    """Ids of all connected clients, across every worker in cluster mode"""
+    if cluster is not None:
+        return cluster.list_clients()
+    return get_client_list(clients, clients_lock)
+
+
+def identify_client(client_id, identity):
+    """
+    Bind a connection to a stable identity.
+
+    The first time an identity is seen it keeps the connection's current id;
+    later connections using it take that id back over, so messages sent to
+    the id while the client was away can be delivered. Returns the client's
+    id from now on, or None if the identity is in use by another connection.
+    """
+    if cluster is not None:
+        return cluster.identify_client(client_id, identity)
+
+    with clients_lock:
+        current = client_identities.get(client_id)
+        if current is not None:
+            return client_id if current == identity else None
+
+        stable_id = identities.get(identity)
+        if stable_id is None:
+            identities[identity] = client_id
+            client_identities[client_id] = identity
+            return client_id
+
+        if stable_id in clients:
+            return None
+
+        connection = clients.pop(client_id)
+        connection.client_id = stable_id
+        clients[stable_id] = connection
+    groups.move(client_id, stable_id)
+    return stable_id
+
+
+def join_group(client_id, group):
+    """Add a client to a group; returns the group's size, or None if it is in too many groups"""
+    size = groups.join(group, client_id)
+    if size is not None and cluster is not None:
+        cluster.group_join(group, client_id)
+    return size
+
+
+def leave_group(client_id, group):
+    """Remove a client from a group; False if it was not a member"""
+    left = groups.leave(group, client_id)
+    if left and cluster is not None:
+        cluster.group_leave(group, client_id)
+    return left
+
+
+def flush_pending(client_id):
+    """
+    Send a reconnected client its backlog as QUEUED:<msg_id>:<sender>:<content>.
+
+    Messages are fetched and encoded in batches and each batch is handed to
+    the connection in one call, so the writer sends it with a single
+    vectored sendmsg(). Items stay pending until the client ACKs them;
+    ones that expired meanwhile are dropped.
+    """
+    with clients_lock:
+        connection = clients.get(client_id)
+    if connection is None:
+        return 0
+
+    message_ids = pending_deliveries.get(client_id)
+    delivered = 0
+    for start in range(0, len(message_ids), FLUSH_BATCH_SIZE):
+        batch_ids = message_ids[start:start + FLUSH_BATCH_SIZE]
+        messages = message_manager.get_messages(batch_ids)
+
+        gone = [mid for mid, msg in zip(batch_ids, messages) if msg is None]
+        if gone:
+            pending_deliveries.ack(client_id, gone)
+
+        frames = [encode_message(f"QUEUED:{msg.message_id}:{msg.sender_id}:{msg.content}",
+                                 connection.framed, connection.compression)
+                  for msg in messages if msg is not None]
+        if frames:
+            connection.send_batch(frames)
+            delivered += len(frames)
+    return delivered
+
+
+def deliver_or_queue_many(sender_id, deliveries, content):
+    """
+    deliver_or_queue() for one content sent to many recipients.
+
+    deliveries holds (target_id, msg_id) pairs. Online recipients are found
+    in one clients_lock acquisition and get one shared encoded frame.
+    Returns the set of target ids the message was pushed to.
+    """
+    with clients_lock:
+        online = [target_id for target_id, _ in deliveries if target_id in clients]
+    broadcast(clients, clients_lock, f"MSG:{sender_id}:{content}", recipient_ids=online)
+
+    delivered = set(online)
+    for target_id, msg_id in deliveries:
+        if target_id in delivered:
+            continue
+        if cluster is not None and cluster.route(sender_id, target_id, msg_id, content):
+            delivered.add(target_id)
+        else:
+            pending_deliveries.add(target_id, msg_id)
+    return delivered
+
+
+def deliver_or_queue(sender_id, target_id, msg_id, content):
+    """Push a message to its recipient, or queue it if the recipient is offline"""
+    # An offline recipient is the normal case here, so it is looked up
+    # directly instead of through send_to_client(), which logs it as an error
+    with clients_lock:
+        connection = clients.get(target_id)
+    if connection is not None:
+        try:
+            connection.send_message(f"MSG:{sender_id}:{content}")
+            return True
+        except Exception as e:
+            log.warning("ERROR", "[ERROR] Failed to send to Client %s: %s", target_id, e)
+    elif cluster is not None and cluster.route(sender_id, target_id, msg_id, content):
+        # Clients of other workers / nodes
+        return True
+    pending_deliveries.add(target_id, msg_id)
+    return False
+
+
+# --- Command registry ---
+#
+# A command is "OPCODE" or "OPCODE:<args>". dispatch() splits the opcode off
+# the raw frame bytes and finds its handler here in one dict lookup; the
+# handler parses its arguments from bytes and decodes only the parts it
+# needs as text (message content), so nothing else is ever decoded. New
+# commands plug in with @command and need no changes to the dispatch loop.
+COMMANDS = {}  # opcode (bytes) -> (handler, metrics label, b":" / b"" / None if arguments are optional,
+#                 rate class, cost(args) or None)
+QUIT_COMMANDS = (b"quit", b"exit", b"disconnect")
+
+
+def command(name, takes_args=True, limit=ALL, cost=None):
+    """
+    Register a handler(client_id, args) for an opcode.
+
+    args holds the bytes after "OPCODE:" (empty for commands registered with
+    takes_args=False); decode them, e.g. str(args, 'utf-8'), only if the
+    command needs text. takes_args=None accepts both "OPCODE" and
+    "OPCODE:<args>". limit is the RATE_LIMITS class the command counts
+    against (None: never limited); batch commands pass cost(args), the
+    number of tokens they take. Returning False closes the connection.
+    """
+    def register(handler):
+        separator = None if takes_args is None else b":" if takes_args else b""
+        COMMANDS[name.encode('ascii')] = (handler, name.upper(), separator, limit, cost)
+        return handler
+    return register
+
+
+class RequestContext(threading.local):
+    """Request id of the FRAME_REQUEST being handled on this thread (None for plain commands)"""
+    id = None
+    replied = False
+
+
+current_request = RequestContext()
+
+
+def reply(client_id, message):
+    """Send a reply to the client that issued the command, tagged with its request id"""
+    request_id = current_request.id
+    if request_id is not None:
+        current_request.replied = True
+    return send_to_client(clients, clients_lock, client_id, message, request_id)
+
+
+def parse_id(field):
+    """Parse a decimal client/message id; None if the field is not one"""
+    if not field.isdigit():
+        return None
+    return int(field)
+
+
+def dispatch(client_id, payload, limiter=None):
+    """
+    Execute a single command from its raw bytes.
+
+    Shared by the threaded server and the event-loop server (async_server.py).
+    With the client's RateLimiter, commands over its limits are answered
+    with BUSY instead of run.
+    Returns False when the client asked to disconnect, True otherwise.
+    """
+    opcode, colon, args = payload.partition(b":")
+    entry = COMMANDS.get(opcode)
+    if entry is None or (entry[2] != colon and entry[2] is not None):
+        payload, entry, args = resolve_slow(payload)
+    handler, label, _, limit, cost = entry
+
+    if log.level <= DEBUG:
+        log.debug("CLIENT", "[CLIENT %s] %s", client_id, payload.decode('utf-8', 'replace'))
+
+    if limiter is not None and limit is not None:
+        wait = limiter.admit(limit, cost(args) if cost is not None else 1)
+        if wait:
+            throttle(client_id, limit, wait)
+            return True
+
+    if metrics.enabled:
+        started = time.perf_counter()
+        keep_open = handler(client_id, args)
+        metrics.observe_command(label, time.perf_counter() - started)
+    else:
+        keep_open = handler(client_id, args)
+    return keep_open is not False
+
+
+def resolve_slow(payload):
+    """
+    Lookup for payloads the fast path missed: surrounding whitespace,
+    quit/exit/disconnect in any case and unknown commands.
+    Returns (payload, registry entry, args).
+    """
+    payload = payload.strip()
+    opcode, colon, args = payload.partition(b":")
+    if not colon and opcode.lower() in QUIT_COMMANDS:
+        opcode = opcode.lower()
+    entry = COMMANDS.get(opcode)
+    if entry is None or (entry[2] != colon and entry[2] is not None):
+        entry = UNKNOWN_COMMAND
+    return payload, entry, args
+
+
+def busy_message(limit, retry_after):
+    """BUSY reply naming the exceeded limit and when to retry (in whole milliseconds)"""
+    return f"BUSY:RetryAfter={math.ceil(retry_after * 1000)}ms,Limit={limit}"
+
+
+def throttle(client_id, limit, wait):
+    """Refuse a command that is over its rate limit"""
+    global throttled_commands
+
+    throttled_commands += 1
+    if metrics.enabled:
+        metrics.inc("commands_throttled_total", labels=(("class", limit),))
+    log.debug("RATE", "[THROTTLED] Client %s over the %s limit, retry in %.3fs", client_id, limit, wait)
+    reply(client_id, busy_message(limit, wait))
+
+
+def process_command(client_id, message):
+    """Execute a command given as text (see dispatch())"""
+    return dispatch(client_id, message.encode('utf-8'))
+
+
+def unknown_command(client_id, args):
+    reply(client_id, "ERROR:Unknown command")
+
+
+UNKNOWN_COMMAND = (unknown_command, "OTHER", b"", ALL, None)
+
+
+@command("SEND", limit="write")
+def handle_send(client_id, args):
+    # Format: SEND:<client_id>:<message>
+    field, colon, content = args.partition(b":")
+    target_id = parse_id(field) if colon else None
+    if target_id is None:
+        reply(client_id, "ERROR:Invalid client ID")
+        return
+
+    content = str(content, 'utf-8')
+    msg_id = message_manager.store_message(client_id, target_id, content)
+    if deliver_or_queue(client_id, target_id, msg_id, content):
+        reply(client_id, f"SENT:Message stored (ID:{msg_id})")
+        log.debug("ROUTED", "[ROUTED] Client %s → Client %s (MsgID:%s)", client_id, target_id, msg_id)
+    else:
+        reply(client_id, f"SENT:Message queued for offline Client {target_id} (ID:{msg_id})")
+        log.debug("QUEUED", "[QUEUED] Client %s → Client %s (MsgID:%s)", client_id, target_id, msg_id)
+
+
+def parse_id_list(field):
+    """Parse "<id>,<id>,..." (at most MAX_BATCH_SIZE ids); None if any is invalid"""
+    ids = [parse_id(part) for part in field.split(b",")]
+    if None in ids or len(ids) > MAX_BATCH_SIZE:
+        return None
+    return ids
+
+
+def batch_cost(args):
+    """Rate limit tokens for a batch command: one per listed id"""
+    return args.partition(b":")[0].count(b",") + 1
+
+
+@command("SEND_MULTI", limit="write", cost=batch_cost)
+def handle_send_multi(client_id, args):
+    # Format: SEND_MULTI:<client_id>,<client_id>,...:<message>
+    # Reply:  SENT_MULTI:<client_id>:<msg_id>:<delivered|queued>,...
+    field, colon, content = args.partition(b":")
+    target_ids = parse_id_list(field) if colon else None
+    if target_ids is None:
+        reply(client_id, f"ERROR:Invalid client ID list (at most {MAX_BATCH_SIZE})")
+        return
+
+    content = str(content, 'utf-8')
+    msg_ids = message_manager.store_many([(client_id, target_id, content) for target_id in target_ids])
+    deliveries = list(zip(target_ids, msg_ids))
+    delivered = deliver_or_queue_many(client_id, deliveries, content)
+    reply(client_id, "SENT_MULTI:" + ",".join(
+        f"{target_id}:{msg_id}:{'delivered' if target_id in delivered else 'queued'}"
+        for target_id, msg_id in deliveries))
+    log.debug("ROUTED", "[ROUTED] Client %s → %s clients (%s online)", client_id, len(deliveries), len(delivered))
+
+
+@command("SEND_TTL", limit="write")
+def handle_send_ttl(client_id, args):
+    # Format: SEND_TTL:<client_id>:<seconds>:<message>
+    field, _, rest = args.partition(b":")
+    ttl_field, colon, content = rest.partition(b":")
+    target_id = parse_id(field)
+    try:
+        ttl = float(ttl_field)
+    except ValueError:
+        ttl = 0
+    # "inf" and "nan" parse as floats but are no deadline
+    if target_id is None or not colon or not math.isfinite(ttl) or not ttl > 0:
+        reply(client_id, "ERROR:Invalid client ID or TTL")
+        return
+
+    if ttl > MAX_MESSAGE_TTL:
+        ttl = MAX_MESSAGE_TTL
+        ttl_text = str(MAX_MESSAGE_TTL)
+    else:
+        ttl_text = ttl_field.decode('ascii')
+    content = str(content, 'utf-8')
+    msg_id = message_manager.store_message(client_id, target_id, content, ttl=ttl)
+    if deliver_or_queue(client_id, target_id, msg_id, content):
+        reply(client_id, f"SENT:Message stored (ID:{msg_id}, TTL:{ttl_text}s)")
+        log.debug("ROUTED", "[ROUTED] Client %s → Client %s (MsgID:%s, TTL:%ss)", client_id, target_id, msg_id, ttl_text)
+    else:
+        reply(client_id, f"SENT:Message queued for offline Client {target_id} (ID:{msg_id}, TTL:{ttl_text}s)")
+        log.debug("QUEUED", "[QUEUED] Client %s → Client %s (MsgID:%s, TTL:%ss)", client_id, target_id, msg_id, ttl_text)
+
+
+@command("BROADCAST", limit="broadcast")
+def handle_broadcast(client_id, args):
+    content = str(args, 'utf-8')
+
+    # One stored record for all recipients, one encoded frame for all sockets
+    if cluster is not None:
+        client_list = cluster.client_ids()
+    else:
+        client_list = get_client_list(clients, clients_lock)
+    recipients = [target_id for target_id in client_list if target_id != client_id]
+    if recipients:
+        message_manager.store_broadcast(client_id, recipients, content)
+    broadcast(clients, clients_lock, f"MSG:{client_id}:{content}", recipient_ids=recipients)
+    if cluster is not None:
+        cluster.broadcast(client_id, content)
+    log.debug("BROADCAST", "[BROADCAST] Client %s to all", client_id)
+
+
+def parse_group(field, client_id):
+    """Decode a group name argument; replies with an error and returns None if it is invalid"""
+    group = field.decode('utf-8', 'replace')
+    if not valid_group_name(group):
+        reply(client_id, "ERROR:Invalid group name")
+        return None
+    return group
+
+
+@command("JOIN", limit="write")
+def handle_join(client_id, args):
+    # Format: JOIN:<group>
+    group = parse_group(args, client_id)
+    if group is None:
+        return
+    if group.startswith(HOST_GROUP_PREFIX):
+        reply(client_id, "ERROR:Host groups are joined automatically")
+        return
+    size = join_group(client_id, group)
+    if size is None:
+        reply(client_id, "ERROR:Too many groups")
+    else:
+        reply(client_id, f"SUCCESS:Joined {group} ({size} members)")
+        log.debug("GROUP", "[GROUP] Client %s joined %s", client_id, group)
+
+
+@command("LEAVE", limit="write")
+def handle_leave(client_id, args):
+    # Format: LEAVE:<group>
+    group = parse_group(args, client_id)
+    if group is None:
+        return
+    if leave_group(client_id, group):
+        reply(client_id, f"SUCCESS:Left {group}")
+        log.debug("GROUP", "[GROUP] Client %s left %s", client_id, group)
+    else:
+        reply(client_id, f"ERROR:Not a member of {group}")
+
+
+@command("PUBLISH", limit="broadcast")
+def handle_publish(client_id, args):
+    # Format: PUBLISH:<group>:<message> - the sender does not have to be a member
+    field, colon, content = args.partition(b":")
+    group = parse_group(field, client_id) if colon else None
+    if group is None:
+        if not colon:
+            reply(client_id, "ERROR:Invalid group name")
+        return
+
+    # One stored record and one encoded frame for all members
+    recipients = [target_id for target_id in groups.get(group) if target_id != client_id]
+    if not recipients:
+        reply(client_id, f"SENT:Published to {group} (Recipients:0)")
+        return
+    content = str(content, 'utf-8')
+    msg_id = message_manager.store_broadcast(client_id, recipients, content)
+    text = f"GROUP:{group}:{client_id}:{content}"
+    broadcast(clients, clients_lock, text, recipient_ids=recipients)
+    if cluster is not None:
+        cluster.multicast(recipients, text)
+    reply(client_id, f"SENT:Published to {group} (ID:{msg_id}, Recipients:{len(recipients)})")
+    log.debug("GROUP", "[PUBLISH] Client %s → %s (%s recipients, MsgID:%s)", client_id, group, len(recipients), msg_id)
+
+
+@command("GROUPS", takes_args=False, limit="read")
+def handle_groups(client_id, args):
+    # Every group with its member count: GROUPS:<group>=<count>,...
+    counts = groups.counts()
+    reply(client_id, "GROUPS:" + ",".join(f"{group}={counts[group]}" for group in sorted(counts)))
+
+
+@command("MEMBERS", limit="read")
+def handle_members(client_id, args):
+    # Format: MEMBERS:<group> -> MEMBERS:<group>:<id>,<id>,...
+    group = parse_group(args, client_id)
+    if group is not None:
+        reply(client_id, f"MEMBERS:{group}:" + ",".join(map(str, sorted(groups.get(group)))))
+
+
+def handle_quit(client_id, args):
+    return False
+
+
+for name in QUIT_COMMANDS:
+    command(name.decode('ascii'), takes_args=False, limit=None)(handle_quit)
+
+
+@command("IDENTIFY", limit=None)
+def handle_identify(client_id, args):
+    # Format: IDENTIFY:<name> - reclaim a stable id and receive queued messages
+    identity = str(args, 'utf-8').strip()
+    if not identity:
+        reply(client_id, "ERROR:Invalid identity")
+        return
+
+    stable_id = identify_client(client_id, identity)
+    if stable_id is None:
+        reply(client_id, f"ERROR:Identity {identity} is unavailable")
+    else:
+        reply(stable_id, f"IDENTIFIED:{stable_id}")
+        queued = flush_pending(stable_id)
+        log.info("IDENTIFIED", "[IDENTIFIED] Client %s is %s (ID:%s), %s queued messages sent",
+                 client_id, identity, stable_id, queued)
+
+
+@command("HELLO", limit=None)
+def handle_hello(client_id, args):
+    # Format: HELLO:zlib[:<dict_id>] - compress large frames sent to this
+    # client, with the preset dictionary <dict_id> if the server has it.
+    # Answer: HELLO:zlib[:<dict_id>] with what was agreed, or HELLO:none
+    with clients_lock:
+        connection = clients.get(client_id)
+    if connection is None:
+        return
+
+    method, _, dict_field = args.partition(b":")
+    if method != b"zlib" or not COMPRESSION_ENABLED or not connection.framed:
+        reply(client_id, "HELLO:none")
+        return
+
+    compression = compression_for(parse_id(dict_field))
+    if compression.dict_id is None:
+        reply(client_id, "HELLO:zlib")
+    else:
+        reply(client_id, f"HELLO:zlib:{compression.dict_id}")
+    # The answer itself goes out uncompressed
+    connection.compression = compression
+    log.debug("HELLO", "[HELLO] Client %s: compression on (dictionary %s)", client_id, compression.dict_id)
+
+
+@command("PING", takes_args=False, limit=None)
+def handle_ping(client_id, args):
+    reply(client_id, "PONG")
+
+
+@command("PONG", takes_args=False, limit=None)
+def handle_pong(client_id, args):
+    # Answer to our heartbeat PING; receiving it already marked the client alive
+    pass
+
+
+@command("ACK", limit=None)
+def handle_ack(client_id, args):
+    # Format: ACK:<msg_id>[,<msg_id>...] - confirms QUEUED deliveries
+    fields = [field for field in args.split(b",") if field]
+    if not all(field.isdigit() for field in fields):
+        reply(client_id, "ERROR:Invalid message ID")
+        return
+    pending_deliveries.ack(client_id, [int(field) for field in fields])
+
+
+@command("LIST", takes_args=False, limit="read")
+def handle_list(client_id, args):
+    client_list = list_clients()
+    clients_str = ",".join(map(str, client_list))
+    reply(client_id, f"CLIENTS:{clients_str}")
+    log.debug("LIST", "[LIST] Sent to Client %s: %s", client_id, clients_str)
+
+
+@command("DELETE_MSG", limit="write")
+def handle_delete_msg(client_id, args):
+    msg_id = parse_id(args)
+    if msg_id is None:
+        reply(client_id, "ERROR:Invalid message ID")
+    elif message_manager.delete_message(msg_id):
+        reply(client_id, f"SUCCESS:Message {msg_id} deleted")
+    else:
+        reply(client_id, f"ERROR:Message {msg_id} not found")
+
+
+@command("DELETE_MSGS", limit="write", cost=batch_cost)
+def handle_delete_msgs(client_id, args):
+    # Format: DELETE_MSGS:<msg_id>,<msg_id>,...
+    # Reply:  DELETED_MSGS:<msg_id>:<deleted|not_found>,...
+    msg_ids = parse_id_list(args)
+    if msg_ids is None:
+        reply(client_id, f"ERROR:Invalid message ID list (at most {MAX_BATCH_SIZE})")
+        return
+    deleted = message_manager.delete_many(msg_ids)
+    reply(client_id, "DELETED_MSGS:" + ",".join(
+        f"{msg_id}:{'deleted' if flag else 'not_found'}" for msg_id, flag in zip(msg_ids, deleted)))
+
+
+@command("DELETE_CLIENT", limit="bulk")
+def handle_delete_client(client_id, args):
+    target_id = parse_id(args)
+    if target_id is None:
+        reply(client_id, "ERROR:Invalid client ID")
+        return
+    count = message_manager.delete_client_messages(target_id)
+    reply(client_id, f"SUCCESS:Deleted {count} messages for Client {target_id}")
+
+
+@command("DELETE_ALL", takes_args=False, limit="bulk")
+def handle_delete_all(client_id, args):
+    # Clear entire message storage
+    count = message_manager.clear_all_messages()
+    reply(client_id, f"SUCCESS:Cleared {count} messages")
+
+
+@command("MSG_STATS", takes_args=False, limit="read")
+def handle_msg_stats(client_id, args):
+    # Get message storage statistics
+    stats = message_manager.get_stats()
+    reply(client_id, f"STATS:Total={stats['total_messages']},Clients={stats['total_clients_with_messages']},"
+                     f"TTL={stats['message_ttl_seconds']}s,Throttled={throttled_commands},"
+                     f"RefusedConnections={refused_connections}")
+
+
+@command("METRICS", takes_args=False, limit="read")
+def handle_metrics(client_id, args):
+    # Command counts/latencies, lock waits, expiry sweeps, bytes and churn
+    if metrics.enabled:
+        reply(client_id, f"METRICS:{metrics.summary()}")
+    else:
+        reply(client_id, "ERROR:Metrics are disabled")
+
+
+@command("MSG_LIST", takes_args=None, limit="read")
+def handle_msg_list(client_id, args):
+    # Format: MSG_LIST[:<cursor>[:<limit>[:<option>...]]] - one page of this
+    # client's messages after <cursor> (the NEXT: value of the previous page,
+    # one id per shard / worker); options: sent, received,
+    # since=<unix time>, until=<unix time>, stream
+    query = parse_msg_list(args)
+    if query is None:
+        reply(client_id, "ERROR:Invalid MSG_LIST arguments")
+        return
+
+    if query.pop("stream"):
+        with clients_lock:
+            connection = clients.get(client_id)
+        if connection is not None:
+            current_request.replied = True
+            MessageStream(connection, client_id, current_request.id, **query).pump()
+        return
+
+    messages, more = message_manager.get_client_messages_page(client_id, **query)
+    if not messages:
+        reply(client_id, "MESSAGES:No messages found")
+        return
+    entries = format_message_list(client_id, messages)
+    if more:
+        # Cursor for the next page
+        cursor = message_manager.next_cursor(query["cursor"], messages)
+        entries += f";NEXT:{format_cursor(cursor)}"
+    reply(client_id, f"MESSAGES:{entries}")
+
+
+def parse_msg_list(args):
+    """MSG_LIST arguments as get_client_messages_page() keywords plus "stream"; None if invalid"""
+    query = {"cursor": (), "limit": MSG_LIST_PAGE_SIZE, "direction": None,
+             "since": None, "until": None, "stream": False}
+    if not args:
+        return query
+
+    fields = args.split(b":")
+    if fields[0]:
+        cursor = parse_id_list(fields[0])
+        if cursor is None:
+            return None
+        query["cursor"] = tuple(cursor)
+    if len(fields) > 1 and fields[1]:
+        limit = parse_id(fields[1])
+        if not limit:
+            return None
+        query["limit"] = min(limit, MSG_LIST_MAX_PAGE_SIZE)
+
+    for option in fields[2:]:
+        name, _, value = option.partition(b"=")
+        if option in (b"sent", b"received"):
+            query["direction"] = option.decode('ascii')
+        elif option == b"stream":
+            query["stream"] = True
+        elif name in (b"since", b"until") and value:
+            try:
+                query[name.decode('ascii')] = float(value)
+            except ValueError:
+                return None
+        else:
+            return None
+    return query
+
+
+def format_cursor(cursor):
+    """MSG_LIST cursor as sent after NEXT: (the last id of each shard / worker)"""
+    return ",".join(map(str, cursor))
+
+
+def format_message_list(client_id, messages):
+    """MSG_LIST entries: ID:<msg_id>,<sent|received>,Client:<other_id|broadcast>,At:<unix time>"""
+    entries = []
+    for msg in messages:
+        direction = "sent" if msg.sender_id == client_id else "received"
+        if msg.sender_id != client_id:
+            other_id = msg.sender_id
+        elif msg.is_broadcast:
+            other_id = "broadcast"
+        else:
+            other_id = msg.recipient_id
+        entries.append(f"ID:{msg.message_id},{direction},Client:{other_id},"
+                       f"At:{msg.created_at + WALL_CLOCK_OFFSET:.3f}")
+    return ";".join(entries)
+
+
+class MessageStream:
+    """
+    MSG_LIST with the stream option: every matching message, sent as a
+    series of MESSAGES:<entries> frames (one page each) followed by
+    MESSAGES_END:<count>.
+
+    Pages are read one at a time, and after each one the stream waits in
+    connection.resume_when_drained(), so a client that reads slowly never
+    has more than about a queue watermark of its history buffered.
+    """
+
+    def __init__(self, connection, client_id, request_id, cursor, limit, direction, since, until):
+        self.connection = connection
+        self.client_id = client_id
+        self.request_id = request_id  # replies stay tagged after the command returns
+        self.cursor = cursor
+        self.limit = limit
+        self.direction = direction
+        self.since = since
+        self.until = until
+        self.sent = 0
+
+    def pump(self):
+        """Send pages until done or until the connection has to drain (also the drain callback)"""
+        try:
+            while True:
+                messages, more = message_manager.get_client_messages_page(
+                    self.client_id, self.cursor, self.limit, self.direction, self.since, self.until)
+                if messages:
+                    self.cursor = message_manager.next_cursor(self.cursor, messages)
+                    self.sent += len(messages)
+                    self.send(f"MESSAGES:{format_message_list(self.client_id, messages)}")
+                if not more:
+                    self.send(f"MESSAGES_END:{self.sent}")
+                    return
+                if not self.connection.resume_when_drained(self.pump):
+                    return
+        except SlowConsumerError:
+            log.info("STREAM", "[STREAM] Client %s: MSG_LIST stream stopped after %s messages",
+                     self.client_id, self.sent)
+
+    def send(self, message):
+        if self.request_id is None:
+            self.connection.send_message(message)
+        else:
+            self.connection.send_bytes(encode_reply(self.request_id, message, self.connection.compression))
+
+
+def process_frames(connection, decoder):
+    """
+    Run every complete command buffered in the decoder, in arrival order.
+
+    Pipelined commands that arrived in one read are all handled here.
+    Returns False when the client asked to disconnect.
+    """
+    limiter = connection.limiter
+    for frame_type, payload in decoder.frames():
+        # Read per command: IDENTIFY can change the connection's id
+        client_id = connection.client_id
+        if frame_type != FRAME_LINE:
+            connection.framed = True
+        if frame_type == FRAME_REQUEST:
+            if not dispatch_request(connection, payload):
+                return False
+            continue
+        if frame_type not in (FRAME_LINE, FRAME_TEXT):
+            reply(client_id, f"ERROR:Unsupported frame type {frame_type}")
+            continue
+
+        if not dispatch(client_id, payload, limiter):
+            return False
+    return True
+
+
+def dispatch_request(connection, payload):
+    """
+    Run a FRAME_REQUEST command; every reply it sends carries the request id.
+
+    Commands that normally send nothing back (ACK, BROADCAST) answer "OK",
+    so each request gets exactly one reply.
+    """
+    request_id, payload = split_request(payload)
+    current_request.id = request_id
+    current_request.replied = False
+    try:
+        keep_open = dispatch(connection.client_id, payload, connection.limiter)
+        if keep_open and not current_request.replied:
+            reply(connection.client_id, "OK")
+    finally:
+        current_request.id = None
+    return keep_open
+
+
+def handle_client(connection):
+    log.debug("THREAD", "[THREAD STARTED] Handler for Client %s", connection.client_id)
+    client_socket = connection.sock
+    decoder = FrameDecoder()
 
     try:
         while True:
-            data = client_socket.recv(1024)
+            nbytes = client_socket.recv_into(decoder.get_buffer())
 
-            if not data:
+            if not nbytes:
                 break
 
-            message = data.decode('utf-8').strip()
-            print(f"[CLIENT {client_id}] {message}")
-
-            if message.startswith("SEND:"):
-                parts = message.split(":", 2)
-                if len(parts) == 3:
-                    try:
-                        target_id = int(parts[1])
-                        content = parts[2]
-                      
-                        msg_id = message_manager.store_message(client_id, target_id, content)
-                        send_to_client(clients, clients_lock, target_id, f"MSG:{client_id}:{content}")
-                        send_to_client(clients, clients_lock, client_id, f"SENT:Message stored (ID:{msg_id})")
-                        print(f"[ROUTED] Client {client_id} → Client {target_id} (MsgID:{msg_id})")
-                    except ValueError:
-                        send_to_client(clients, clients_lock, client_id, "ERROR:Invalid client ID")
-
-            elif message.startswith("BROADCAST:"):
-                content = message.split(":", 1)[1]
-                
-                client_list = get_client_list(clients, clients_lock)
-                for target_id in client_list:
-                    if target_id != client_id:
-                        message_manager.store_message(client_id, target_id, content)
-                broadcast(clients, clients_lock, f"MSG:{client_id}:{content}", exclude_id=client_id)
-                print(f"[BROADCAST] Client {client_id} to all")
-            elif message.lower() in ["quit", "exit", "disconnect"]:
+            if metrics.enabled:
+                metrics.inc("bytes_received_total", nbytes)
+            connection.last_seen = time.monotonic()
+            decoder.advance(nbytes)
+            if not process_frames(connection, decoder):
                 break
-            elif message == "LIST":
-                client_list = get_client_list(clients, clients_lock)
-                clients_str = ",".join(map(str, client_list))
-                send_to_client(clients, clients_lock, client_id, f"CLIENTS:{clients_str}")
-                print(f"[LIST] Sent to Client {client_id}: {clients_str}")
-
-            elif message.startswith("DELETE_MSG:"):
-               
-                try:
-                    msg_id = int(message.split(":", 1)[1])
-                    if message_manager.delete_message(msg_id):
-                        send_to_client(clients, clients_lock, client_id, f"SUCCESS:Message {msg_id} deleted")
-                    else:
-                        send_to_client(clients, clients_lock, client_id, f"ERROR:Message {msg_id} not found")
-                except ValueError:
-                    send_to_client(clients, clients_lock, client_id, "ERROR:Invalid message ID")
-
-            elif message.startswith("DELETE_CLIENT:"):
-               
-                try:
-                    target_id = int(message.split(":", 1)[1])
-                    count = message_manager.delete_client_messages(target_id)
-                    send_to_client(clients, clients_lock, client_id, f"SUCCESS:Deleted {count} messages for Client {target_id}")
-                except ValueError:
-                    send_to_client(clients, clients_lock, client_id, "ERROR:Invalid client ID")
-
-            elif message == "DELETE_ALL":
-                # Clear entire message storage
-                count = message_manager.clear_all_messages()
-                send_to_client(clients, clients_lock, client_id, f"SUCCESS:Cleared {count} messages")
-
-            elif message == "MSG_STATS":
-                # Get message storage statistics
-                stats = message_manager.get_stats()
-                stats_str = f"STATS:Total={stats['total_messages']},Clients={stats['total_clients_with_messages']},TTL={stats['message_ttl_seconds']}s"
-                send_to_client(clients, clients_lock, client_id, stats_str)
-
-            elif message == "MSG_LIST":
-                # List all messages for this client
-                messages = message_manager.get_client_messages(client_id)
-                if messages:
-                    msg_list = []
-                    for msg in messages:
-                        direction = "sent" if msg.sender_id == client_id else "received"
-                        other_id = msg.recipient_id if msg.sender_id == client_id else msg.sender_id
-                        msg_list.append(f"ID:{msg.message_id},{direction},Client:{other_id}")
-                    send_to_client(clients, clients_lock, client_id, f"MESSAGES:{';'.join(msg_list)}")
-                else:
-                    send_to_client(clients, clients_lock, client_id, "MESSAGES:No messages found")
-
-            else:
-                send_to_client(clients, clients_lock, client_id, "ERROR:Unknown command")
+            connection.partial = decoder.pending() > 0
+
+    except ProtocolError as e:
+        log.error("ERROR", "[ERROR] Client %s: %s", connection.client_id, e)
+        send_to_client(clients, clients_lock, connection.client_id, f"ERROR:{e}")
 
     except Exception as e:
-        print(f"[ERROR] Client {client_id}: {e}")
+        log.error("ERROR", "[ERROR] Client %s: %s", connection.client_id, e)
 
     finally:
-        with clients_lock:
-            if client_id in clients:
-                del clients[client_id]
+        unregister_client(connection.client_id, connection)
 
+        connection.close()
         client_socket.close()
-        print(f"[DISCONNECTED] Client {client_id} | Remaining clients: {len(clients)}")
+        log.info("CONNECTION", "[DISCONNECTED] Client %s | Remaining clients: %s", connection.client_id, len(clients))
 
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_socket.bind((HOST, PORT))
-server_socket.listen(5)
 
-server_socket.settimeout(1.0)
+def main(reuse_port=False):
+    """
+    Run the threaded server.
 
-print(f"[SERVER STARTED] Listening on {HOST}:{PORT}")
-print(f"[INFO] Waiting for client connections...")
+    Args:
+        reuse_port: Set SO_REUSEPORT so several worker processes can accept
+            on the same port (cluster.py)
+    """
+    start_message_manager()
+    metrics.start_http_server()
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # A restarted server (or mesh node) can bind while old connections are in TIME_WAIT
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind((HOST, PORT))
+    server_socket.listen(socket.SOMAXCONN)  # pools open many connections at once
 
-try:
-    while True:
-        try :
-            client_socket, address = server_socket.accept()
+    server_socket.settimeout(1.0)
+    threading.Thread(target=run_reaper, daemon=True).start()
 
-        except socket.timeout:
-            
-            continue
+    log.info("SERVER", "[SERVER STARTED] Listening on %s:%s", HOST, PORT)
+    log.info("SERVER", "[INFO] Waiting for client connections...")
 
-        with clients_lock:
-            client_counter += 1
-            client_id = client_counter
-            clients[client_id] = client_socket
+    try:
+        while True:
+            try :
+                client_socket, address = server_socket.accept()
+
+            except socket.timeout:
+
+                continue
 
-        print(f"[NEW CONNECTION] Client {client_id} connected from {address[0]}:{address[1]}")
-        print(f"[INFO] Total clients connected: {len(clients)}")
+            refusal = admit_connection(address, MAX_CONNECTIONS)
+            if refusal is not None:
+                try:
+                    client_socket.send(refusal)
+                except OSError:
+                    pass
+                client_socket.close()
+                continue
+
+            set_keepalive(client_socket)
+            connection = ClientConnection(client_socket)
+            client_id = register_client(connection, address)
+
+            log.info("CONNECTION", "[NEW CONNECTION] Client %s connected from %s:%s | Total clients: %s",
+                     client_id, address[0], address[1], len(clients))
+
+            thread = threading.Thread(target=handle_client, args=(connection,))
+            thread.start()
+
+    except KeyboardInterrupt:
+        log.info("SERVER", "[SERVER] Shutting down...")
+        server_socket.close()
+        # Handler threads are blocked in recv(); closing the sockets lets them exit
+        with clients_lock:
+            connections = list(clients.values())
+        for connection in connections:
+            connection.close(flush_timeout=0)
+        message_manager.stop()
+        log.flush()
 
-        thread = threading.Thread(target=handle_client, args=(client_socket, client_id))
-        thread.start()
 
-except KeyboardInterrupt:
-    print("\n[SERVER] Shutting down...")
-    message_manager.stop()
-    server_socket.close()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,327 @@
-def send_to_client(clients, clients_lock, client_id, message):
-    with clients_lock:
-        if client_id in clients:
+import os
+import socket
+import threading
+import time
+from collections import deque
+from protocol import encode_message, encode_reply
+from metrics import metrics
+from logger import log
+
+# Outbound queue limits (bytes). A connection whose unsent data grows past the
+# high watermark is a slow consumer; senders blocked by the "block" policy
+# resume once the writer has drained it below the low watermark.
+QUEUE_HIGH_WATERMARK = 1024 * 1024
+QUEUE_LOW_WATERMARK = 256 * 1024
+
+# What to do when a consumer falls behind:
+#   "drop_oldest" - discard the oldest queued messages to make room
+#   "disconnect"  - close the connection
+#   "block"       - make the sender wait (up to BLOCK_TIMEOUT, then disconnect)
+POLICY_DROP_OLDEST = "drop_oldest"
+POLICY_DISCONNECT = "disconnect"
+POLICY_BLOCK = "block"
+SLOW_CONSUMER_POLICY = POLICY_DROP_OLDEST
+BLOCK_TIMEOUT = 5.0
+
+# TCP keepalive: the kernel probes a connection after KEEPALIVE_IDLE seconds
+# without traffic, every KEEPALIVE_INTERVAL seconds, and drops it after
+# KEEPALIVE_COUNT unanswered probes. Sent data that stays unacknowledged for
+# the same total time also drops it (TCP_USER_TIMEOUT, Linux).
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 5
+
+# Max buffers per sendmsg() call
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+class SlowConsumerError(Exception):
+    """Raised when a message cannot be queued for a client that fell behind"""
+
+
+class OutboundQueue:
+    """
+    Bounded queue of encoded records waiting to be written to one socket.
+
+    Records are queued whole, so dropping the oldest ones never leaves a
+    partial frame on the wire.
+    """
+
+    def __init__(self, policy=None, high_watermark=None, low_watermark=None):
+        self.policy = policy or SLOW_CONSUMER_POLICY
+        self.high_watermark = high_watermark or QUEUE_HIGH_WATERMARK
+        self.low_watermark = low_watermark or QUEUE_LOW_WATERMARK
+        self.chunks = deque()
+        self.queued_bytes = 0
+        self.dropped = 0
+        self.closed = False
+        self.finishing = False
+        self.cond = threading.Condition(threading.Lock())
+
+    def put(self, data):
+        """Queue one encoded record, applying the slow-consumer policy if full"""
+        with self.cond:
+            self._make_room(len(data))
+            self.chunks.append(data)
+            self.queued_bytes += len(data)
+            self.cond.notify_all()
+
+    def put_many(self, chunks):
+        """Queue several records; the policy is applied once for their total size"""
+        total = sum(len(chunk) for chunk in chunks)
+        with self.cond:
+            self._make_room(total)
+            self.chunks.extend(chunks)
+            self.queued_bytes += total
+            self.cond.notify_all()
+
+    def _make_room(self, size):
+        """Apply the slow-consumer policy before queuing size bytes (lock held)"""
+        if self.closed or self.finishing:
+            raise SlowConsumerError("connection closed")
+
+        # An empty queue always accepts, however large the record
+        if not self.chunks or self.queued_bytes + size <= self.high_watermark:
+            return
+
+        if self.policy == POLICY_DROP_OLDEST:
+            while self.chunks and self.queued_bytes + size > self.high_watermark:
+                self.queued_bytes -= len(self.chunks.popleft())
+                self.dropped += 1
+        elif self.policy == POLICY_BLOCK:
+            drained = self.cond.wait_for(
+                lambda: self.closed or self.queued_bytes <= self.low_watermark,
+                timeout=BLOCK_TIMEOUT)
+            if self.closed:
+                raise SlowConsumerError("connection closed")
+            if not drained:
+                self._close()
+                raise SlowConsumerError("send blocked for too long")
+        else:
+            self._close()
+            raise SlowConsumerError("outbound queue full")
+
+    def get_batch(self):
+        """Wait for queued records and take all of them; [] once closed"""
+        with self.cond:
+            while not self.chunks and not self.closed and not self.finishing:
+                self.cond.wait()
+            return self._take_all()
+
+    def get_batch_nowait(self):
+        """Take every queued record without waiting"""
+        with self.cond:
+            return self._take_all()
+
+    def wait_drained(self, timeout=None):
+        """Wait until at most low_watermark bytes are queued; False on timeout or close"""
+        with self.cond:
+            drained = self.cond.wait_for(
+                lambda: self.closed or self.queued_bytes <= self.low_watermark, timeout=timeout)
+            return drained and not self.closed
+
+    def finish(self):
+        """Stop accepting records; get_batch() returns what is left, then []"""
+        with self.cond:
+            self.finishing = True
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self._close()
+
+    def _take_all(self):
+        if self.closed:
+            return []
+        chunks = list(self.chunks)
+        self.chunks.clear()
+        self.queued_bytes = 0
+        self.cond.notify_all()
+        return chunks
+
+    def _close(self):
+        self.closed = True
+        self.chunks.clear()
+        self.queued_bytes = 0
+        self.cond.notify_all()
+
+
+class ClientConnection:
+    """
+    A connected client socket plus the wire format it speaks.
+
+    Messages are never written by the thread that produced them: they go into
+    a per-connection OutboundQueue and a dedicated writer thread sends them,
+    so a client with a full socket buffer only ever delays itself.
+    """
+
+    def __init__(self, sock, policy=None, high_watermark=None, low_watermark=None):
+        self.sock = sock
+        self.client_id = None  # assigned by register_client, may change on IDENTIFY
+        # Switched on by the handler once the client sends a framed record;
+        # until then replies go out as legacy text lines.
+        self.framed = False
+        # protocol.Compression once the client negotiated it with HELLO
+        self.compression = None
+        self.limiter = None  # ratelimit.RateLimiter, set by register_client
+        # Heartbeat state (server.reap_idle_clients): when we last received
+        # data, when we last sent PING, and whether a record is half-received
+        self.last_seen = time.monotonic()
+        self.pinged = 0.0
+        self.partial = False
+        self.queue = OutboundQueue(policy, high_watermark, low_watermark)
+        self.writer_thread = threading.Thread(target=self._writer, daemon=True)
+        self.writer_thread.start()
+
+    def send_message(self, message):
+        self.send_bytes(encode_message(message, self.framed, self.compression))
+
+    def send_bytes(self, data):
+        try:
+            self.queue.put(data)
+        except SlowConsumerError:
+            self._shutdown()
+            raise
+
+    def send_batch(self, chunks):
+        """Queue many encoded records at once; the writer sends them with one sendmsg()"""
+        try:
+            self.queue.put_many(chunks)
+        except SlowConsumerError:
+            self._shutdown()
+            raise
+
+    def pending_bytes(self):
+        """Bytes queued but not yet handed to the socket"""
+        return self.queue.queued_bytes
+
+    def resume_when_drained(self, callback):
+        """
+        Pace a producer (e.g. a streamed reply) to the client's reading speed.
+
+        Blocks the calling handler thread until the queue has drained to the
+        low watermark and returns True to carry on; callback is not needed
+        here. False means the connection closed or stayed backed up for
+        BLOCK_TIMEOUT, and the producer should stop.
+        """
+        return self.queue.wait_drained(BLOCK_TIMEOUT)
+
+    def close(self, flush_timeout=1.0):
+        """Flush what is already queued (bounded by flush_timeout), then shut down"""
+        self.queue.finish()
+        if threading.current_thread() is not self.writer_thread:
+            self.writer_thread.join(timeout=flush_timeout)
+        self.queue.close()
+        self._shutdown()
+
+    def _writer(self):
+        """Dedicated writer thread: drains the outbound queue into the socket"""
+        while True:
+            chunks = self.queue.get_batch()
+            if not chunks:
+                break
             try:
-                clients[client_id].send(message.encode('utf-8'))
-                return True
-            except Exception as e:
-                print(f"[ERROR] Failed to send to Client {client_id}: {e}")
-                return False
+                send_vectored(self.sock, chunks)
+            except OSError:
+                self.queue.close()
+                self._shutdown()
+                break
+            if metrics.enabled:
+                metrics.inc("bytes_sent_total", sum(map(len, chunks)))
+
+    def _shutdown(self):
+        # Wakes the handler thread blocked in recv() so it can clean up
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def set_keepalive(sock):
+    """Turn on TCP keepalive with the KEEPALIVE_* timings, where the platform has the options"""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    timeout = KEEPALIVE_IDLE + KEEPALIVE_INTERVAL * KEEPALIVE_COUNT
+    for option, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                          ("TCP_KEEPCNT", KEEPALIVE_COUNT), ("TCP_USER_TIMEOUT", timeout * 1000)):
+        if hasattr(socket, option):
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+            except OSError:
+                pass
+
+
+def send_vectored(sock, chunks):
+    """
+    Write every buffer in chunks using scatter/gather sendmsg() calls,
+    handling partial writes. Falls back to one joined sendall() where
+    sendmsg() is unavailable.
+    """
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b"".join(chunks))
+        return
+
+    views = [memoryview(chunk) for chunk in chunks]
+    index = 0
+    while index < len(views):
+        sent = sock.sendmsg(views[index:index + IOV_MAX])
+        while sent:
+            size = len(views[index])
+            if sent >= size:
+                sent -= size
+                index += 1
+            else:
+                views[index] = views[index][sent:]
+                sent = 0
+
+
+def send_to_client(clients, clients_lock, client_id, message, request_id=None):
+    # The lock only covers the id -> connection lookup; the send itself
+    # just queues the message for the connection's writer.
+    with clients_lock:
+        conn = clients.get(client_id)
+
+    if conn is None:
+        log.warning("ERROR", "[ERROR] Client %s not found", client_id)
+        return False
+
+    try:
+        if request_id is None:
+            conn.send_message(message)
         else:
-            print(f"[ERROR] Client {client_id} not found")
-            return False
+            conn.send_bytes(encode_reply(request_id, message, conn.compression))
+        return True
+    except Exception as e:
+        log.warning("ERROR", "[ERROR] Failed to send to Client %s: %s", client_id, e)
+        return False
+
+def broadcast(clients, clients_lock, message, exclude_id=None, recipient_ids=None):
+    """
+    Send one message to every client (or only to recipient_ids).
 
-def broadcast(clients, clients_lock, message, exclude_id=None):
+    The message is encoded (and compressed) at most once per wire format
+    and compression setting, and the same bytes object is queued on every
+    connection, so fan-out costs no copies.
+    """
     with clients_lock:
-        for cid, sock in clients.items():
-            if cid != exclude_id:
-                try:
-                    sock.send(message.encode('utf-8'))
-                except Exception as e:
-                    print(f"[ERROR] Broadcast to Client {cid} failed: {e}")
+        if recipient_ids is None:
+            targets = list(clients.items())
+        else:
+            targets = [(cid, clients[cid]) for cid in recipient_ids if cid in clients]
+
+    encoded = {}  # (framed flag, Compression) -> encoded bytes
+    for cid, conn in targets:
+        if cid != exclude_id:
+            key = (conn.framed, conn.compression)
+            data = encoded.get(key)
+            if data is None:
+                data = encoded[key] = encode_message(message, conn.framed, conn.compression)
+            try:
+                conn.send_bytes(data)
+            except Exception as e:
+                log.warning("ERROR", "[ERROR] Broadcast to Client %s failed: %s", cid, e)
 
 def get_client_list(clients, clients_lock):
     with clients_lock:
@@ -0,0 +1,121 @@
+import zlib
+
+import pytest
+
+import server
+from protocol import (Compression, DEFAULT_DICTIONARY, DEFAULT_DICTIONARY_ID, FLAG_COMPRESSED, FrameDecoder,
+                      FRAME_TEXT, HEADER_SIZE, MAX_FRAME_SIZE, ProtocolError, build_dictionary, compression_for,
+                      decompress, encode_frame, register_dictionary)
+
+CHAT = b"MESSAGES:" + b";".join(b"ID:%d,received,Client:3,At:1700000000.000" % i for i in range(100))
+
+
+def decode(data):
+    decoder = FrameDecoder()
+    decoder.feed(data)
+    return list(decoder.frames())
+
+
+@pytest.mark.parametrize("dict_id", [None, DEFAULT_DICTIONARY_ID])
+def test_compressed_frame_round_trip(dict_id):
+    frame = encode_frame(CHAT, FRAME_TEXT, compression_for(dict_id))
+    assert frame[2] == FRAME_TEXT | FLAG_COMPRESSED
+    assert len(frame) < len(CHAT)
+    assert decode(frame) == [(FRAME_TEXT, CHAT)]
+
+
+def test_dictionary_shrinks_small_payloads():
+    payload = b"SENT:Message queued for offline Client 12 (ID:345);" * 12
+    plain = encode_frame(payload, FRAME_TEXT, compression_for())
+    primed = encode_frame(payload, FRAME_TEXT, compression_for(DEFAULT_DICTIONARY_ID))
+    assert len(primed) < len(plain)
+
+
+def test_short_payload_sent_uncompressed():
+    frame = encode_frame(b"LIST", FRAME_TEXT, compression_for())
+    assert frame[2] == FRAME_TEXT
+    assert frame[HEADER_SIZE:] == b"LIST"
+
+
+def test_unknown_dictionary_falls_back_to_none():
+    assert compression_for(12345).dict_id is None
+    assert compression_for(DEFAULT_DICTIONARY_ID).dict_id == DEFAULT_DICTIONARY_ID
+
+
+def test_unknown_dictionary_rejected():
+    packed = Compression(b"a dictionary the decoder never registered" * 4).compress(CHAT)
+    with pytest.raises(ProtocolError):
+        decompress(packed)
+
+
+def test_zip_bomb_rejected():
+    bomb = zlib.compress(b"\0" * (MAX_FRAME_SIZE + 1), 9)
+    with pytest.raises(ProtocolError):
+        decompress(bomb)
+
+
+def test_truncated_and_corrupt_streams_rejected():
+    packed = zlib.compress(CHAT)
+    with pytest.raises(ProtocolError):
+        decompress(packed[:len(packed) // 2])
+    with pytest.raises(ProtocolError):
+        decompress(b"\x78\x01not zlib at all")
+
+
+def test_trained_dictionary_round_trip():
+    samples = [b"MSG:7:are we still meeting at the library tonight?"] * 20
+    zdict = build_dictionary(samples, size=1024)
+    assert len(zdict) <= max(1024, len(DEFAULT_DICTIONARY))
+    assert zdict.endswith(DEFAULT_DICTIONARY)
+    dict_id = register_dictionary(zdict)
+    frame = encode_frame(samples[0] * 12, FRAME_TEXT, compression_for(dict_id))
+    assert decode(frame) == [(FRAME_TEXT, samples[0] * 12)]
+
+
+class RecordingConnection:
+    def __init__(self, framed):
+        self.framed = framed
+        self.compression = None
+        self.sent = []
+
+    def send_message(self, message):
+        self.sent.append(message)
+
+
+@pytest.fixture
+def connection():
+    """Factory registering a RecordingConnection as client 7"""
+    def connect(framed=True):
+        conn = server.clients[7] = RecordingConnection(framed)
+        return conn
+
+    yield connect
+    server.clients.pop(7, None)
+
+
+def test_hello_negotiates_dictionary(connection):
+    conn = connection()
+    server.process_command(7, f"HELLO:zlib:{DEFAULT_DICTIONARY_ID}")
+    assert conn.sent == [f"HELLO:zlib:{DEFAULT_DICTIONARY_ID}"]
+    assert conn.compression.dict_id == DEFAULT_DICTIONARY_ID
+
+
+def test_hello_without_known_dictionary(connection):
+    conn = connection()
+    server.process_command(7, "HELLO:zlib:12345")
+    assert conn.sent == ["HELLO:zlib"]
+    assert conn.compression is not None and conn.compression.dict_id is None
+
+
+def test_hello_refused_for_text_clients(connection):
+    conn = connection(framed=False)
+    server.process_command(7, "HELLO:zlib")
+    assert conn.sent == ["HELLO:none"]
+    assert conn.compression is None
+
+
+def test_hello_unknown_method(connection):
+    conn = connection()
+    server.process_command(7, "HELLO:lz4")
+    assert conn.sent == ["HELLO:none"]
+    assert conn.compression is None
@@ -0,0 +1,28 @@
+from delivery import PendingDeliveries
+from message_manager import MessageManager
+
+
+def test_prune_drops_expired_and_deleted():
+    manager = MessageManager(start_worker=False)
+    pending = PendingDeliveries()
+    expiring = [manager.store_message(1, 2, f"m{n}", ttl=0) for n in range(1000)]
+    kept = manager.store_message(1, 3, "kept")
+    deleted = manager.store_message(1, 3, "deleted")
+    for message_id in expiring:
+        pending.add(2, message_id)
+    pending.add(3, kept)
+    pending.add(3, deleted)
+
+    manager._auto_delete_expired()
+    manager.delete_message(deleted)
+    assert pending.prune(manager.get_messages, batch_size=64) == 1001
+    assert pending.total() == 1
+    assert pending.get(3) == [kept]
+    manager.stop()
+
+
+def test_number_of_queues_is_capped():
+    pending = PendingDeliveries(max_clients=3)
+    for client_id in range(5):
+        pending.add(client_id, client_id + 100)
+    assert [pending.count(client_id) for client_id in range(5)] == [0, 0, 1, 1, 1]
@@ -0,0 +1,158 @@
+import time
+
+import pytest
+
+from message_log import MessageLog, RECORD_STORE, encode_store, read_records
+from message_manager import MessageManager, ShardedMessageManager
+
+STORAGES = ["dict", "compact"]
+
+
+def open_manager(log_dir, storage="dict"):
+    return MessageManager(storage=storage, start_worker=False, log_dir=str(log_dir), durability="sync")
+
+
+def contents(manager, client_id):
+    return [msg.content for msg in manager.get_client_messages(client_id)]
+
+
+@pytest.mark.parametrize("storage", STORAGES)
+def test_restart_replays_segments(tmp_path, storage):
+    manager = open_manager(tmp_path, storage)
+    ids = [manager.store_message(1, 2, f"hello {n}") for n in range(5)]
+    manager.delete_message(ids[1])
+    manager.delete_many([ids[3]])
+    manager.stop()
+
+    manager = open_manager(tmp_path, storage)
+    assert contents(manager, 2) == ["hello 0", "hello 2", "hello 4"]
+    assert manager.get_message(ids[4]).sender_id == 1
+    assert manager.store_message(1, 2, "after") > ids[-1]
+    manager.stop()
+
+
+@pytest.mark.parametrize("storage", STORAGES)
+def test_restart_after_checkpoint(tmp_path, storage):
+    manager = open_manager(tmp_path, storage)
+    ids = [manager.store_message(1, 2, f"old {n}") for n in range(3)]
+    manager.delete_message(ids[0])
+    manager.checkpoint()
+    manager.store_message(2, 1, "new")
+    manager.stop()
+
+    assert len(list(tmp_path.glob("snapshot-*.snap"))) == 1
+    manager = open_manager(tmp_path, storage)
+    assert contents(manager, 2) == ["old 1", "old 2", "new"]
+    manager.stop()
+
+
+@pytest.mark.parametrize("storage", STORAGES)
+def test_ids_not_reused_after_delete_all_and_checkpoint(tmp_path, storage):
+    manager = open_manager(tmp_path, storage)
+    last_id = max(manager.store_message(1, 2, f"m{n}") for n in range(3))
+    manager.clear_all_messages()
+    manager.checkpoint()
+    manager.stop()
+
+    manager = open_manager(tmp_path, storage)
+    assert manager.get_stats()['total_messages'] == 0
+    assert manager.store_message(1, 2, "fresh") > last_id
+    manager.stop()
+
+
+@pytest.mark.parametrize("storage", STORAGES)
+def test_ids_not_reused_after_expiry_and_checkpoint(tmp_path, storage):
+    manager = open_manager(tmp_path, storage)
+    last_id = manager.store_message(1, 2, "short", ttl=0.05)
+    time.sleep(0.1)
+    assert manager._auto_delete_expired() == 1
+    manager.checkpoint()
+    manager.stop()
+
+    manager = open_manager(tmp_path, storage)
+    assert manager.store_message(1, 2, "fresh") > last_id
+    manager.stop()
+
+
+@pytest.mark.parametrize("storage", STORAGES)
+def test_expired_messages_not_recovered(tmp_path, storage):
+    manager = open_manager(tmp_path, storage)
+    manager.store_message(1, 2, "short", ttl=0.05)
+    manager.store_message(1, 2, "long")
+    manager.stop()
+    time.sleep(0.1)
+
+    manager = open_manager(tmp_path, storage)
+    assert contents(manager, 2) == ["long"]
+    manager.stop()
+
+
+@pytest.mark.parametrize("storage", STORAGES)
+def test_delete_all_then_restart(tmp_path, storage):
+    manager = open_manager(tmp_path, storage)
+    for n in range(3):
+        manager.store_message(1, 2, f"gone {n}")
+    manager.clear_all_messages()
+    manager.store_message(2, 1, "kept")
+    manager.stop()
+
+    manager = open_manager(tmp_path, storage)
+    assert manager.get_stats()['total_messages'] == 1
+    assert contents(manager, 1) == ["kept"]
+    assert contents(manager, 2) == ["kept"]
+    manager.stop()
+
+
+@pytest.mark.parametrize("storage", STORAGES)
+@pytest.mark.parametrize("checkpoint", [False, True])
+def test_broadcast_unlink_survives_restart(tmp_path, storage, checkpoint):
+    manager = open_manager(tmp_path, storage)
+    broadcast_id = manager.store_broadcast(1, [2, 3, 4], "to all")
+    manager.delete_client_messages(3)  # drops 3 from the recipients only
+    if checkpoint:
+        manager.checkpoint()
+    manager.delete_client_messages(4)
+    manager.stop()
+
+    manager = open_manager(tmp_path, storage)
+    assert manager.get_message(broadcast_id).recipients == {2}
+    assert contents(manager, 2) == ["to all"]
+    assert contents(manager, 3) == []
+    assert contents(manager, 4) == []
+
+    # The last recipient leaving removes the broadcast, also after a restart
+    manager.delete_client_messages(2)
+    manager.stop()
+    manager = open_manager(tmp_path, storage)
+    assert manager.get_message(broadcast_id) is None
+    manager.stop()
+
+
+def test_sharded_restart(tmp_path):
+    manager = ShardedMessageManager(num_shards=4, log_dir=str(tmp_path), durability="sync")
+    ids = [manager.store_message(sender, 9, f"from {sender}") for sender in range(1, 9)]
+    for shard in manager.shards:
+        shard.checkpoint()
+    manager.delete_message(ids[0])
+    manager.stop()
+
+    manager = ShardedMessageManager(num_shards=4, log_dir=str(tmp_path), durability="sync")
+    assert sorted(contents(manager, 9)) == sorted(f"from {sender}" for sender in range(2, 9))
+    new_ids = [manager.store_message(sender, 9, "again") for sender in range(1, 9)]
+    assert not set(new_ids) & set(ids)
+    manager.stop()
+
+
+def test_torn_tail_is_ignored(tmp_path):
+    log = MessageLog(str(tmp_path), durability="sync")
+    log.wait(log.append(encode_store(1, 1, 2, "intact", time.time(), time.time() + 60)))
+    log.close()
+    segment = sorted(tmp_path.glob("segment-*.log"))[0]
+    torn = encode_store(2, 1, 2, "torn", time.time(), time.time() + 60)
+    with open(segment, "ab") as f:
+        f.write(torn[:-3])
+
+    assert [record_type for record_type, _ in read_records(segment)] == [RECORD_STORE]
+    manager = open_manager(tmp_path)
+    assert contents(manager, 2) == ["intact"]
+    manager.stop()
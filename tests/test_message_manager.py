@@ -0,0 +1,92 @@
+from message_manager import ClientIndex, MessageManager, ShardedMessageManager
+
+
+def page_all(manager, client_id, limit):
+    ids = []
+    cursor = ()
+    while True:
+        page, more = manager.get_client_messages_page(client_id, cursor, limit)
+        ids += [msg.message_id for msg in page]
+        if not more:
+            return ids
+        cursor = manager.next_cursor(cursor, page)
+
+
+def test_client_index_tombstones_and_compaction():
+    index = ClientIndex()
+    for message_id in range(1, 11):
+        index.add(message_id)
+    for message_id in (2, 4, 6):
+        index.discard(message_id)
+    assert list(index) == [1, 3, 5, 7, 8, 9, 10]
+    assert list(index.iter_after(5)) == [7, 8, 9, 10]
+
+    for message_id in (1, 3, 8):
+        index.discard(message_id)
+    # More than half tombstoned: the array was compacted
+    assert list(index.ids) == [5, 7, 9, 10]
+    assert len(index) == 4
+
+
+def test_page_resumes_after_deleted_cursor():
+    manager = MessageManager(start_worker=False)
+    ids = [manager.store_message(n % 2 + 1, 2 - n % 2, f"m{n}") for n in range(50)]
+
+    page, more = manager.get_client_messages_page(1, (), 10)
+    assert more and [msg.message_id for msg in page] == ids[:10]
+    manager.delete_many(ids[5:15])
+
+    page, more = manager.get_client_messages_page(1, manager.next_cursor((), page), 10)
+    assert [msg.message_id for msg in page] == ids[15:25]
+    assert page_all(manager, 2, 7) == ids[:5] + ids[15:]
+    manager.stop()
+
+
+def test_sharded_spreads_senders_of_one_worker():
+    manager = ShardedMessageManager(4, id_offset=1, id_stride=4)
+    senders = [c * 4 + 1 for c in range(8)]
+    for sender in senders:
+        manager.store_message(sender, 2, "hi")
+    manager.store_many([(sender, 2, "batch") for sender in senders])
+    assert [len(shard.messages) for shard in manager.shards] == [4, 4, 4, 4]
+    for sender in senders:
+        assert manager.shard_for_client(sender).get_client_messages(sender, "sent")
+    manager.stop()
+
+
+def test_long_ttl_does_not_block_expiry_arrays():
+    manager = MessageManager(start_worker=False, message_ttl=120)
+    manager.store_message(1, 2, "long", ttl=3600)
+    manager.store_many([(1, 2, "default")] * 100)
+    queue = manager.expiry_queue
+    assert len(queue.heap) == 1 and len(queue.ids) == 100
+
+    manager.store_message(1, 2, "short", ttl=0)
+    assert manager._auto_delete_expired() == 1
+    assert len(queue) == 101
+    manager.stop()
+
+
+def test_sharded_pages_return_every_id_once():
+    manager = ShardedMessageManager(4)
+    ids = []
+    for n in range(60):
+        sender = n % 7 + 3
+        ids.append(manager.store_message(sender, 1, f"to {n}"))
+        ids.append(manager.store_message(1, sender, f"from {n}"))
+    ids.append(manager.store_broadcast(5, [1, 2], "all"))
+
+    paged = page_all(manager, 1, 7)
+    assert len(paged) == len(set(paged))
+    assert sorted(paged) == sorted(ids)
+
+    received = []
+    cursor = ()
+    while True:
+        page, more = manager.get_client_messages_page(1, cursor, 3, direction="received")
+        received += [msg.message_id for msg in page]
+        if not more:
+            break
+        cursor = manager.next_cursor(cursor, page)
+    assert sorted(received) == sorted(ids[0:120:2] + ids[-1:])
+    manager.stop()
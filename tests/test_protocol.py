@@ -0,0 +1,122 @@
+import pytest
+
+from protocol import (FrameDecoder, ProtocolError, FRAME_LINE, FRAME_REQUEST, FRAME_TEXT, HEADER, MAGIC,
+                      MAX_FRAME_SIZE, MAX_LINE_SIZE, encode_frame, encode_message, encode_request,
+                      split_request)
+
+
+def decode(*chunks, decoder=None):
+    """Feed the chunks one read at a time and collect every record"""
+    decoder = decoder or FrameDecoder(buffer_size=64)
+    records = []
+    for chunk in chunks:
+        decoder.feed(chunk)
+        records.extend(decoder.frames())
+    return records
+
+
+def test_frame_round_trip():
+    assert decode(encode_frame(b"SEND:2:hi")) == [(FRAME_TEXT, b"SEND:2:hi")]
+
+
+def test_frame_split_across_reads():
+    data = encode_frame(b"SEND:2:" + b"x" * 300)
+    decoder = FrameDecoder(buffer_size=64)
+    records = decode(*(data[i:i + 1] for i in range(len(data))), decoder=decoder)
+    assert records == [(FRAME_TEXT, b"SEND:2:" + b"x" * 300)]
+    assert decoder.pending() == 0
+
+
+def test_header_split_across_reads():
+    data = encode_frame(b"LIST")
+    assert decode(data[:3], data[3:5], data[5:]) == [(FRAME_TEXT, b"LIST")]
+
+
+def test_pipelined_frames_in_one_read():
+    commands = [b"SEND:2:a", b"LIST", b"MSG_STATS", b"DELETE_MSG:7"]
+    data = b"".join(encode_frame(command) for command in commands)
+    assert decode(data) == [(FRAME_TEXT, command) for command in commands]
+
+
+def test_partial_frame_is_kept_until_complete():
+    first, second = encode_frame(b"LIST"), encode_frame(b"MSG_STATS")
+    decoder = FrameDecoder(buffer_size=64)
+    assert decode(first + second[:4], decoder=decoder) == [(FRAME_TEXT, b"LIST")]
+    assert decoder.pending() == 4
+    assert decode(second[4:], decoder=decoder) == [(FRAME_TEXT, b"MSG_STATS")]
+
+
+def test_text_lines_and_frames_mixed():
+    data = b"LIST\n" + encode_frame(b"MSG_STATS") + b"  SEND:2:hi \r\n\n" + encode_frame(b"quit")
+    assert decode(data) == [
+        (FRAME_LINE, b"LIST"),
+        (FRAME_TEXT, b"MSG_STATS"),
+        (FRAME_LINE, b"SEND:2:hi"),
+        (FRAME_TEXT, b"quit"),
+    ]
+
+
+def test_text_line_split_across_reads():
+    assert decode(b"SEND:2:hel", b"lo\nLI", b"ST\n") == [(FRAME_LINE, b"SEND:2:hello"), (FRAME_LINE, b"LIST")]
+
+
+def test_large_frame_grows_buffer():
+    payload = b"y" * 200_000
+    assert decode(encode_frame(payload)) == [(FRAME_TEXT, payload)]
+
+
+def test_buffer_shrinks_after_large_frame():
+    decoder = FrameDecoder(buffer_size=64)
+    payload = b"y" * 200_000
+    frame = encode_frame(payload)
+    assert decode(frame[:1000], frame[1000:] + b"LI", decoder=decoder) == [(FRAME_TEXT, payload)]
+    # Still holding part of a record: the large buffer is kept
+    assert len(decoder._buf) > 200_000
+    assert decode(b"ST\n", decoder=decoder) == [(FRAME_LINE, b"LIST")]
+    assert len(decoder._buf) == 64
+
+
+def test_recv_into_buffer():
+    data = encode_frame(b"SEND:2:hi") + b"LIST\n"
+    decoder = FrameDecoder(buffer_size=64)
+    view = decoder.get_buffer()
+    view[:len(data)] = data
+    decoder.advance(len(data))
+    assert list(decoder.frames()) == [(FRAME_TEXT, b"SEND:2:hi"), (FRAME_LINE, b"LIST")]
+
+
+def test_oversize_frame_rejected_from_header():
+    header = HEADER.pack(MAGIC, 1, FRAME_TEXT, MAX_FRAME_SIZE + 1)
+    with pytest.raises(ProtocolError):
+        decode(header)
+
+
+def test_oversize_frame_not_encoded():
+    with pytest.raises(ProtocolError):
+        encode_frame(b"z" * (MAX_FRAME_SIZE + 1))
+
+
+def test_oversize_line_rejected():
+    with pytest.raises(ProtocolError):
+        decode(b"a" * (MAX_LINE_SIZE + 1))
+
+
+def test_unknown_version_rejected():
+    with pytest.raises(ProtocolError):
+        decode(HEADER.pack(MAGIC, 2, FRAME_TEXT, 0))
+
+
+def test_encode_message_for_text_peer():
+    assert encode_message("CLIENTS:1,2", framed=False) == b"CLIENTS:1,2\n"
+    assert decode(encode_message("CLIENTS:1,2")) == [(FRAME_TEXT, b"CLIENTS:1,2")]
+
+
+def test_request_round_trip():
+    [(frame_type, payload)] = decode(encode_request(42, "LIST"))
+    assert frame_type == FRAME_REQUEST
+    assert split_request(payload) == (42, b"LIST")
+
+
+def test_short_request_rejected():
+    with pytest.raises(ProtocolError):
+        split_request(b"\x00\x01")